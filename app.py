@@ -1,13 +1,59 @@
 from flask import (
     Flask, render_template, request,
-    redirect, url_for, session, flash, make_response
+    redirect, url_for, session, flash, make_response, abort, jsonify,
+    stream_template, stream_with_context, get_flashed_messages, g,
+    has_request_context, has_app_context, send_file,
 )
+from flask.sessions import SecureCookieSessionInterface
 from werkzeug.security import generate_password_hash, check_password_hash
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+from datetime import date, datetime, timedelta
 from functools import wraps
+from collections import Counter, deque, namedtuple
+from sqlalchemy import (
+    or_, and_, inspect, text, event, MetaData, Table, Column, Index, insert, update, delete,
+    select, case, literal, bindparam,
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import Select
+from sqlalchemy.sql.visitors import replacement_traverse
+from sqlalchemy.schema import CreateTable
+from compression import CompressionMiddleware
+from cache import Cache, STAT_NAMES as CACHE_STAT_NAMES
+from metrics import Registry, MetricsMiddleware
+from profiler import (
+    ProfilerMiddleware, list_profiles, load_profile, load_collapsed, profile_file,
+    top_functions, flame_tree,
+)
+import backup
+import atexit
+import base64
+import csv
+import gzip
+import hashlib
+import heapq
+import io
+import json
+import math
 import os
-from sqlalchemy import or_, inspect, text
+import random
+import re
+import socket
+import sqlite3
+import statistics
+import sys
+import threading
+import time
+import zlib
+
+try:
+    import brotli  # необязателен: без него статические страницы отдаются в gzip
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
 
@@ -29,16 +75,118 @@ def allowed_file(filename: str) -> bool:
 
 # путь к БД
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_PATH = os.path.join(BASE_DIR, "database", "fair.db")
+DB_PATH = os.environ.get("DB_PATH", os.path.join(BASE_DIR, "database", "fair.db"))
 DB_URI = "sqlite:///" + DB_PATH.replace("\\", "/")
 
 app.config["SQLALCHEMY_DATABASE_URI"] = DB_URI
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+# === кэш байткода шаблонов ===
+# общий для всех воркеров на машине; заполняется при выкладке precompile_templates.py,
+# устаревшие файлы Jinja отбрасывает сам по контрольной сумме исходника
+JINJA_CACHE_DIR = os.environ.get(
+    "JINJA_CACHE_DIR", os.path.join(BASE_DIR, "cache", "jinja")
+)
+os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+app.jinja_options = {
+    **app.jinja_options,
+    "bytecode_cache": FileSystemBytecodeCache(JINJA_CACHE_DIR),
+}
+
+# === общий кэш ===
+# локальный LRU в каждом воркере + общий файл SQLite для всех воркеров машины;
+# сброс пространства ключей через cache.invalidate() доходит до всех процессов
+CACHE_PATH = os.environ.get("CACHE_PATH", os.path.join(BASE_DIR, "cache", "shared.db"))
+app.config.setdefault("CACHE_LOCAL_SIZE", 2048)
+app.config.setdefault("CACHE_SHARED_SIZE", 20000)
+app.config.setdefault("CACHE_DEFAULT_TTL", 300)
+app.config.setdefault("CACHE_CHECK_INTERVAL", 0.5)
+cache = Cache(
+    CACHE_PATH,
+    local_size=app.config["CACHE_LOCAL_SIZE"],
+    default_ttl=app.config["CACHE_DEFAULT_TTL"],
+    shared_size=app.config["CACHE_SHARED_SIZE"],
+    check_interval=app.config["CACHE_CHECK_INTERVAL"],
+)
+
+# === архив ===
+# старые строки переезжают в отдельный файл, который подключается к каждому
+# соединению как схема archive; с ARCHIVE_PATH="" — в таблицы *_archive той же базы
+ARCHIVE_PATH = os.environ.get("ARCHIVE_PATH", os.path.join(BASE_DIR, "database", "archive.db"))
+ARCHIVE_SCHEMA = "archive" if ARCHIVE_PATH else None
+
 db = SQLAlchemy(app)
 
+
+@event.listens_for(Engine, "connect")
+def _sqlite_on_connect(dbapi_conn, conn_record):
+    # SQLite по умолчанию не проверяет внешние ключи и не делает каскады
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA foreign_keys=ON")
+    if ARCHIVE_SCHEMA:
+        cur.execute(f"ATTACH DATABASE ? AS {ARCHIVE_SCHEMA}", (ARCHIVE_PATH,))
+    cur.close()
+
+
 # ===== МОДЕЛИ =====
 
+# оформление карточек улиц: короткий тег и описание по коду улицы
+STREET_META = {
+    "it": {
+        "tag": "IT & разработка",
+        "desc": "Помощь с программированием, лабораторными, проектами и разбором кода.",
+    },
+    "design": {
+        "tag": "Дизайн & визуал",
+        "desc": "Презентации, графика, визуал для соцсетей и учебных проектов.",
+    },
+    "study": {
+        "tag": "Учёба & репетиторство",
+        "desc": "Конспекты, подготовка к зачётам и экзаменам, объяснение теории.",
+    },
+    "photo": {
+        "tag": "Фото & креатив",
+        "desc": "Фотосессии, обработка, оформление аватарок и портфолио.",
+    },
+    "cyber": {
+        "tag": "Киберпространство & сети",
+        "desc": "Всё про сети, базовую кибербезопасность и настройки железа.",
+    },
+    "automation": {
+        "tag": "Python & автоматизация",
+        "desc": "Задачи по автоматизации, скриптам и ботам для учёбы и рутины.",
+    },
+    "algos": {
+        "tag": "Алгоритмы & структуры данных",
+        "desc": "Подготовка по алгоритмам и структурам данных для учёбы и собесов.",
+    },
+    "frontend": {
+        "tag": "Фронтенд & вёрстка",
+        "desc": "HTML, CSS, JS, адаптивная вёрстка и современный фронтенд.",
+    },
+    "uiux": {
+        "tag": "Интерфейсы & UX",
+        "desc": "Интерфейсы, UX, прототипы и улучшение удобства сайтов.",
+    },
+    "pixel": {
+        "tag": "Цифровой арт & пиксели",
+        "desc": "Пиксель-арт, иллюстрации, стилизация и визуальные фишки.",
+    },
+    "inspire": {
+        "tag": "Проспект вдохновения",
+        "desc": "Мозговые штурмы, сценарии, идеи проектов и креативные форматы.",
+    },
+    "cheats": {
+        "tag": "Цифровая грамотность",
+        "desc": "Мир онлайн-жизни: соцсети, приватность, цифровой след "
+                "и грамотное поведение в интернете.",
+    },
+}
+STREET_META_DEFAULT = {
+    "tag": "Пространство мастеров",
+    "desc": "Пространство для любых цифровых мастерских и новых идей.",
+}
+
 
 class Street(db.Model):
     __tablename__ = "streets"
@@ -48,7 +196,13 @@ class Street(db.Model):
     code = db.Column(db.String(50), nullable=False, unique=True)
 
     # улица → павильоны
-    pavilions = db.relationship("Pavilion", backref="street", lazy="select")
+    pavilions = db.relationship(
+        "Pavilion", backref="street", lazy="select", passive_deletes=True
+    )
+
+    @property
+    def meta(self):
+        return STREET_META.get(self.code, STREET_META_DEFAULT)
 
 
 class Pavilion(db.Model):
@@ -56,11 +210,16 @@ class Pavilion(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
-    street_id = db.Column(db.Integer, db.ForeignKey("streets.id"), nullable=False)
+    street_id = db.Column(
+        db.Integer, db.ForeignKey("streets.id", ondelete="CASCADE"), nullable=False
+    )
     description = db.Column(db.Text, nullable=True)
 
+    # время постановки в очередь на удаление
+    deleted_at = db.Column(db.DateTime, nullable=True)
+
     # павильон → объявления
-    ads = db.relationship("Ad", backref="pavilion", lazy="select")
+    ads = db.relationship("Ad", backref="pavilion", lazy="select", passive_deletes=True)
 
 
 class Ad(db.Model):
@@ -75,17 +234,23 @@ class Ad(db.Model):
 
     pavilion_id = db.Column(
         db.Integer,
-        db.ForeignKey("pavilions.id"),
+        db.ForeignKey("pavilions.id", ondelete="CASCADE"),
         nullable=False,
     )
 
     # мастер из users
     master_id = db.Column(
         db.Integer,
-        db.ForeignKey("users.id"),
+        db.ForeignKey("users.id", ondelete="CASCADE"),
         nullable=True,
     )
 
+    deleted_at = db.Column(db.DateTime, nullable=True)
+
+    # для подборки на главной; у старых объявлений даты нет
+    created_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow)
+    views = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
     master = db.relationship("User", foreign_keys=[master_id])
 
     @property
@@ -110,13 +275,19 @@ class User(db.Model):
     full_name = db.Column(db.String(120), nullable=True)  # настоящее имя
     avatar_filename = db.Column(db.String(255), nullable=True)  # имя файла в /static/uploads/avatars
 
+    deleted_at = db.Column(db.DateTime, nullable=True)
+    # для аналитики (индекс — под дневные срезы); у зарегистрированных раньше даты нет
+    created_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow, index=True)
+
 
 class StreetRequest(db.Model):
     __tablename__ = "street_requests"
 
     id = db.Column(db.Integer, primary_key=True)
 
-    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False
+    )
     user = db.relationship("User", backref="street_requests")
 
     street_name = db.Column(db.String(120), nullable=False)
@@ -125,9 +296,14 @@ class StreetRequest(db.Model):
     pavilion_desc = db.Column(db.Text, nullable=True)
 
     status = db.Column(db.String(20), nullable=False, default="pending")
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
-    street_id = db.Column(db.Integer, db.ForeignKey("streets.id"), nullable=True)
+    street_id = db.Column(
+        db.Integer, db.ForeignKey("streets.id", ondelete="SET NULL"), nullable=True
+    )
+
+    # id не переиспользуются: старые строки лежат в архиве с теми же id
+    __table_args__ = {"sqlite_autoincrement": True}
 
 
 class AdRequest(db.Model):
@@ -135,17 +311,23 @@ class AdRequest(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
 
-    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False
+    )
     user = db.relationship("User", backref="ad_requests")
 
-    pavilion_id = db.Column(db.Integer, db.ForeignKey("pavilions.id"), nullable=False)
+    pavilion_id = db.Column(
+        db.Integer, db.ForeignKey("pavilions.id", ondelete="CASCADE"), nullable=False
+    )
     pavilion = db.relationship("Pavilion", backref="ad_requests")
 
     title = db.Column(db.String(250), nullable=False)
     text = db.Column(db.Text, nullable=False)
 
     status = db.Column(db.String(20), nullable=False, default="pending")
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+    __table_args__ = {"sqlite_autoincrement": True}
 
 
 class SupportMessage(db.Model):
@@ -153,39 +335,55 @@ class SupportMessage(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
 
-    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False
+    )
     user = db.relationship("User", backref="support_messages")
 
     subject = db.Column(db.String(200), nullable=False)
     text = db.Column(db.Text, nullable=False)
     status = db.Column(db.String(20), nullable=False, default="new")
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
     admin_reply = db.Column(db.Text, nullable=True)
     replied_at = db.Column(db.DateTime, nullable=True)
 
+    __table_args__ = {"sqlite_autoincrement": True}
+
 
 class AdMessage(db.Model):
     __tablename__ = "ad_messages"
 
     id = db.Column(db.Integer, primary_key=True)
-    ad_id = db.Column(db.Integer, db.ForeignKey("ads.id"), nullable=False)
-    sender_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
-    receiver_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    ad_id = db.Column(
+        db.Integer, db.ForeignKey("ads.id", ondelete="CASCADE"), nullable=False
+    )
+    sender_id = db.Column(
+        db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False
+    )
+    receiver_id = db.Column(
+        db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False
+    )
     text = db.Column(db.Text, nullable=False)
-    created_at = db.Column(db.DateTime, server_default=db.func.now())
+    created_at = db.Column(db.DateTime, server_default=db.func.now(), index=True)
     is_read = db.Column(db.Boolean, default=False, nullable=False)
 
+    __table_args__ = {"sqlite_autoincrement": True}
+
 
 class PavilionRequest(db.Model):
     __tablename__ = "pavilion_requests"
 
     id = db.Column(db.Integer, primary_key=True)
 
-    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False
+    )
     user = db.relationship("User", backref="pavilion_requests")
 
-    street_id = db.Column(db.Integer, db.ForeignKey("streets.id"), nullable=False)
+    street_id = db.Column(
+        db.Integer, db.ForeignKey("streets.id", ondelete="CASCADE"), nullable=False
+    )
     street = db.relationship("Street", backref="pavilion_requests")
 
     # старое поле title
@@ -198,7 +396,165 @@ class PavilionRequest(db.Model):
     ad_text = db.Column(db.Text, nullable=True)
 
     status = db.Column(db.String(20), nullable=False, default="pending")
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+    __table_args__ = {"sqlite_autoincrement": True}
+
+
+class DeletionTask(db.Model):
+    """Фоновое удаление пользователя, павильона или объявления."""
+
+    __tablename__ = "deletion_tasks"
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    # user / pavilion / pavilion_ads / ad
+    entity = db.Column(db.String(20), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    label = db.Column(db.String(200), nullable=True)  # что удаляем — для админки
+
+    status = db.Column(db.String(20), nullable=False, default="pending")
+    total_rows = db.Column(db.Integer, nullable=False, default=0)
+    done_rows = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    @property
+    def progress(self):
+        if self.status == "done":
+            return 100
+        if not self.total_rows:
+            return 0
+        return min(99, int(self.done_rows * 100 / self.total_rows))
+
+
+# задача «жива»: у таких unique_key не повторяется (частичный уникальный индекс)
+JOB_ACTIVE_SQL = "status IN ('queued', 'running')"
+
+
+class Job(db.Model):
+    """Задача фоновой очереди (хранится в той же SQLite-базе)."""
+
+    __tablename__ = "jobs"
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default="{}")  # JSON
+
+    priority = db.Column(db.Integer, nullable=False, default=0)  # больше — раньше
+    # queued / running / done / failed / cancelled
+    status = db.Column(db.String(20), nullable=False, default="queued")
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    # не даёт поставить дубль, пока такая же задача ждёт или выполняется
+    unique_key = db.Column(db.String(120), nullable=True)
+
+    locked_by = db.Column(db.String(120), nullable=True)
+    locked_at = db.Column(db.DateTime, nullable=True)  # heartbeat воркера
+    last_error = db.Column(db.Text, nullable=True)
+
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index("ix_jobs_queue", "status", "priority", "run_at"),
+        db.Index("ix_jobs_unique_key", "unique_key"),
+        db.Index(
+            "ux_jobs_active_key", "unique_key", unique=True, sqlite_where=text(JOB_ACTIVE_SQL)
+        ),
+    )
+
+    @property
+    def payload_data(self):
+        try:
+            return json.loads(self.payload or "{}")
+        except ValueError:
+            return {}
+
+
+class ChangeLog(db.Model):
+    """Журнал изменений каталога для дельта-синхронизации (/api/v1/changes)."""
+
+    __tablename__ = "change_log"
+
+    id = db.Column(db.Integer, primary_key=True)  # он же токен синхронизации
+    entity = db.Column(db.String(20), nullable=False)  # streets / pavilions / ads
+    entity_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(10), nullable=False)  # upsert / delete
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (db.Index("ix_change_log_entity", "entity", "entity_id"),)
+
+
+class AdViewDay(db.Model):
+    """Просмотры объявления за сутки (UTC) — для графиков динамики."""
+
+    __tablename__ = "ad_view_days"
+
+    ad_id = db.Column(
+        db.Integer,
+        db.ForeignKey("ads.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    day = db.Column(db.Date, primary_key=True)
+    views = db.Column(db.Integer, nullable=False, default=0)
+
+
+class DailyStat(db.Model):
+    """Суточная сводка для дашборда: значение метрики за день (UTC).
+
+    dim — разрез метрики (вид заявки, «вид:статус»), для метрик без разреза "".
+    """
+
+    __tablename__ = "daily_stats"
+
+    day = db.Column(db.Date, primary_key=True)
+    metric = db.Column(db.String(40), primary_key=True)
+    dim = db.Column(db.String(40), primary_key=True, default="")
+    value = db.Column(db.Float, nullable=False, default=0)
+
+
+class RollupWatermark(db.Model):
+    """До какого дня включительно сводки посчитаны окончательно."""
+
+    __tablename__ = "rollup_watermarks"
+
+    name = db.Column(db.String(40), primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+
+
+class MaintenanceRun(db.Model):
+    """Запуск задачи обслуживания базы; cursor — где остановился, если не успел."""
+
+    __tablename__ = "maintenance_runs"
+
+    id = db.Column(db.Integer, primary_key=True)
+    task = db.Column(db.String(40), nullable=False, index=True)
+    # running / ok / problems / partial / skipped / failed
+    status = db.Column(db.String(20), nullable=False, default="running")
+    summary = db.Column(db.String(300), nullable=True)
+    details = db.Column(db.Text, nullable=True)  # JSON
+    cursor = db.Column(db.Text, nullable=True)  # JSON
+    started_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    duration = db.Column(db.Float, nullable=True)
+
+
+class ChangeLogCompaction(db.Model):
+    """Запуск сжатия журнала; horizon — старший удалённый токен."""
+
+    __tablename__ = "change_log_compactions"
+
+    id = db.Column(db.Integer, primary_key=True)
+    horizon = db.Column(db.Integer, nullable=False, default=0)
+    removed = db.Column(db.Integer, nullable=False, default=0)
+    ran_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
 
 # ===== СОЗДАНИЕ ТАБЛИЦ И МИГРАЦИЯ =====
@@ -245,6 +601,448 @@ with app.app_context():
 
         db.session.commit()
 
+    # мягкое удаление
+    for table_name in ("users", "pavilions", "ads"):
+        cols = [c["name"] for c in insp.get_columns(table_name)]
+        if "deleted_at" not in cols:
+            db.session.execute(
+                text(f"ALTER TABLE {table_name} ADD COLUMN deleted_at DATETIME")
+            )
+
+    cols = [c["name"] for c in insp.get_columns("users")]
+    if "created_at" not in cols:
+        db.session.execute(text("ALTER TABLE users ADD COLUMN created_at DATETIME"))
+
+    # одна активная задача на unique_key: дубли, поставленные до уникального
+    # индекса, отменяем, иначе индекс не создастся
+    if "ux_jobs_active_key" not in {i["name"] for i in insp.get_indexes("jobs")}:
+        db.session.execute(
+            text(
+                "UPDATE jobs SET status = 'cancelled', finished_at = CURRENT_TIMESTAMP, "
+                "last_error = 'дубль по unique_key' "
+                f"WHERE unique_key IS NOT NULL AND {JOB_ACTIVE_SQL} "
+                "AND id > (SELECT MIN(d.id) FROM jobs d WHERE d.unique_key = jobs.unique_key "
+                f"         AND d.{JOB_ACTIVE_SQL})"
+            )
+        )
+        db.session.commit()
+        for index in Job.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
+
+    # дата и просмотры объявлений
+    cols = [c["name"] for c in insp.get_columns("ads")]
+    if "created_at" not in cols:
+        db.session.execute(text("ALTER TABLE ads ADD COLUMN created_at DATETIME"))
+    if "views" not in cols:
+        db.session.execute(
+            text("ALTER TABLE ads ADD COLUMN views INTEGER NOT NULL DEFAULT 0")
+        )
+    db.session.commit()
+
+
+def _fk_signature(fks):
+    return {
+        (
+            tuple(fk["constrained_columns"]),
+            fk["referred_table"],
+            (fk.get("options") or {}).get("ondelete", "").upper() or None,
+        )
+        for fk in fks
+    }
+
+
+def _model_fk_signature(table):
+    return {
+        (
+            tuple(c.name for c in fk.columns),
+            fk.referred_table.name,
+            fk.ondelete.upper() if fk.ondelete else None,
+        )
+        for fk in table.foreign_key_constraints
+    }
+
+
+def _lacks_autoincrement(table):
+    if not table.dialect_options["sqlite"]["autoincrement"]:
+        return False
+    sql = db.session.execute(
+        text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+        {"name": table.name},
+    ).scalar()
+    return "AUTOINCREMENT" not in (sql or "").upper()
+
+
+def migrate_fk_cascades():
+    """Пересоздаёт таблицы, у которых внешние ключи без ON DELETE из моделей
+    или нет AUTOINCREMENT, который модель требует.
+
+    ALTER TABLE в SQLite не умеет ни того, ни другого, поэтому делаем
+    стандартную процедуру: новая таблица → копия данных → DROP → RENAME.
+    Колонки, которых нет в модели, переносятся как есть.
+    """
+    insp = inspect(db.engine)
+    existing = set(insp.get_table_names())
+
+    to_rebuild = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing:
+            continue
+        if (
+            _fk_signature(insp.get_foreign_keys(table.name)) != _model_fk_signature(table)
+            or _lacks_autoincrement(table)
+        ):
+            to_rebuild.append(table)
+    db.session.commit()
+
+    if not to_rebuild:
+        return
+
+    # копия схемы, чтобы у новой таблицы резолвились внешние ключи
+    scratch = MetaData()
+    for table in db.metadata.sorted_tables:
+        table.to_metadata(scratch)
+
+    # колонки читаем заранее: инспектор ходит через другое соединение, и на
+    # большой таблице оно упрётся в блокировку записи, которую держит conn
+    columns = {table.name: insp.get_columns(table.name) for table in to_rebuild}
+
+    with db.engine.connect() as conn:
+        # вне транзакции, иначе PRAGMA игнорируется
+        conn.exec_driver_sql("PRAGMA foreign_keys=OFF")
+        try:
+            for table in to_rebuild:
+                db_cols = columns[table.name]
+                tmp_name = f"{table.name}__new"
+                tmp = table.to_metadata(scratch, name=tmp_name)
+                # индексы создаём после переименования, чтобы не было конфликта имён
+                tmp.indexes.clear()
+                for col in db_cols:
+                    if col["name"] not in tmp.c:
+                        tmp.append_column(Column(col["name"], col["type"], nullable=True))
+
+                common = ", ".join(
+                    f'"{c["name"]}"' for c in db_cols if c["name"] in tmp.c
+                )
+                conn.exec_driver_sql(f'DROP TABLE IF EXISTS "{tmp_name}"')
+                conn.execute(CreateTable(tmp))
+                conn.exec_driver_sql(
+                    f'INSERT INTO "{tmp_name}" ({common}) '
+                    f'SELECT {common} FROM "{table.name}"'
+                )
+                conn.exec_driver_sql(f'DROP TABLE "{table.name}"')
+                conn.exec_driver_sql(f'ALTER TABLE "{tmp_name}" RENAME TO "{table.name}"')
+                for index in table.indexes:
+                    index.create(conn, checkfirst=True)
+            conn.commit()
+        finally:
+            conn.exec_driver_sql("PRAGMA foreign_keys=ON")
+
+
+with app.app_context():
+    migrate_fk_cascades()
+    # индексы, добавленные в модели позже: create_all у готовых таблиц их не создаёт
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
+# ===== АРХИВНЫЕ ТАБЛИЦЫ =====
+# Те же колонки, что у рабочих таблиц, плюс archived_at; без внешних ключей
+# (SQLite не проверяет их между файлами) и с индексами под выборки страниц.
+# Переносит строки задача обслуживания archive (раздел АРХИВ: ПЕРЕНОС).
+
+ARCHIVED_MODELS = {
+    "ad_messages": (AdMessage, ("ad_id", "sender_id", "receiver_id")),
+    "support_messages": (SupportMessage, ("user_id",)),
+    "street_requests": (StreetRequest, ("user_id",)),
+    "ad_requests": (AdRequest, ("user_id",)),
+    "pavilion_requests": (PavilionRequest, ("user_id",)),
+}
+
+archive_metadata = MetaData()
+
+
+def _archive_table(hot, indexed):
+    name = hot.name if ARCHIVE_SCHEMA else f"{hot.name}_archive"
+    table = Table(
+        name,
+        archive_metadata,
+        *(Column(c.name, c.type, primary_key=c.primary_key) for c in hot.columns),
+        Column("archived_at", db.DateTime, nullable=False),
+        schema=ARCHIVE_SCHEMA,
+    )
+    for col in indexed:
+        Index(f"ix_{name}_{col}", table.c[col])
+    return table
+
+
+ARCHIVE_TABLES = {
+    name: _archive_table(model.__table__, indexed)
+    for name, (model, indexed) in ARCHIVED_MODELS.items()
+}
+
+
+def archive_name(table_name):
+    """Имя архивной таблицы для сырого SQL."""
+    table = ARCHIVE_TABLES[table_name]
+    return f"{table.schema}.{table.name}" if table.schema else table.name
+
+
+def on_archive(stmt, model):
+    """Тот же SELECT, но по архивной таблице вместо рабочей."""
+    hot = model.__table__
+    arch = ARCHIVE_TABLES[hot.name]
+
+    def replace(element):
+        if isinstance(element, Column) and getattr(element, "table", None) is hot:
+            return arch.c[element.key]
+        if isinstance(element, Table) and element is not arch and element.name == hot.name:
+            return arch
+        return None
+
+    return replacement_traverse(stmt, {}, replace)
+
+
+def archive_count(model, *where):
+    arch = ARCHIVE_TABLES[model.__tablename__]
+    return db.session.execute(
+        select(db.func.count()).select_from(arch).where(*where)
+    ).scalar()
+
+
+def wants_archive():
+    """Страница показывает архив вместо текущих строк (?archive=1)."""
+    return request.args.get("archive") == "1"
+
+
+def list_source(model, stmt, archive):
+    """SELECT списка, колонка id и колонки для подсчёта статусов — рабочие или архивные."""
+    if archive:
+        arch = ARCHIVE_TABLES[model.__tablename__]
+        return on_archive(stmt, model), arch.c.id, arch.c
+    return stmt, model.id, model
+
+
+def seed_archive_sequences():
+    """Поднимает счётчики id рабочих таблиц до наибольшего id в архиве.
+
+    AUTOINCREMENT помнит только id, выданные самой таблицей; после переноса
+    старой базы или ручной правки sqlite_sequence счётчик может оказаться ниже
+    архива, и новая строка получила бы id архивной.
+    """
+    for name, arch in ARCHIVE_TABLES.items():
+        top = db.session.execute(select(db.func.max(arch.c.id))).scalar()
+        if top is None:
+            continue
+        params = {"name": name, "top": top}
+        seq = db.session.execute(
+            text("SELECT seq FROM sqlite_sequence WHERE name = :name"), params
+        ).scalar()
+        if seq is None:
+            db.session.execute(
+                text("INSERT INTO sqlite_sequence (name, seq) VALUES (:name, :top)"), params
+            )
+        elif seq < top:
+            db.session.execute(
+                text("UPDATE sqlite_sequence SET seq = :top WHERE name = :name"), params
+            )
+    db.session.commit()
+
+
+with app.app_context():
+    archive_metadata.create_all(db.engine)
+    seed_archive_sequences()
+
+
+# ===== СТРОКИ ДЛЯ СПИСКОВ =====
+# Списки рисуются из кортежей с нужными колонками, а не из ORM-объектов:
+# без паролей и длинных текстов и без подгрузки связей на каждую строку.
+
+class StreetCard(namedtuple("StreetCard", "id name code pavilions_count")):
+    __slots__ = ()
+    meta = Street.meta
+
+
+STREET_CARDS = select(
+    Street.id,
+    Street.name,
+    Street.code,
+    select(db.func.count(Pavilion.id))
+    .where(Pavilion.street_id == Street.id, Pavilion.deleted_at.is_(None))
+    .scalar_subquery(),
+).order_by(Street.id)
+
+UserRow = namedtuple("UserRow", "id username full_name email role deleted_at")
+USER_ROWS = select(
+    User.id, User.username, User.full_name, User.email, User.role, User.deleted_at
+)
+
+SupportRow = namedtuple(
+    "SupportRow", "id subject text status admin_reply created_at username email"
+)
+SUPPORT_ROWS = (
+    select(
+        SupportMessage.id,
+        SupportMessage.subject,
+        SupportMessage.text,
+        SupportMessage.status,
+        SupportMessage.admin_reply,
+        SupportMessage.created_at,
+        User.username,
+        User.email,
+    )
+    .select_from(SupportMessage)
+    .outerjoin(User, User.id == SupportMessage.user_id)
+)
+
+StreetRequestRow = namedtuple(
+    "StreetRequestRow", "id status created_at username street_name street_code pavilion_title"
+)
+STREET_REQUEST_ROWS = (
+    select(
+        StreetRequest.id,
+        StreetRequest.status,
+        StreetRequest.created_at,
+        User.username,
+        StreetRequest.street_name,
+        StreetRequest.street_code,
+        StreetRequest.pavilion_title,
+    )
+    .select_from(StreetRequest)
+    .outerjoin(User, User.id == StreetRequest.user_id)
+)
+
+AdRequestRow = namedtuple(
+    "AdRequestRow", "id status created_at username pavilion_title street_name title"
+)
+AD_REQUEST_ROWS = (
+    select(
+        AdRequest.id,
+        AdRequest.status,
+        AdRequest.created_at,
+        User.username,
+        Pavilion.title.label("pavilion_title"),
+        Street.name,
+        AdRequest.title,
+    )
+    .select_from(AdRequest)
+    .outerjoin(User, User.id == AdRequest.user_id)
+    .outerjoin(Pavilion, Pavilion.id == AdRequest.pavilion_id)
+    .outerjoin(Street, Street.id == Pavilion.street_id)
+)
+
+PavilionRequestRow = namedtuple(
+    "PavilionRequestRow", "id status created_at username street_name pavilion_title ad_title"
+)
+PAVILION_REQUEST_ROWS = (
+    select(
+        PavilionRequest.id,
+        PavilionRequest.status,
+        PavilionRequest.created_at,
+        User.username,
+        Street.name,
+        PavilionRequest.pavilion_title,
+        PavilionRequest.ad_title,
+    )
+    .select_from(PavilionRequest)
+    .outerjoin(User, User.id == PavilionRequest.user_id)
+    .outerjoin(Street, Street.id == PavilionRequest.street_id)
+)
+
+# имя мастера как в Ad.master_display_name
+MASTER_NAME = db.func.coalesce(
+    User.username, db.func.nullif(Ad.author_name, ""), "Мастер"
+).label("master_name")
+
+AdCard = namedtuple("AdCard", "id title master_name pavilion_id pavilion_title")
+AD_CARDS = (
+    select(Ad.id, Ad.title, MASTER_NAME, Ad.pavilion_id, Pavilion.title.label("pavilion_title"))
+    .select_from(Ad)
+    .join(Pavilion, Pavilion.id == Ad.pavilion_id)
+    .outerjoin(User, User.id == Ad.master_id)
+    .where(Ad.deleted_at.is_(None))
+)
+
+AdListRow = namedtuple("AdListRow", "id title text master_name master_email")
+AD_LIST_ROWS = (
+    select(Ad.id, Ad.title, Ad.text, MASTER_NAME, User.email)
+    .select_from(Ad)
+    .outerjoin(User, User.id == Ad.master_id)
+    .where(Ad.deleted_at.is_(None))
+)
+
+PavilionCard = namedtuple("PavilionCard", "id title ads_count")
+PAVILION_CARDS = select(
+    Pavilion.id,
+    Pavilion.title,
+    select(db.func.count(Ad.id))
+    .where(Ad.pavilion_id == Pavilion.id, Ad.deleted_at.is_(None))
+    .scalar_subquery(),
+).where(Pavilion.deleted_at.is_(None))
+
+ThreadRow = namedtuple(
+    "ThreadRow", "ad_id ad_title pavilion_title peer_id peer_name unread_count last_time"
+)
+
+# диалоги мастера: одна строка на пару (объявление, клиент)
+MASTER_THREADS_SQL = """
+WITH t AS (
+    SELECT m.ad_id AS ad_id,
+           CASE WHEN m.sender_id = :uid THEN m.receiver_id ELSE m.sender_id END AS peer_id,
+           SUM(CASE WHEN m.receiver_id = :uid AND m.is_read = 0 THEN 1 ELSE 0 END) AS unread_count,
+           MAX(m.created_at) AS last_time
+    FROM ad_messages m
+    JOIN ads a ON a.id = m.ad_id
+    WHERE a.master_id = :uid AND a.deleted_at IS NULL
+      AND ((m.sender_id = :uid AND m.receiver_id != :uid)
+           OR (m.receiver_id = :uid AND m.sender_id != :uid))
+    GROUP BY 1, 2
+)
+SELECT t.ad_id, a.title, p.title, t.peer_id,
+       COALESCE(u.username, 'ID ' || t.peer_id), t.unread_count, t.last_time
+FROM t
+JOIN ads a ON a.id = t.ad_id
+LEFT JOIN pavilions p ON p.id = a.pavilion_id
+LEFT JOIN users u ON u.id = t.peer_id
+ORDER BY t.last_time DESC
+"""
+
+# диалоги пользователя: одна строка на пару (объявление, мастер объявления)
+USER_THREADS_SQL = """
+WITH t AS (
+    SELECT m.ad_id AS ad_id,
+           SUM(CASE WHEN m.receiver_id = :uid AND m.is_read = 0 THEN 1 ELSE 0 END) AS unread_count,
+           MAX(m.created_at) AS last_time
+    FROM ad_messages m
+    WHERE m.sender_id = :uid OR m.receiver_id = :uid
+    GROUP BY 1
+)
+SELECT t.ad_id, a.title, p.title, a.master_id,
+       COALESCE(u.username, 'ID ' || a.master_id), t.unread_count, t.last_time
+FROM t
+JOIN ads a ON a.id = t.ad_id AND a.deleted_at IS NULL AND a.master_id IS NOT NULL
+LEFT JOIN pavilions p ON p.id = a.pavilion_id
+LEFT JOIN users u ON u.id = a.master_id
+ORDER BY t.last_time DESC
+"""
+
+
+# MAX() в SQLite теряет тип колонки — возвращаем last_time как datetime
+MASTER_THREADS = text(MASTER_THREADS_SQL).columns(last_time=db.DateTime)
+USER_THREADS = text(USER_THREADS_SQL).columns(last_time=db.DateTime)
+
+# те же диалоги, но по сообщениям, перенесённым в архив
+MASTER_THREADS_ARCHIVE = text(
+    MASTER_THREADS_SQL.replace("FROM ad_messages m", f"FROM {archive_name('ad_messages')} m")
+).columns(last_time=db.DateTime)
+USER_THREADS_ARCHIVE = text(
+    USER_THREADS_SQL.replace("FROM ad_messages m", f"FROM {archive_name('ad_messages')} m")
+).columns(last_time=db.DateTime)
+
+
+def fetch_rows(dto, stmt, params=None):
+    return [dto._make(row) for row in db.session.execute(stmt, params or {})]
+
 
 # ===== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ =====
 
@@ -253,59 +1051,45 @@ def get_student_info():
     return "Филатова Виктория", "ФБИ-34"
 
 
-def recalc_unread_total():
-    """Счётчик непрочитанных сообщений по объявлениям."""
+def current_user():
+    """Пользователь из сессии; из БД грузится не больше одного раза за запрос."""
     if "user_id" not in session:
-        session["unread_total"] = 0
-        return
+        return None
+    if "current_user" not in g:
+        user = db.session.get(User, session["user_id"])
+        if user is not None and user.deleted_at is not None:
+            user = None
+        g.current_user = user
+    return g.current_user
+
 
+def count_unread_messages():
+    """Непрочитанные сообщения по объявлениям."""
     user_id = session["user_id"]
     role = session.get("user_role")
 
     # мастер
     if role == "master":
-        ads = Ad.query.filter_by(master_id=user_id).all()
-        if not ads:
-            session["unread_total"] = 0
-            return
-
-        ad_ids = [a.id for a in ads]
-
-        unread_total = AdMessage.query.filter(
-            AdMessage.ad_id.in_(ad_ids),
+        return AdMessage.query.filter(
+            AdMessage.ad_id.in_(select(Ad.id).where(Ad.master_id == user_id)),
             AdMessage.receiver_id == user_id,
             AdMessage.is_read.is_(False),
         ).count()
-        session["unread_total"] = unread_total
-        return
 
     # обычный пользователь
-    unread_total = AdMessage.query.filter_by(
-        receiver_id=user_id,
-        is_read=False,
-    ).count()
-    session["unread_total"] = unread_total
-
-
-def recalc_support_badge():
-    """Счётчики по поддержке."""
-    if "user_id" not in session:
-        session["support_unread"] = 0
-        session["admin_support_new"] = 0
-        return
+    if role == "user":
+        return AdMessage.query.filter_by(
+            receiver_id=user_id,
+            is_read=False,
+        ).count()
 
-    role = session.get("user_role")
+    return 0
 
-    # админ
-    if role == "admin":
-        session["support_unread"] = 0
-        session["admin_support_new"] = SupportMessage.query.filter_by(
-            status="new"
-        ).count()
-        return
 
-    # пользователь / мастер
-    user_id = session["user_id"]
+def count_support_unread():
+    """Новые ответы поддержки с последнего захода на страницу поддержки."""
+    if session.get("user_role") == "admin":
+        return 0
 
     last_seen_str = session.get("support_seen_at")
     last_seen = None
@@ -315,52 +1099,137 @@ def recalc_support_badge():
         except ValueError:
             last_seen = None
 
-    q = SupportMessage.query.filter_by(user_id=user_id)
+    q = SupportMessage.query.filter_by(user_id=session["user_id"])
     q = q.filter(SupportMessage.admin_reply.isnot(None))
     q = q.filter(SupportMessage.replied_at.isnot(None))
 
     if last_seen is not None:
         q = q.filter(SupportMessage.replied_at > last_seen)
 
-    session["support_unread"] = q.count()
+    return q.count()
+
+
+# счётчики админки одни на всех админов: лежат в общем кэше, отправка заявок
+# и модерация поправляют их на ±n, а раз в ADMIN_COUNTERS_TTL секунд они всё
+# равно пересчитываются из БД — на случай гонки или правки мимо этих путей
+ADMIN_COUNTERS_KEY = "counters:admin"
+ADMIN_COUNTERS_TTL = 60
+
+
+def load_admin_counters():
+    """Ожидающие заявки по видам и новые обращения — одним запросом."""
+
+    def with_status(model, status):
+        return (
+            select(db.func.count())
+            .select_from(model)
+            .where(model.status == status)
+            .scalar_subquery()
+        )
+
+    row = db.session.execute(
+        select(
+            with_status(StreetRequest, "pending").label("street"),
+            with_status(AdRequest, "pending").label("ad"),
+            with_status(PavilionRequest, "pending").label("pavilion"),
+            with_status(SupportMessage, "new").label("support"),
+        )
+    ).one()
+    return row._asdict()
+
+
+def admin_counters():
+    return cache.get_or_set(ADMIN_COUNTERS_KEY, load_admin_counters, ttl=ADMIN_COUNTERS_TTL)
+
+
+def bump_admin_counter(name, delta):
+    """Поправка счётчика после коммита: name — street/ad/pavilion/support."""
+    if delta:
+        cache.update(
+            ADMIN_COUNTERS_KEY,
+            lambda counters: {**counters, name: max(0, counters[name] + delta)},
+        )
 
 
-def recalc_admin_counters():
-    """Счётчики для админа."""
+def count_admin_requests():
     if session.get("user_role") != "admin":
-        session["admin_requests"] = 0
-        session["admin_support_new"] = 0
-        return
+        return 0
+    counters = admin_counters()
+    return counters["ad"] + counters["pavilion"] + counters["street"]
 
-    pending_ads = AdRequest.query.filter_by(status="pending").count()
-    pending_pav = PavilionRequest.query.filter_by(status="pending").count()
-    pending_streets = StreetRequest.query.filter_by(status="pending").count()
 
-    session["admin_requests"] = pending_ads + pending_pav + pending_streets
-    session["admin_support_new"] = SupportMessage.query.filter_by(
-        status="new"
-    ).count()
+def count_admin_support_new():
+    if session.get("user_role") != "admin":
+        return 0
+    return admin_counters()["support"]
+
+
+class HeaderBadges:
+    """Счётчики в шапке: badges.unread_total и т.п. в шаблонах.
+
+    Каждый считается при первом обращении и запоминается до конца запроса,
+    так что редиректы, JSON и страницы без шапки в БД за ними не ходят.
+    """
+
+    loaders = {
+        "unread_total": count_unread_messages,
+        "support_unread": count_support_unread,
+        "admin_requests": count_admin_requests,
+        "admin_support_new": count_admin_support_new,
+    }
+
+    def __init__(self):
+        self._values = {}
+
+    def __getattr__(self, name):
+        try:
+            loader = self.loaders[name]
+        except KeyError:
+            raise AttributeError(name) from None
+        if name not in self._values:
+            self._values[name] = loader() if "user_id" in session else 0
+        return self._values[name]
+
+    def set(self, name, value):
+        """Значение уже посчитано во вьюхе — второй раз не считаем."""
+        self._values[name] = value
+
+
+def header_badges():
+    if "header_badges" not in g:
+        g.header_badges = HeaderBadges()
+    return g.header_badges
+
+
+@app.context_processor
+def inject_header_badges():
+    return {"badges": header_badges()}
+
+
+# запросы, которым сессия не нужна: файлы, API и заранее отрисованные страницы
+# (те показывают шапку по данным из сессии как есть)
+SESSIONLESS_ENDPOINTS = {"static", "api_v1_list", "api_v1_detail", "api_v1_changes"}
 
 
 @app.before_request
-def auto_update_unread():
-    """Обновление счётчиков перед каждым запросом."""
-    if "user_id" in session:
-        # 🔄 каждый запрос подтягиваем актуальные данные пользователя из БД
-        user = User.query.get(session["user_id"])
-        if user:
-            session["avatar_filename"] = user.avatar_filename
-            session["full_name"] = user.full_name
-
-        recalc_unread_total()
-        recalc_support_badge()
-        recalc_admin_counters()
-    else:
-        session["unread_total"] = 0
-        session["support_unread"] = 0
-        session["admin_support_new"] = 0
-        session["admin_requests"] = 0
+def check_current_user():
+    """Выход, если аккаунт удалили; имя и аватар для шапки — из той же строки."""
+    if request.endpoint in SESSIONLESS_ENDPOINTS or request.endpoint in STATIC_PAGES:
+        return
+    if "user_id" not in session:
+        return
 
+    user = current_user()
+    if user is None:
+        # аккаунт удалён (или удаляется) — выходим
+        session.clear()
+        return
+
+    # пишем только изменения, чтобы не выставлять cookie сессии на каждый ответ
+    if session.get("avatar_filename") != user.avatar_filename:
+        session["avatar_filename"] = user.avatar_filename
+    if session.get("full_name") != user.full_name:
+        session["full_name"] = user.full_name
 
 
 def login_required(view_func):
@@ -389,16 +1258,1130 @@ def admin_required(view_func):
     return wrapped
 
 
-# ===== ПОЛЬЗОВАТЕЛЬСКИЕ СТРАНИЦЫ =====
+def get_live_or_404(model, obj_id):
+    """Как get_or_404, но объекты в очереди на удаление тоже дают 404."""
+    obj = model.query.get_or_404(obj_id)
+    if obj.deleted_at is not None:
+        abort(404)
+    return obj
 
 
-@app.route("/")
-def index():
-    if session.get("user_role") == "admin":
-        return redirect(url_for("admin_dashboard"))
+STREAM_BATCH_SIZE = 500
+STREAM_CHUNK_SIZE = 16 * 1024
 
-    streets = Street.query.order_by(Street.id).all()
-    featured_ads = Ad.query.limit(12).all()
+
+def iter_keyset(stmt, id_col, dto, desc=False, batch=STREAM_BATCH_SIZE, after=None):
+    """Строки SELECT пачками по id, сразу в кортежи dto.
+
+    Каждая пачка — отдельный короткий SELECT: открытый курсор SQLite держал бы
+    блокировку чтения всё время, пока медленный клиент качает страницу.
+    after — id, после которого начинать (продолжение прерванного обхода).
+    """
+    last_id = after
+    while True:
+        q = stmt
+        if last_id is not None:
+            q = q.where(id_col < last_id if desc else id_col > last_id)
+        rows = fetch_rows(dto, q.order_by(id_col.desc() if desc else id_col).limit(batch))
+        yield from rows
+        if len(rows) < batch:
+            return
+        last_id = rows[-1].id
+
+
+def stream_page(template_name, **context):
+    """Потоковый рендер: шапка и первые строки уходят сразу, остальное — по мере готовности."""
+    # флеши забираем до отправки заголовков, иначе сессия с ними не сохранится
+    get_flashed_messages()
+    # контекст запроса захватывается здесь и живёт, пока поток не закончится
+    pieces = stream_template(template_name, **context)
+
+    def generate():
+        buf, size = [], 0
+        for piece in pieces:
+            buf.append(piece)
+            size += len(piece)
+            if size >= STREAM_CHUNK_SIZE:
+                yield "".join(buf)
+                buf, size = [], 0
+        if buf:
+            yield "".join(buf)
+
+    return app.response_class(generate(), mimetype="text/html")
+
+
+def count_by_status(model):
+    counts = dict(
+        db.session.execute(
+            select(model.status, db.func.count()).group_by(model.status)
+        ).all()
+    )
+    counts["total"] = sum(counts.values())
+    return counts
+
+
+# ===== ОЧЕРЕДЬ ФОНОВЫХ ЗАДАЧ =====
+
+# воркеры внутри веб-процесса; при отдельном jobs_worker.py можно выключить
+app.config.setdefault("JOBS_IN_PROCESS", True)
+app.config.setdefault("JOB_WORKER_THREADS", 2)
+
+JOB_POLL_INTERVAL = 2  # сек между опросами очереди, если задач нет
+JOB_LOCK_TIMEOUT = 120  # сек без heartbeat — воркер считается упавшим
+JOB_RETRY_BASE = 5  # сек, дальше удваивается с каждой попыткой
+JOB_RETRY_MAX = 3600
+JOB_KEEP_FINISHED_DAYS = 7
+JOB_MISSING_RETRY = 60  # сек: не чаще, если задача не кладёт результат в кэш
+
+JOB_HANDLERS = {}
+PERIODIC_JOBS = {}
+
+
+class JobDeferred(Exception):
+    """Задаче пока нельзя выполняться: вернуть в очередь через delay секунд.
+
+    Попытка при этом не засчитывается.
+    """
+
+    def __init__(self, message, delay):
+        super().__init__(message)
+        self.delay = delay
+
+
+def job_handler(kind, max_attempts=5, priority=0):
+    """Регистрирует функцию-обработчик задач вида kind. Обработчик получает payload."""
+
+    def decorator(func):
+        JOB_HANDLERS[kind] = {
+            "func": func,
+            "max_attempts": max_attempts,
+            "priority": priority,
+        }
+        return func
+
+    return decorator
+
+
+def periodic_job(kind, every_seconds, payload=None, cache_key=None):
+    """Задача kind будет ставиться в очередь раз в every_seconds.
+
+    cache_key — ключ общего кэша с её результатом: если его нет, задача
+    нужна сразу, а не по расписанию.
+    """
+    PERIODIC_JOBS[kind] = {
+        "every": every_seconds,
+        "payload": payload or {},
+        "cache_key": cache_key,
+    }
+
+
+def enqueue_job(kind, payload=None, priority=None, run_at=None, delay=0,
+                unique_key=None, commit=True):
+    """Ставит задачу в очередь. С unique_key дубль не создаётся."""
+    handler = JOB_HANDLERS.get(kind)
+    if handler is None:
+        raise ValueError(f"нет обработчика для задачи {kind!r}")
+
+    def active():
+        return Job.query.filter(
+            Job.unique_key == unique_key, text(JOB_ACTIVE_SQL)
+        ).first()
+
+    if unique_key:
+        existing = active()
+        if existing is not None:
+            return existing
+
+    if run_at is None:
+        run_at = datetime.utcnow() + timedelta(seconds=delay)
+
+    values = {
+        "kind": kind,
+        "payload": json.dumps(payload or {}, ensure_ascii=False),
+        "priority": handler["priority"] if priority is None else priority,
+        "max_attempts": handler["max_attempts"],
+        "run_at": run_at,
+        "unique_key": unique_key,
+        "status": "queued",
+    }
+    if unique_key:
+        # между SELECT выше и вставкой задачу мог поставить другой процесс —
+        # тогда сработает уникальный индекс, и берём его задачу
+        job_id = db.session.execute(
+            sqlite_insert(Job)
+            .values(**values)
+            .on_conflict_do_nothing(
+                index_elements=[Job.unique_key], index_where=text(JOB_ACTIVE_SQL)
+            )
+            .returning(Job.id)
+        ).scalar()
+        if job_id is None:
+            return active()
+        job = db.session.get(Job, job_id)
+    else:
+        job = Job(**values)
+        db.session.add(job)
+    if commit:
+        db.session.commit()
+        wake_job_workers()
+    return job
+
+
+def job_heartbeat(job_id):
+    """Долгие задачи продлевают блокировку, чтобы их не перезапустили."""
+    Job.query.filter_by(id=job_id, status="running").update(
+        {"locked_at": datetime.utcnow()}, synchronize_session=False
+    )
+
+
+def _requeue_stale_jobs():
+    """Задачи упавших воркеров — снова в очередь, если попытки не кончились.
+
+    Задача, которая сама роняет или вешает воркер, иначе повторялась бы вечно.
+    """
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=JOB_LOCK_TIMEOUT)
+    lost = and_(Job.status == "running", Job.locked_at < stale)
+    Job.query.filter(lost, Job.attempts >= Job.max_attempts).update(
+        {
+            "status": "failed",
+            "finished_at": now,
+            "last_error": "воркер пропал, попытки исчерпаны",
+            "locked_by": None,
+            "locked_at": None,
+        },
+        synchronize_session=False,
+    )
+    Job.query.filter(lost).update(
+        {"status": "queued", "locked_by": None, "locked_at": None},
+        synchronize_session=False,
+    )
+    db.session.commit()
+
+
+def _ensure_periodic_jobs():
+    now = datetime.utcnow()
+    for kind, spec in PERIODIC_JOBS.items():
+        key = f"periodic:{kind}"
+        # результата нет в кэше (первый запуск, сброс) — сайт ждёт его сейчас
+        missing = spec["cache_key"] is not None and cache.get(spec["cache_key"]) is None
+        active = Job.query.filter(
+            Job.unique_key == key, Job.status.in_(("queued", "running"))
+        ).first()
+        if active is not None:
+            if missing and active.status == "queued" and active.run_at > now:
+                Job.query.filter_by(id=active.id, status="queued").update(
+                    {"run_at": now}, synchronize_session=False
+                )
+                db.session.commit()
+            continue
+        last = (
+            Job.query.filter(Job.unique_key == key, Job.finished_at.isnot(None))
+            .order_by(Job.finished_at.desc())
+            .first()
+        )
+        run_at = now
+        if last is not None:
+            every = JOB_MISSING_RETRY if missing else spec["every"]
+            run_at = max(run_at, last.finished_at + timedelta(seconds=every))
+        enqueue_job(kind, spec["payload"], run_at=run_at, unique_key=key)
+
+
+def _claim_job(worker_id):
+    """Атомарно забирает самую приоритетную готовую задачу."""
+    now = datetime.utcnow()
+    # дата идёт через тип DateTime, а не через адаптер sqlite3 (устарел в 3.12)
+    row = db.session.execute(
+        text(
+            "UPDATE jobs SET status = 'running', locked_by = :worker, "
+            "locked_at = :now, started_at = :now, attempts = attempts + 1 "
+            "WHERE id = (SELECT id FROM jobs WHERE status = 'queued' AND run_at <= :now "
+            "            ORDER BY priority DESC, run_at, id LIMIT 1) "
+            "AND status = 'queued' "
+            "RETURNING id"
+        ).bindparams(bindparam("now", type_=db.DateTime)),
+        {"worker": worker_id, "now": now},
+    ).first()
+    db.session.commit()
+    if row is None:
+        return None
+    return db.session.get(Job, row[0], populate_existing=True)
+
+
+def run_job(job):
+    """Выполняет задачу; при ошибке — повтор с экспоненциальной паузой."""
+    handler = JOB_HANDLERS.get(job.kind)
+    try:
+        if handler is None:
+            raise RuntimeError(f"нет обработчика для задачи {job.kind!r}")
+        handler["func"](job.payload_data, job_id=job.id)
+    except JobDeferred as e:
+        db.session.rollback()
+        Job.query.filter_by(id=job.id).update(
+            {
+                "status": "queued",
+                "run_at": datetime.utcnow() + timedelta(seconds=e.delay),
+                "attempts": Job.attempts - 1,
+                "last_error": str(e),
+                "locked_by": None,
+                "locked_at": None,
+            },
+            synchronize_session=False,
+        )
+        db.session.commit()
+        return False
+    except Exception as e:
+        db.session.rollback()
+        app.logger.exception("Задача #%s (%s) упала", job.id, job.kind)
+        now = datetime.utcnow()
+        if job.attempts < job.max_attempts and handler is not None:
+            delay = min(JOB_RETRY_BASE * 2 ** (job.attempts - 1), JOB_RETRY_MAX)
+            delay *= random.uniform(0.8, 1.2)
+            values = {"status": "queued", "run_at": now + timedelta(seconds=delay)}
+        else:
+            values = {"status": "failed", "finished_at": now}
+        if values["status"] == "queued" and is_lock_error(e):
+            DB_LOCK_RETRIES.inc(kind=job.kind)
+        values.update({"last_error": repr(e), "locked_by": None, "locked_at": None})
+        Job.query.filter_by(id=job.id).update(values, synchronize_session=False)
+        db.session.commit()
+        return False
+
+    Job.query.filter_by(id=job.id).update(
+        {
+            "status": "done",
+            "finished_at": datetime.utcnow(),
+            "locked_by": None,
+            "locked_at": None,
+        },
+        synchronize_session=False,
+    )
+    db.session.commit()
+    return True
+
+
+def run_pending_jobs(worker_id="inline", limit=None):
+    """Выполняет готовые задачи из очереди; возвращает их количество."""
+    done = 0
+    while limit is None or done < limit:
+        job = _claim_job(worker_id)
+        if job is None:
+            break
+        g.job_kind = job.kind  # для меток метрик SQL
+        try:
+            run_job(job)
+        finally:
+            g.pop("job_kind", None)
+        done += 1
+    return done
+
+
+_jobs_wakeup = threading.Event()
+_job_threads = []
+_job_threads_lock = threading.Lock()
+
+
+def _job_worker_loop(worker_id, maintain):
+    while True:
+        with app.app_context():
+            try:
+                if maintain:
+                    _requeue_stale_jobs()
+                    _ensure_periodic_jobs()
+                run_pending_jobs(worker_id)
+            except Exception:
+                app.logger.exception("Воркер очереди %s: ошибка цикла", worker_id)
+            finally:
+                db.session.remove()
+        _jobs_wakeup.wait(timeout=JOB_POLL_INTERVAL)
+        _jobs_wakeup.clear()
+
+
+def start_job_workers(threads=None):
+    """Запускает потоки-воркеры очереди (один раз на процесс)."""
+    threads = threads or app.config["JOB_WORKER_THREADS"]
+    with _job_threads_lock:
+        _job_threads[:] = [t for t in _job_threads if t.is_alive()]
+        prefix = f"{socket.gethostname()}:{os.getpid()}"
+        while len(_job_threads) < threads:
+            n = len(_job_threads)
+            t = threading.Thread(
+                target=_job_worker_loop,
+                args=(f"{prefix}:{n}", n == 0),
+                name=f"job-worker-{n}",
+                daemon=True,
+            )
+            t.start()
+            _job_threads.append(t)
+
+
+def wake_job_workers():
+    _jobs_wakeup.set()
+
+
+@app.before_request
+def ensure_background_workers():
+    """Воркеры стартуют с первым запросом, а не при импорте (скрипты их не запускают)."""
+    if app.config["JOBS_IN_PROCESS"] and not _job_threads:
+        start_job_workers()
+
+
+@job_handler("cleanup_jobs", max_attempts=1, priority=-10)
+def cleanup_jobs(payload, job_id=None):
+    """Удаляет старые завершённые задачи, чтобы таблица не росла."""
+    border = datetime.utcnow() - timedelta(days=JOB_KEEP_FINISHED_DAYS)
+    Job.query.filter(
+        Job.status.in_(("done", "cancelled")), Job.finished_at < border
+    ).delete(synchronize_session=False)
+    db.session.commit()
+
+
+periodic_job("cleanup_jobs", every_seconds=6 * 3600)
+
+
+# ===== ЖУРНАЛ ИЗМЕНЕНИЙ =====
+
+CHANGE_TRACKED = {Street: "streets", Pavilion: "pavilions", Ad: "ads"}
+
+CHANGELOG_COMPACT_BATCH = 2000
+CHANGELOG_TOMBSTONE_DAYS = 30  # дольше надгробия не храним — клиенту нужна полная синхронизация
+
+
+@event.listens_for(Session, "after_flush")
+def _capture_changes(session, flush_context):
+    """Пишет в журнал всё, что ORM сбросил в базу по улицам, павильонам и объявлениям."""
+    now = datetime.utcnow()
+    rows = []
+
+    for obj in session.new:
+        entity = CHANGE_TRACKED.get(type(obj))
+        if entity:
+            rows.append({"entity": entity, "entity_id": obj.id, "op": "upsert", "created_at": now})
+
+    for obj in session.dirty:
+        entity = CHANGE_TRACKED.get(type(obj))
+        if entity and session.is_modified(obj, include_collections=False):
+            # мягкое удаление для клиентов — то же удаление
+            op = "delete" if getattr(obj, "deleted_at", None) else "upsert"
+            rows.append({"entity": entity, "entity_id": obj.id, "op": op, "created_at": now})
+
+    for obj in session.deleted:
+        entity = CHANGE_TRACKED.get(type(obj))
+        if entity:
+            rows.append({"entity": entity, "entity_id": obj.id, "op": "delete", "created_at": now})
+
+    if rows:
+        session.connection().execute(insert(ChangeLog.__table__), rows)
+
+
+def record_changes(entity, ids, op="upsert"):
+    """Запись в журнал для массовых INSERT/UPDATE, которые идут мимо flush.
+
+    ids — список id или SELECT, возвращающий id.
+    """
+    now = datetime.utcnow()
+    if isinstance(ids, Select):
+        db.session.execute(
+            insert(ChangeLog).from_select(
+                ["entity_id", "entity", "op", "created_at"],
+                ids.add_columns(
+                    db.literal(entity), db.literal(op), db.literal(now, db.DateTime)
+                ),
+            )
+        )
+        return
+
+    ids = list(ids)
+    if ids:
+        db.session.execute(
+            insert(ChangeLog),
+            [{"entity": entity, "entity_id": i, "op": op, "created_at": now} for i in ids],
+        )
+
+
+def change_log_horizon():
+    """Токены не старше горизонта ещё валидны, более старые — нет."""
+    return db.session.execute(
+        select(db.func.coalesce(db.func.max(ChangeLogCompaction.horizon), 0))
+    ).scalar()
+
+
+@job_handler("compact_change_log", max_attempts=1, priority=-10)
+def compact_change_log(payload, job_id=None):
+    """Оставляет по одной (последней) записи на объект и убирает старые надгробия."""
+    removed = 0
+
+    # дубли: более старые записи того же объекта клиенту уже не нужны
+    dedup = text(
+        "DELETE FROM change_log WHERE id IN ("
+        "SELECT c.id FROM change_log c WHERE EXISTS ("
+        "SELECT 1 FROM change_log n WHERE n.entity = c.entity "
+        "AND n.entity_id = c.entity_id AND n.id > c.id) LIMIT :batch)"
+    )
+    while True:
+        deleted = db.session.execute(dedup, {"batch": CHANGELOG_COMPACT_BATCH}).rowcount
+        removed += deleted
+        if job_id is not None:
+            job_heartbeat(job_id)
+        db.session.commit()
+        if deleted < CHANGELOG_COMPACT_BATCH:
+            break
+
+    # старые надгробия: после их удаления токены до horizon становятся невалидными
+    cutoff = datetime.utcnow() - timedelta(days=CHANGELOG_TOMBSTONE_DAYS)
+    horizon = db.session.execute(
+        select(db.func.max(ChangeLog.id)).where(
+            ChangeLog.op == "delete", ChangeLog.created_at < cutoff
+        )
+    ).scalar()
+    if horizon:
+        removed += ChangeLog.query.filter(
+            ChangeLog.op == "delete", ChangeLog.id <= horizon
+        ).delete(synchronize_session=False)
+
+    db.session.add(ChangeLogCompaction(horizon=horizon or change_log_horizon(), removed=removed))
+    db.session.commit()
+
+
+periodic_job("compact_change_log", every_seconds=24 * 3600)
+
+
+# ===== ФОНОВОЕ УДАЛЕНИЕ =====
+
+DELETE_BATCH_SIZE = 500
+DELETE_BATCH_PAUSE = 0.05  # сек между пачками, чтобы не держать блокировку записи
+
+
+def deletion_steps(entity):
+    """Шаги удаления в порядке зависимостей: (таблица, условие WHERE).
+
+    У таблиц с архивом перед рабочей таблицей чистится архивная по тому же условию.
+    """
+    steps = []
+    for table, cond in _live_deletion_steps(entity):
+        if table in ARCHIVE_TABLES:
+            steps.append((archive_name(table), cond))
+        steps.append((table, cond))
+    return steps
+
+
+def _live_deletion_steps(entity):
+    if entity == "user":
+        return [
+            (
+                "ad_messages",
+                "sender_id = :id OR receiver_id = :id "
+                "OR ad_id IN (SELECT id FROM ads WHERE master_id = :id)",
+            ),
+            ("ad_view_days", "ad_id IN (SELECT id FROM ads WHERE master_id = :id)"),
+            ("support_messages", "user_id = :id"),
+            ("street_requests", "user_id = :id"),
+            ("ad_requests", "user_id = :id"),
+            ("pavilion_requests", "user_id = :id"),
+            ("ads", "master_id = :id"),
+            ("users", "id = :id"),
+        ]
+    if entity == "pavilion":
+        return [
+            ("ad_messages", "ad_id IN (SELECT id FROM ads WHERE pavilion_id = :id)"),
+            ("ad_view_days", "ad_id IN (SELECT id FROM ads WHERE pavilion_id = :id)"),
+            ("ad_requests", "pavilion_id = :id"),
+            ("ads", "pavilion_id = :id"),
+            ("pavilions", "id = :id"),
+        ]
+    if entity == "pavilion_ads":
+        # только объявления, помеченные при очистке; новые не трогаем
+        return [
+            (
+                "ad_messages",
+                "ad_id IN (SELECT id FROM ads "
+                "WHERE pavilion_id = :id AND deleted_at IS NOT NULL)",
+            ),
+            (
+                "ad_view_days",
+                "ad_id IN (SELECT id FROM ads "
+                "WHERE pavilion_id = :id AND deleted_at IS NOT NULL)",
+            ),
+            ("ads", "pavilion_id = :id AND deleted_at IS NOT NULL"),
+        ]
+    if entity == "ad":
+        return [
+            ("ad_messages", "ad_id = :id"),
+            ("ad_view_days", "ad_id = :id"),
+            ("ads", "id = :id"),
+        ]
+    raise ValueError(f"неизвестный тип удаления: {entity}")
+
+
+def schedule_deletion(entity, entity_id, label=None):
+    """Мягко помечает объект удалённым и ставит задачу на фоновую очистку."""
+    now = datetime.utcnow()
+
+    if entity == "user":
+        User.query.filter_by(id=entity_id).update(
+            {"deleted_at": now}, synchronize_session=False
+        )
+        Ad.query.filter_by(master_id=entity_id).update(
+            {"deleted_at": now}, synchronize_session=False
+        )
+        record_changes("ads", select(Ad.id).where(Ad.master_id == entity_id), op="delete")
+    elif entity == "pavilion":
+        Pavilion.query.filter_by(id=entity_id).update(
+            {"deleted_at": now}, synchronize_session=False
+        )
+        Ad.query.filter_by(pavilion_id=entity_id).update(
+            {"deleted_at": now}, synchronize_session=False
+        )
+        record_changes("pavilions", [entity_id], op="delete")
+        record_changes("ads", select(Ad.id).where(Ad.pavilion_id == entity_id), op="delete")
+    elif entity == "pavilion_ads":
+        Ad.query.filter_by(pavilion_id=entity_id).update(
+            {"deleted_at": now}, synchronize_session=False
+        )
+        record_changes("ads", select(Ad.id).where(Ad.pavilion_id == entity_id), op="delete")
+    elif entity == "ad":
+        Ad.query.filter_by(id=entity_id).update(
+            {"deleted_at": now}, synchronize_session=False
+        )
+        record_changes("ads", [entity_id], op="delete")
+    else:
+        raise ValueError(f"неизвестный тип удаления: {entity}")
+
+    task = DeletionTask(
+        entity=entity,
+        entity_id=entity_id,
+        label=label,
+        status="pending",
+        created_at=now,
+        updated_at=now,
+    )
+    db.session.add(task)
+    db.session.flush()
+
+    enqueue_job("deletion", {"task_id": task.id}, commit=False)
+    db.session.commit()
+    wake_job_workers()
+    return task
+
+
+def run_deletion_task(task, job_id=None):
+    """Удаляет зависимые строки пачками, каждая пачка — отдельная короткая транзакция."""
+    params = {"id": task.entity_id}
+    steps = deletion_steps(task.entity)
+
+    if not task.total_rows:
+        total = 0
+        for table, cond in steps:
+            total += db.session.execute(
+                text(f"SELECT COUNT(*) FROM {table} WHERE {cond}"), params
+            ).scalar()
+        task.total_rows = total
+        db.session.commit()
+
+    for table, cond in steps:
+        stmt = text(
+            f"DELETE FROM {table} WHERE rowid IN "
+            f"(SELECT rowid FROM {table} WHERE {cond} LIMIT :batch)"
+        )
+        while True:
+            deleted = db.session.execute(
+                stmt, {**params, "batch": DELETE_BATCH_SIZE}
+            ).rowcount
+            task.done_rows += deleted
+            task.updated_at = datetime.utcnow()
+            if job_id is not None:
+                job_heartbeat(job_id)
+            db.session.commit()
+
+            if deleted < DELETE_BATCH_SIZE:
+                break
+            time.sleep(DELETE_BATCH_PAUSE)
+
+    task.status = "done"
+    task.finished_at = datetime.utcnow()
+    task.updated_at = task.finished_at
+    db.session.commit()
+
+
+@job_handler("deletion", max_attempts=5, priority=5)
+def deletion_job(payload, job_id=None):
+    task = db.session.get(DeletionTask, payload["task_id"])
+    if task is None or task.status == "done":
+        return
+
+    task.status = "running"
+    task.updated_at = datetime.utcnow()
+    db.session.commit()
+    try:
+        # пачки идемпотентны, поэтому повтор просто продолжит с места сбоя
+        run_deletion_task(task, job_id=job_id)
+        if task.entity in ("user", "pavilion"):
+            # вместе с ними ушли заявки и обращения — счётчики админки пересчитать
+            cache.invalidate("counters")
+    except Exception as e:
+        db.session.rollback()
+        DeletionTask.query.filter_by(id=task.id).update(
+            {"status": "failed", "error": str(e), "updated_at": datetime.utcnow()},
+            synchronize_session=False,
+        )
+        db.session.commit()
+        raise
+
+
+# ===== ПОДБОРКА ОБЪЯВЛЕНИЙ НА ГЛАВНОЙ =====
+# Рейтинг считается фоновой задачей и лежит в общем кэше списком id.
+# Главная берёт из него FEATURED_COUNT штук: первые FEATURED_PINNED всегда,
+# остальные — случайно из остатка пула, так что подборка меняется от показа
+# к показу без ORDER BY RANDOM() по всей таблице.
+
+FEATURED_KEY = "featured:ranking"
+FEATURED_COUNT = 12
+FEATURED_PINNED = 4
+FEATURED_POOL_SIZE = 60
+FEATURED_RANK_INTERVAL = 10 * 60
+FEATURED_ACTIVITY_DAYS = 14
+
+# вклад составляющих в оценку объявления
+FEATURED_WEIGHTS = {"recency": 3.0, "messages": 1.5, "views": 1.0}
+FEATURED_HALF_LIFE_DAYS = 7  # через столько дней свежесть падает вдвое
+# каждое следующее объявление из того же павильона идёт с таким множителем
+FEATURED_PAVILION_PENALTY = 0.5
+
+
+def featured_score(created_at, messages, views, now):
+    if created_at is None:
+        recency = 0.0
+    else:
+        age_days = max((now - created_at).total_seconds(), 0) / 86400
+        recency = 0.5 ** (age_days / FEATURED_HALF_LIFE_DAYS)
+    return (
+        FEATURED_WEIGHTS["recency"] * recency
+        + FEATURED_WEIGHTS["messages"] * math.log1p(messages)
+        + FEATURED_WEIGHTS["views"] * math.log1p(views)
+    )
+
+
+def diversify(scored, size):
+    """Жадный отбор: лучшее объявление, но с поправкой на повторы павильона.
+
+    scored — [(оценка, id объявления, id павильона)].
+    """
+    by_pavilion = {}
+    for score, ad_id, pavilion_id in sorted(scored, reverse=True):
+        by_pavilion.setdefault(pavilion_id, []).append((score, ad_id))
+
+    heap = [(-items[0][0], pavilion_id, 0) for pavilion_id, items in by_pavilion.items()]
+    heapq.heapify(heap)
+    ranked = []
+    while heap and len(ranked) < size:
+        _, pavilion_id, pos = heapq.heappop(heap)
+        items = by_pavilion[pavilion_id]
+        ranked.append(items[pos][1])
+        if pos + 1 < len(items):
+            penalty = FEATURED_PAVILION_PENALTY ** (pos + 1)
+            heapq.heappush(heap, (-items[pos + 1][0] * penalty, pavilion_id, pos + 1))
+    return ranked
+
+
+@job_handler("rank_featured_ads", max_attempts=1, priority=-5)
+def rank_featured_ads(payload, job_id=None):
+    """Пересчёт подборки: свежесть, переписка за FEATURED_ACTIVITY_DAYS, просмотры."""
+    now = datetime.utcnow()
+    since = now - timedelta(days=FEATURED_ACTIVITY_DAYS)
+    messages = (
+        select(AdMessage.ad_id, db.func.count().label("messages"))
+        .where(AdMessage.created_at >= since)
+        .group_by(AdMessage.ad_id)
+        .subquery()
+    )
+    rows = db.session.execute(
+        select(
+            Ad.id,
+            Ad.pavilion_id,
+            Ad.created_at,
+            Ad.views,
+            db.func.coalesce(messages.c.messages, 0),
+        )
+        .select_from(Ad)
+        .join(Pavilion, Pavilion.id == Ad.pavilion_id)
+        .outerjoin(messages, messages.c.ad_id == Ad.id)
+        .where(Ad.deleted_at.is_(None), Pavilion.deleted_at.is_(None))
+    )
+    scored = [
+        (featured_score(created_at, msg_count, views, now), ad_id, pavilion_id)
+        for ad_id, pavilion_id, created_at, views, msg_count in rows
+    ]
+    ranking = diversify(scored, FEATURED_POOL_SIZE)
+    # живёт дольше интервала: если задача разок не успеет, главная не опустеет
+    cache.set(FEATURED_KEY, ranking, ttl=FEATURED_RANK_INTERVAL * 6)
+    return ranking
+
+
+periodic_job("rank_featured_ads", every_seconds=FEATURED_RANK_INTERVAL, cache_key=FEATURED_KEY)
+
+
+def featured_ad_cards():
+    # пустой список — тоже рейтинг (объявлений нет), None — его ещё не считали
+    ranking = cache.get(FEATURED_KEY)
+    if ranking is None:
+        # первый запуск или сброс кэша: свежие, пока задача считает. Сама главная
+        # в базу не пишет — воркер видит пустой ключ и запускает пересчёт сразу
+        wake_job_workers()
+        return fetch_rows(AdCard, AD_CARDS.order_by(Ad.id.desc()).limit(FEATURED_COUNT))
+
+    pinned = ranking[:FEATURED_PINNED]
+    rest = ranking[FEATURED_PINNED:]
+    picked = random.sample(rest, min(len(rest), FEATURED_COUNT - len(pinned)))
+    # случайный выбор, но в порядке рейтинга
+    position = {ad_id: i for i, ad_id in enumerate(ranking)}
+    ids = pinned + sorted(picked, key=position.get)
+
+    cards = {card.id: card for card in fetch_rows(AdCard, AD_CARDS.where(Ad.id.in_(ids)))}
+    return [cards[ad_id] for ad_id in ids if ad_id in cards]
+
+
+# ===== СЧЁТЧИК ПРОСМОТРОВ =====
+# Просмотр не пишет в БД: воркер копит счётчики в памяти, а фоновый поток раз
+# в VIEWS_FLUSH_INTERVAL секунд сбрасывает их одним UPDATE по ads и одним
+# upsert в суточную таблицу. При падении процесса теряется не больше интервала.
+
+VIEWS_FLUSH_INTERVAL = 10
+# до SQLite 3.32 в одном запросе не больше 999 параметров; на объявление их по
+# три: в UPDATE — id и прибавка в CASE и id в IN (плюс один на ELSE), в upsert
+# суточной таблицы — ad_id, day и views
+SQLITE_MAX_VARIABLES = 999
+VIEWS_BINDS_PER_AD = 3
+VIEWS_FLUSH_CHUNK = (SQLITE_MAX_VARIABLES - 1) // VIEWS_BINDS_PER_AD
+
+
+class ViewBuffer:
+    def __init__(self, interval):
+        self.interval = interval
+        self._counts = Counter()  # (ad_id, день) -> просмотров
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def add(self, ad_id):
+        self._ensure_flusher()
+        with self._lock:
+            self._counts[(ad_id, datetime.utcnow().date())] += 1
+
+    @property
+    def running(self):
+        """Поток сброса запущен в этом процессе."""
+        return self._pid == os.getpid()
+
+    def _ensure_flusher(self):
+        if self.running:
+            return
+        with self._lock:
+            if self.running:
+                return
+            # после fork счётчики родителя сбросит сам родитель
+            self._counts = Counter()
+            self._pid = os.getpid()
+            threading.Thread(target=self._loop, name="view-flusher", daemon=True).start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            with app.app_context():
+                try:
+                    self.flush()
+                except Exception:
+                    app.logger.exception("Сброс счётчиков просмотров")
+                finally:
+                    db.session.remove()
+
+    def flush(self):
+        """Записывает накопленное; при ошибке возвращает счётчики в буфер."""
+        with self._lock:
+            counts, self._counts = self._counts, Counter()
+        if not counts:
+            return 0
+        try:
+            write_views(counts)
+        except Exception:
+            db.session.rollback()
+            with self._lock:
+                self._counts.update(counts)
+            raise
+        return sum(counts.values())
+
+
+def write_views(counts):
+    totals = Counter()
+    for (ad_id, _), n in counts.items():
+        totals[ad_id] += n
+
+    ids = sorted(totals)
+    for i in range(0, len(ids), VIEWS_FLUSH_CHUNK):
+        chunk = ids[i:i + VIEWS_FLUSH_CHUNK]
+        added = case({ad_id: totals[ad_id] for ad_id in chunk}, value=Ad.id, else_=0)
+        db.session.execute(
+            update(Ad)
+            .where(Ad.id.in_(chunk))
+            .values(views=Ad.views + added)
+            .execution_options(synchronize_session=False)
+        )
+
+    # объявление могли удалить, пока копились просмотры
+    alive = set()
+    for i in range(0, len(ids), VIEWS_FLUSH_CHUNK):
+        alive.update(db.session.execute(
+            select(Ad.id).where(Ad.id.in_(ids[i:i + VIEWS_FLUSH_CHUNK]))
+        ).scalars())
+    rows = [
+        {"ad_id": ad_id, "day": day, "views": n}
+        for (ad_id, day), n in counts.items()
+        if ad_id in alive
+    ]
+    for i in range(0, len(rows), VIEWS_FLUSH_CHUNK):
+        stmt = sqlite_insert(AdViewDay).values(rows[i:i + VIEWS_FLUSH_CHUNK])
+        db.session.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[AdViewDay.ad_id, AdViewDay.day],
+                set_={"views": AdViewDay.views + stmt.excluded.views},
+            )
+        )
+    db.session.commit()
+
+
+view_buffer = ViewBuffer(VIEWS_FLUSH_INTERVAL)
+
+
+@atexit.register
+def _flush_views_at_exit():
+    if not view_buffer.running:
+        return
+    with app.app_context():
+        try:
+            view_buffer.flush()
+        except Exception:
+            app.logger.exception("Сброс счётчиков просмотров при выходе")
+
+
+# ===== АНАЛИТИКА: СУТОЧНЫЕ СВОДКИ =====
+# Дашборд читает только daily_stats. Задача rollup_analytics досчитывает дни
+# после отметки (watermark) кусками по ANALYTICS_CHUNK_DAYS и каждый раз
+# пересчитывает сегодняшний день. Прошедшие дни больше не трогаются.
+# Статусы заявок — снимок на момент запуска: историю статусов задним числом
+# восстановить не из чего, поэтому ряд копится с момента включения.
+
+ANALYTICS_WATERMARK = "analytics"
+ANALYTICS_INTERVAL = 15 * 60
+ANALYTICS_CHUNK_DAYS = 31
+ANALYTICS_BACKFILL_DAYS = 365
+ANALYTICS_DASHBOARD_DAYS = 30
+
+# метрики, которые целиком пересчитываются за день из исходных таблиц
+ROLLUP_METRICS = (
+    "users_new",
+    "requests_new",
+    "messages",
+    "support_new",
+    "ad_views",
+    "master_responses",
+    "master_response_median",
+)
+
+MASTER_RESPONSE_SQL = """
+WITH m AS (
+    SELECT am.ad_id,
+           am.created_at,
+           CASE WHEN am.sender_id = a.master_id THEN 1 ELSE 0 END AS from_master,
+           CASE WHEN am.sender_id = a.master_id THEN am.receiver_id ELSE am.sender_id END AS peer
+    FROM ad_messages am
+    JOIN ads a ON a.id = am.ad_id
+    WHERE a.master_id IS NOT NULL
+      AND am.created_at >= :lookback AND am.created_at < :end
+),
+t AS (
+    -- номер «раунда»: растёт на каждом ответе мастера в диалоге
+    SELECT ad_id, peer, created_at, from_master,
+           SUM(from_master) OVER (
+               PARTITION BY ad_id, peer ORDER BY created_at ROWS UNBOUNDED PRECEDING
+           ) AS round
+    FROM m
+),
+asks AS (
+    SELECT ad_id, peer, round, MIN(created_at) AS asked_at
+    FROM t WHERE from_master = 0
+    GROUP BY ad_id, peer, round
+)
+SELECT date(t.created_at) AS day,
+       (julianday(t.created_at) - julianday(asks.asked_at)) * 86400 AS seconds
+FROM t
+JOIN asks ON asks.ad_id = t.ad_id AND asks.peer = t.peer AND asks.round = t.round - 1
+WHERE t.from_master = 1 AND t.created_at >= :start
+"""
+# насколько назад смотреть в поисках вопроса, на который отвечает мастер
+MASTER_RESPONSE_LOOKBACK_DAYS = 30
+
+
+def _day_start(day):
+    return datetime.combine(day, datetime.min.time())
+
+
+def _count_by_day(column, start, end):
+    day = db.func.date(column)
+    return db.session.execute(
+        select(day, db.func.count())
+        .where(column >= _day_start(start), column < _day_start(end))
+        .group_by(day)
+    ).all()
+
+
+def master_response_times(start, end):
+    """Время ответа мастера (с) от первого неотвеченного сообщения: день → список."""
+    result = {}
+    stmt = text(MASTER_RESPONSE_SQL).bindparams(
+        *(bindparam(name, type_=db.DateTime) for name in ("lookback", "start", "end"))
+    )
+    rows = db.session.execute(
+        stmt,
+        {
+            "lookback": _day_start(start - timedelta(days=MASTER_RESPONSE_LOOKBACK_DAYS)),
+            "start": _day_start(start),
+            "end": _day_start(end),
+        },
+    )
+    for day, seconds in rows:
+        result.setdefault(day, []).append(seconds)
+    return result
+
+
+def rollup_days(start, end):
+    """Пересчитывает ROLLUP_METRICS за дни [start, end)."""
+    rows = []
+
+    def add(metric, pairs, dim=""):
+        rows.extend(
+            {"day": date.fromisoformat(str(day)), "metric": metric, "dim": dim, "value": value}
+            for day, value in pairs
+        )
+
+    add("users_new", _count_by_day(User.created_at, start, end))
+    for kind, model in MODERATION_MODELS.items():
+        add("requests_new", _count_by_day(model.created_at, start, end), dim=kind)
+    add("messages", _count_by_day(AdMessage.created_at, start, end))
+    add("support_new", _count_by_day(SupportMessage.created_at, start, end))
+    add(
+        "ad_views",
+        db.session.execute(
+            select(AdViewDay.day, db.func.sum(AdViewDay.views))
+            .where(AdViewDay.day >= start, AdViewDay.day < end)
+            .group_by(AdViewDay.day)
+        ).all(),
+    )
+    responses = master_response_times(start, end)
+    add("master_responses", [(day, len(values)) for day, values in responses.items()])
+    add(
+        "master_response_median",
+        [(day, statistics.median(values)) for day, values in responses.items()],
+    )
+
+    DailyStat.query.filter(
+        DailyStat.day >= start,
+        DailyStat.day < end,
+        DailyStat.metric.in_(ROLLUP_METRICS),
+    ).delete(synchronize_session=False)
+    if rows:
+        db.session.execute(insert(DailyStat), rows)
+
+
+def snapshot_request_statuses(day):
+    DailyStat.query.filter_by(day=day, metric="requests_status").delete(
+        synchronize_session=False
+    )
+    counts = {}
+    for kind, model in MODERATION_MODELS.items():
+        # обработанные заявки уходят в архив, но из истории статусов не пропадают
+        sources = [model]
+        if model.__tablename__ in ARCHIVE_TABLES:
+            sources.append(ARCHIVE_TABLES[model.__tablename__].c)
+        for source in sources:
+            for status, n in count_by_status(source).items():
+                if status != "total":
+                    dim = f"{kind}:{status}"
+                    counts[dim] = counts.get(dim, 0) + n
+    rows = [
+        {"day": day, "metric": "requests_status", "dim": dim, "value": n}
+        for dim, n in counts.items()
+    ]
+    if rows:
+        db.session.execute(insert(DailyStat), rows)
+
+
+def first_activity_day():
+    firsts = [
+        db.session.execute(select(db.func.min(column))).scalar()
+        for column in (
+            User.created_at,
+            AdMessage.created_at,
+            SupportMessage.created_at,
+            StreetRequest.created_at,
+            AdRequest.created_at,
+            PavilionRequest.created_at,
+        )
+    ]
+    firsts = [value for value in firsts if value is not None]
+    return min(firsts).date() if firsts else None
+
+
+@job_handler("rollup_analytics", max_attempts=3, priority=-5)
+def rollup_analytics(payload, job_id=None):
+    today = datetime.utcnow().date()
+    mark = db.session.get(RollupWatermark, ANALYTICS_WATERMARK)
+    if mark is None:
+        first = first_activity_day() or today
+        start = max(first, today - timedelta(days=ANALYTICS_BACKFILL_DAYS))
+        mark = RollupWatermark(name=ANALYTICS_WATERMARK, day=start - timedelta(days=1))
+        db.session.add(mark)
+    start = mark.day + timedelta(days=1)
+
+    while start <= today:
+        end = min(start + timedelta(days=ANALYTICS_CHUNK_DAYS), today + timedelta(days=1))
+        rollup_days(start, end)
+        # сегодняшний день ещё не закрыт — отметка останавливается на вчера
+        mark.day = min(end, today) - timedelta(days=1)
+        db.session.commit()
+        start = end
+
+    snapshot_request_statuses(today)
+    db.session.commit()
+
+
+periodic_job("rollup_analytics", every_seconds=ANALYTICS_INTERVAL)
+
+
+def dashboard_series(days=ANALYTICS_DASHBOARD_DAYS):
+    """Ряды для дашборда из daily_stats: [{day, metric → value}], старые дни сверху."""
+    today = datetime.utcnow().date()
+    start = today - timedelta(days=days - 1)
+    series = {
+        start + timedelta(days=i): {"day": start + timedelta(days=i)}
+        for i in range(days)
+    }
+    for day, metric, dim, value in db.session.execute(
+        select(DailyStat.day, DailyStat.metric, DailyStat.dim, DailyStat.value)
+        .where(DailyStat.day >= start)
+    ):
+        key = f"{metric}:{dim}" if dim else metric
+        series[day][key] = value
+    return list(series.values())
+
+
+# ===== ПОЛЬЗОВАТЕЛЬСКИЕ СТРАНИЦЫ =====
+
+
+@app.route("/")
+def index():
+    if session.get("user_role") == "admin":
+        return redirect(url_for("admin_dashboard"))
+
+    streets = fetch_rows(StreetCard, STREET_CARDS)
+    featured_ads = featured_ad_cards()
     fio, group = get_student_info()
 
     return render_template(
@@ -413,9 +2396,10 @@ def index():
 @app.route("/street/<code>")
 def street_page(code):
     street = Street.query.filter_by(code=code).first_or_404()
-    pavilions = Pavilion.query.filter_by(street_id=street.id).order_by(
-        Pavilion.id
-    ).all()
+    pavilions = fetch_rows(
+        PavilionCard,
+        PAVILION_CARDS.where(Pavilion.street_id == street.id).order_by(Pavilion.id),
+    )
 
     fio, group = get_student_info()
     return render_template(
@@ -429,8 +2413,10 @@ def street_page(code):
 
 @app.route("/pavilion/<int:pavilion_id>")
 def pavilion_page(pavilion_id):
-    pavilion = Pavilion.query.get_or_404(pavilion_id)
-    ads = pavilion.ads
+    pavilion = get_live_or_404(Pavilion, pavilion_id)
+    ads = fetch_rows(
+        AdListRow, AD_LIST_ROWS.where(Ad.pavilion_id == pavilion.id).order_by(Ad.id)
+    )
 
     fio, group = get_student_info()
     return render_template(
@@ -449,7 +2435,7 @@ def pavilion_page(pavilion_id):
 @login_required
 def offer_ad(pavilion_id):
     fio, group = get_student_info()
-    pavilion = Pavilion.query.get_or_404(pavilion_id)
+    pavilion = get_live_or_404(Pavilion, pavilion_id)
 
     if session.get("user_role") not in ("master", "admin"):
         flash("Предлагать объявления могут только мастера.", "error")
@@ -478,7 +2464,7 @@ def offer_ad(pavilion_id):
             db.session.add(req)
             db.session.commit()
 
-            recalc_admin_counters()
+            bump_admin_counter("ad", 1)
             flash("Заявка на объявление отправлена администратору.", "success")
             return redirect(url_for("pavilion_page", pavilion_id=pavilion.id))
 
@@ -494,7 +2480,8 @@ def offer_ad(pavilion_id):
 
 @app.route("/ad/<int:ad_id>")
 def ad_page(ad_id):
-    ad = Ad.query.get_or_404(ad_id)
+    ad = get_live_or_404(Ad, ad_id)
+    view_buffer.add(ad.id)
     fio, group = get_student_info()
     return render_template("ad.html", ad=ad, fio=fio, group=group)
 
@@ -571,7 +2558,7 @@ def login():
         username = request.form.get("username", "").strip()
         password = request.form.get("password", "")
 
-        user = User.query.filter_by(username=username).first()
+        user = User.query.filter_by(username=username, deleted_at=None).first()
 
         if user is None:
             errors.append("Пользователь с таким логином не найден.")
@@ -593,9 +2580,6 @@ def login():
                 session["user_role"] = user.role
                 session["avatar_filename"] = user.avatar_filename
                 session["full_name"] = user.full_name
-
-                recalc_unread_total()
-                recalc_support_badge()
                 return redirect(url_for("index"))
 
     return render_template("login.html", errors=errors)
@@ -611,35 +2595,13 @@ def logout():
 @login_required
 def delete_account():
     user_id = session["user_id"]
-    user = User.query.get_or_404(user_id)
+    user = current_user()
+    if user is None:
+        abort(404)
 
     if request.method == "POST":
-        # 1. удаляем все сообщения по объявлениям
-        AdMessage.query.filter(
-            (AdMessage.sender_id == user_id) | (AdMessage.receiver_id == user_id)
-        ).delete(synchronize_session=False)
-
-        # 2. обращения в поддержку
-        SupportMessage.query.filter_by(user_id=user_id).delete(
-            synchronize_session=False
-        )
-
-        # 3. заявки пользователя
-        StreetRequest.query.filter_by(user_id=user_id).delete(
-            synchronize_session=False
-        )
-        AdRequest.query.filter_by(user_id=user_id).delete(synchronize_session=False)
-        PavilionRequest.query.filter_by(user_id=user_id).delete(
-            synchronize_session=False
-        )
-
-        # 4. если это мастер – удаляем все его объявления
-        if user.role == "master":
-            Ad.query.filter_by(master_id=user_id).delete(synchronize_session=False)
-
-        # 5. сам пользователь
-        db.session.delete(user)
-        db.session.commit()
+        # аккаунт сразу скрывается, связанные данные чистятся в фоне
+        schedule_deletion("user", user_id, label=f"Пользователь {user.username}")
 
         session.clear()
         flash("Аккаунт удалён.", "success")
@@ -652,16 +2614,159 @@ def delete_account():
 # ===== ПРОСТЫЕ СТРАНИЦЫ =====
 
 
+# Страницы без данных из БД рисуются один раз и держатся в памяти вместе с
+# gzip/brotli-версиями. На каждый запрос рендерятся только шапка и плашка
+# сообщений конкретного пользователя. Для гостя и они одинаковые, так что
+# гостю страница отдаётся целиком из памяти.
+
+STATIC_PAGES = {
+    "how_it_works": "how_it_works.html",
+    "about": "about.html",
+}
+STATIC_PAGE_FRAGMENTS = ["partials/site_header.html", "partials/floating_messages.html"]
+PRERENDER_MARKER = "<!--#fragment-->"
+
+STATIC_GZIP_LEVEL = 9
+FRAGMENT_GZIP_LEVEL = 6
+STATIC_BROTLI_QUALITY = 11
+
+# gzip-заголовок без имени файла и времени (RFC 1952)
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+_static_pages = {}
+_static_pages_lock = threading.Lock()
+
+
+def _deflate_part(data, level, final=False):
+    """Сырой deflate-кусок. После Z_SYNC_FLUSH поток выровнен по байту, поэтому
+    куски, сжатые отдельно, можно склеивать в один поток."""
+    c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return c.compress(data) + c.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class PrerenderedPage:
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        fio, group = get_student_info()
+
+        env = app.jinja_env
+        self.templates = [
+            env.get_template(name)
+            for name in [STATIC_PAGES[endpoint], "base.html", *STATIC_PAGE_FRAGMENTS]
+        ]
+
+        html = render_template(
+            STATIC_PAGES[endpoint],
+            fio=fio,
+            group=group,
+            prerender_marker=Markup(PRERENDER_MARKER),
+        )
+        self.parts = [part.encode("utf-8") for part in html.split(PRERENDER_MARKER)]
+        if len(self.parts) != len(STATIC_PAGE_FRAGMENTS) + 1:
+            raise RuntimeError(f"{endpoint}: шаблон должен наследовать base.html")
+
+        last = len(self.parts) - 1
+        self.deflated = [
+            _deflate_part(part, STATIC_GZIP_LEVEL, final=(i == last))
+            for i, part in enumerate(self.parts)
+        ]
+
+        # гостевой вариант полностью статичен — сжимаем его целиком заранее
+        body = self._join(self.render_fragments(anonymous=True))
+        self.guest = {
+            "identity": body,
+            "gzip": gzip.compress(body, STATIC_GZIP_LEVEL, mtime=0),
+        }
+        if brotli is not None:
+            self.guest["br"] = brotli.compress(body, quality=STATIC_BROTLI_QUALITY)
+        self.guest_etag = hashlib.sha1(body).hexdigest()
+
+    def is_up_to_date(self):
+        return all(t.is_up_to_date for t in self.templates)
+
+    def render_fragments(self, anonymous=False):
+        # явный session={} перекрывает настоящую сессию из контекст-процессора
+        extra = {"session": {}} if anonymous else {}
+        return [
+            render_template(name, **extra).encode("utf-8")
+            for name in STATIC_PAGE_FRAGMENTS
+        ]
+
+    def _join(self, fragments):
+        out = [self.parts[0]]
+        for fragment, part in zip(fragments, self.parts[1:]):
+            out += [fragment, part]
+        return b"".join(out)
+
+    def personal_body(self, encoding):
+        fragments = self.render_fragments()
+        body = self._join(fragments)
+        if encoding != "gzip":
+            return body
+
+        # статические куски уже сжаты — дожимаем только фрагменты
+        deflated = [self.deflated[0]]
+        for fragment, part in zip(fragments, self.deflated[1:]):
+            deflated += [_deflate_part(fragment, FRAGMENT_GZIP_LEVEL), part]
+        trailer = (zlib.crc32(body) & 0xFFFFFFFF).to_bytes(4, "little") + (
+            len(body) & 0xFFFFFFFF
+        ).to_bytes(4, "little")
+        return GZIP_HEADER + b"".join(deflated) + trailer
+
+
+def get_static_page(endpoint):
+    page = _static_pages.get(endpoint)
+    # в продакшене шаблоны не перечитываются, а при отладке следим за правками
+    if page is not None and not (app.jinja_env.auto_reload and not page.is_up_to_date()):
+        return page
+
+    with _static_pages_lock:
+        page = _static_pages.get(endpoint)
+        if page is None or not page.is_up_to_date():
+            page = PrerenderedPage(endpoint)
+            _static_pages[endpoint] = page
+    return page
+
+
+def _pick_encoding(allow_br):
+    accepted = request.accept_encodings
+    if allow_br and accepted["br"]:
+        return "br"
+    if accepted["gzip"]:
+        return "gzip"
+    return "identity"
+
+
+def serve_static_page(endpoint):
+    page = get_static_page(endpoint)
+    guest = "user_id" not in session
+
+    if guest:
+        encoding = _pick_encoding(allow_br=brotli is not None)
+        resp = make_response(page.guest[encoding])
+        # слабый ETag: тело одно и то же, меняется только кодировка
+        resp.set_etag(page.guest_etag, weak=True)
+        resp.headers["Cache-Control"] = "no-cache"
+    else:
+        # brotli на лету для каждого пользователя дороже, чем выигрыш
+        encoding = _pick_encoding(allow_br=False)
+        resp = make_response(page.personal_body(encoding))
+        resp.headers["Cache-Control"] = "private, no-cache"
+
+    if encoding != "identity":
+        resp.headers["Content-Encoding"] = encoding
+    resp.vary.update(("Accept-Encoding", "Cookie"))
+    return resp.make_conditional(request) if guest else resp
+
+
 @app.route("/how-it-works")
 def how_it_works():
-    fio, group = get_student_info()
-    return render_template("how_it_works.html", fio=fio, group=group)
+    return serve_static_page("how_it_works")
 
 
 @app.route("/about")
 def about():
-    fio, group = get_student_info()
-    return render_template("about.html", fio=fio, group=group)
+    return serve_static_page("about")
 
 
 # ===== ЗАЯВКА НА НОВУЮ УЛИЦУ =====
@@ -720,7 +2825,7 @@ def request_street():
             db.session.add(req)
             db.session.commit()
 
-            recalc_admin_counters()
+            bump_admin_counter("street", 1)
             flash("Заявка на улицу отправлена администратору.", "success")
             return redirect(url_for("index"))
 
@@ -761,19 +2866,29 @@ def support():
             db.session.add(msg)
             db.session.commit()
 
-            recalc_admin_counters()
+            bump_admin_counter("support", 1)
             flash("Сообщение отправлено администратору.", "success")
             return redirect(url_for("support"))
 
-    my_messages = (
-        SupportMessage.query.filter_by(user_id=session["user_id"])
-        .order_by(SupportMessage.created_at.desc())
-        .limit(10)
-        .all()
-    )
+    archive = wants_archive()
+    if archive:
+        arch = ARCHIVE_TABLES["support_messages"]
+        my_messages = db.session.execute(
+            select(arch).where(arch.c.user_id == session["user_id"]).order_by(arch.c.id.desc())
+        ).all()
+        archived = len(my_messages)
+    else:
+        my_messages = (
+            SupportMessage.query.filter_by(user_id=session["user_id"])
+            .order_by(SupportMessage.created_at.desc())
+            .limit(10)
+            .all()
+        )
+        archived = archive_count(
+            SupportMessage, ARCHIVE_TABLES["support_messages"].c.user_id == session["user_id"]
+        )
 
     session["support_seen_at"] = datetime.utcnow().isoformat()
-    recalc_support_badge()
 
     return render_template(
         "support.html",
@@ -781,6 +2896,8 @@ def support():
         group=group,
         errors=errors,
         my_messages=my_messages,
+        archive=archive,
+        archived=archived,
     )
 
 
@@ -791,43 +2908,336 @@ def support():
 @admin_required
 def admin_dashboard():
     fio, group = get_student_info()
-    streets = Street.query.order_by(Street.id).all()
+    streets = fetch_rows(StreetCard, STREET_CARDS)
+
+    series = dashboard_series()
+    for row in series:
+        row["requests_new"] = sum(row.get(f"requests_new:{kind}", 0) for kind in MODERATION_MODELS)
+        # снимок статусов есть только за дни, когда работала задача сводок
+        if any(key.startswith("requests_status:") for key in row):
+            row["pending"] = sum(
+                row.get(f"requests_status:{kind}:pending", 0) for kind in MODERATION_MODELS
+            )
+        else:
+            row["pending"] = None
+    totals = {
+        metric: sum(row.get(metric, 0) for row in series)
+        for metric in ("users_new", "requests_new", "messages", "support_new", "ad_views")
+    }
+    last_response = next(
+        (row for row in reversed(series) if "master_response_median" in row), None
+    )
+    peak = max([row.get("messages", 0) for row in series] + [1])
+
     return render_template(
         "admin_dashboard.html",
         fio=fio,
         group=group,
         streets=streets,
+        series=series,
+        totals=totals,
+        last_response=last_response,
+        peak=peak,
     )
 
 
-# ===== АДМИН: ЗАЯВКИ НА УЛИЦЫ =====
+@app.template_filter("duration")
+def format_duration(seconds):
+    """Секунды в «2 ч 05 мин» / «7 мин» / «40 с»."""
+    seconds = int(seconds or 0)
+    if seconds >= 3600:
+        return f"{seconds // 3600} ч {seconds % 3600 // 60:02d} мин"
+    if seconds >= 60:
+        return f"{seconds // 60} мин"
+    return f"{seconds} с"
 
 
-@app.route("/admin/requests")
-@admin_required
-def admin_requests():
-    fio, group = get_student_info()
-    requests_list = StreetRequest.query.order_by(
-        StreetRequest.created_at.desc()
-    ).all()
+# ===== МОДЕРАЦИЯ ЗАЯВОК =====
 
-    stats = {
-        "total": len(requests_list),
-        "pending": sum(1 for r in requests_list if r.status == "pending"),
-        "approved": sum(1 for r in requests_list if r.status == "approved"),
-        "rejected": sum(1 for r in requests_list if r.status == "rejected"),
-    }
+MODERATION_MODELS = {
+    "street": StreetRequest,
+    "ad": AdRequest,
+    "pavilion": PavilionRequest,
+}
 
-    return render_template(
-        "admin_requests.html",
-        fio=fio,
-        group=group,
-        requests=requests_list,
-        stats=stats,
+
+def _approve_street_requests(reqs, results):
+    codes = {r.street_code for r in reqs}
+    taken = set(
+        db.session.execute(select(Street.code).where(Street.code.in_(codes))).scalars()
     )
 
+    ok = []
+    for r in reqs:
+        if r.street_code in taken:
+            results[r.id].update(result="error", message="код улицы уже занят")
+            continue
+        taken.add(r.street_code)
+        ok.append(r)
+    if not ok:
+        return
 
-@app.route("/admin/requests/<int:req_id>/approve", methods=["POST"])
+    street_ids = db.session.execute(
+        insert(Street).returning(Street.id, sort_by_parameter_order=True),
+        [{"name": r.street_name, "code": r.street_code} for r in ok],
+    ).scalars().all()
+    pav_ids = db.session.execute(
+        insert(Pavilion).returning(Pavilion.id, sort_by_parameter_order=True),
+        [
+            {"title": r.pavilion_title, "description": r.pavilion_desc, "street_id": sid}
+            for r, sid in zip(ok, street_ids)
+        ],
+    ).scalars().all()
+    record_changes("streets", street_ids)
+    record_changes("pavilions", pav_ids)
+    db.session.execute(
+        update(StreetRequest),
+        [
+            {"id": r.id, "status": "approved", "street_id": sid}
+            for r, sid in zip(ok, street_ids)
+        ],
+    )
+
+    for r, sid, pid in zip(ok, street_ids, pav_ids):
+        results[r.id].update(
+            result="approved", street_id=sid, street_code=r.street_code, pavilion_id=pid
+        )
+
+
+def _approve_ad_requests(reqs, results):
+    pav_ids = {r.pavilion_id for r in reqs}
+    live_pavs = set(
+        db.session.execute(
+            select(Pavilion.id).where(
+                Pavilion.id.in_(pav_ids), Pavilion.deleted_at.is_(None)
+            )
+        ).scalars()
+    )
+    names = dict(
+        db.session.execute(
+            select(User.id, User.username).where(User.id.in_({r.user_id for r in reqs}))
+        ).all()
+    )
+
+    ok = []
+    for r in reqs:
+        if r.pavilion_id not in live_pavs:
+            results[r.id].update(result="error", message="павильон удалён")
+        else:
+            ok.append(r)
+    if not ok:
+        return
+
+    ad_ids = db.session.execute(
+        insert(Ad).returning(Ad.id, sort_by_parameter_order=True),
+        [
+            {
+                "title": r.title,
+                "text": r.text,
+                "author_name": names.get(r.user_id),
+                "pavilion_id": r.pavilion_id,
+                "master_id": r.user_id,
+            }
+            for r in ok
+        ],
+    ).scalars().all()
+    record_changes("ads", ad_ids)
+    db.session.execute(
+        update(AdRequest), [{"id": r.id, "status": "approved"} for r in ok]
+    )
+
+    for r, aid in zip(ok, ad_ids):
+        results[r.id].update(result="approved", ad_id=aid, pavilion_id=r.pavilion_id)
+
+
+def _approve_pavilion_requests(reqs, results):
+    street_ids = set(
+        db.session.execute(
+            select(Street.id).where(Street.id.in_({r.street_id for r in reqs}))
+        ).scalars()
+    )
+    names = dict(
+        db.session.execute(
+            select(User.id, User.username).where(User.id.in_({r.user_id for r in reqs}))
+        ).all()
+    )
+
+    ok = []
+    for r in reqs:
+        if r.street_id not in street_ids:
+            results[r.id].update(result="error", message="улица не найдена")
+        else:
+            ok.append(r)
+    if not ok:
+        return
+
+    pav_ids = db.session.execute(
+        insert(Pavilion).returning(Pavilion.id, sort_by_parameter_order=True),
+        [
+            {
+                # в старых заявках название лежит в title
+                "title": r.pavilion_title or r.title,
+                "description": r.pavilion_desc,
+                "street_id": r.street_id,
+            }
+            for r in ok
+        ],
+    ).scalars().all()
+    ad_ids = db.session.execute(
+        insert(Ad).returning(Ad.id, sort_by_parameter_order=True),
+        [
+            {
+                "title": r.ad_title,
+                "text": r.ad_text,
+                "author_name": names.get(r.user_id),
+                "pavilion_id": pid,
+                "master_id": r.user_id,
+            }
+            for r, pid in zip(ok, pav_ids)
+        ],
+    ).scalars().all()
+    record_changes("pavilions", pav_ids)
+    record_changes("ads", ad_ids)
+    db.session.execute(
+        update(PavilionRequest), [{"id": r.id, "status": "approved"} for r in ok]
+    )
+
+    for r, pid, aid in zip(ok, pav_ids, ad_ids):
+        results[r.id].update(result="approved", pavilion_id=pid, ad_id=aid)
+
+
+def moderate_requests(kind, action, ids=None, created_before=None):
+    """Одобрение/отклонение пачки заявок одной транзакцией.
+
+    ids=None — все ожидающие заявки (с фильтром по дате).
+    С ids и created_before заявки не моложе даты пропускаются с причиной.
+    Возвращает список результатов по каждой заявке.
+    """
+    model = MODERATION_MODELS[kind]
+
+    q = model.query
+    if ids is not None:
+        # дату проверяем ниже: отсеянная фильтром заявка — не «не найдена»
+        q = q.filter(model.id.in_(ids))
+    else:
+        q = q.filter(model.status == "pending")
+        if created_before is not None:
+            q = q.filter(model.created_at < created_before)
+    reqs = q.order_by(model.id).all()
+
+    results = {r.id: {"id": r.id, "result": None, "message": ""} for r in reqs}
+    for missing in set(ids or ()) - set(results):
+        results[missing] = {"id": missing, "result": "error", "message": "заявка не найдена"}
+
+    pending = []
+    for r in reqs:
+        if r.status != "pending":
+            results[r.id].update(result="skipped", message="заявка уже обработана")
+        elif created_before is not None and not (r.created_at and r.created_at < created_before):
+            results[r.id].update(
+                result="skipped",
+                message=f"не подходит под фильтр: создана не раньше {created_before:%d.%m.%Y}",
+            )
+        else:
+            pending.append(r)
+
+    if pending:
+        if action == "reject":
+            db.session.execute(
+                update(model), [{"id": r.id, "status": "rejected"} for r in pending]
+            )
+            for r in pending:
+                results[r.id]["result"] = "rejected"
+        elif kind == "street":
+            _approve_street_requests(pending, results)
+        elif kind == "ad":
+            _approve_ad_requests(pending, results)
+        else:
+            _approve_pavilion_requests(pending, results)
+
+    db.session.commit()
+    done = sum(1 for r in results.values() if r["result"] in ("approved", "rejected"))
+    bump_admin_counter(kind, -done)
+    return [results[k] for k in sorted(results)]
+
+
+@app.route("/admin/moderation/bulk", methods=["POST"])
+@admin_required
+def admin_bulk_moderation():
+    """Массовая модерация: выбранные заявки или все ожидающие по фильтру."""
+    kind = request.form.get("kind")
+    action = request.form.get("action")
+    scope = request.form.get("scope", "selected")
+    back = url_for("admin_requests") if kind == "street" else url_for("admin_ad_requests")
+
+    if kind not in MODERATION_MODELS or action not in ("approve", "reject"):
+        abort(400)
+
+    ids = None
+    if scope != "all_pending":
+        ids = request.form.getlist("ids", type=int)
+        if not ids:
+            flash("Не выбрано ни одной заявки.", "error")
+            return redirect(back)
+
+    created_before = None
+    if request.form.get("created_before"):
+        try:
+            created_before = datetime.strptime(
+                request.form["created_before"], "%Y-%m-%d"
+            )
+        except ValueError:
+            flash("Дата фильтра в формате ГГГГ-ММ-ДД.", "error")
+            return redirect(back)
+
+    items = moderate_requests(kind, action, ids=ids, created_before=created_before)
+
+    summary = {}
+    for item in items:
+        summary[item["result"]] = summary.get(item["result"], 0) + 1
+
+    if request.accept_mimetypes.best == "application/json" or request.form.get("format") == "json":
+        return jsonify({"kind": kind, "action": action, "summary": summary, "items": items})
+
+    fio, group = get_student_info()
+    return render_template(
+        "admin_moderation_result.html",
+        fio=fio,
+        group=group,
+        kind=kind,
+        action=action,
+        items=items,
+        summary=summary,
+        back=back,
+    )
+
+
+# ===== АДМИН: ЗАЯВКИ НА УЛИЦЫ =====
+
+
+@app.route("/admin/requests")
+@admin_required
+def admin_requests():
+    fio, group = get_student_info()
+    archive = wants_archive()
+    stmt, _, cols = list_source(
+        StreetRequest, STREET_REQUEST_ROWS.order_by(StreetRequest.created_at.desc()), archive
+    )
+    requests_list = fetch_rows(StreetRequestRow, stmt)
+    stats = {"pending": 0, "approved": 0, "rejected": 0, **count_by_status(cols)}
+
+    return render_template(
+        "admin_requests.html",
+        fio=fio,
+        group=group,
+        requests=requests_list,
+        stats=stats,
+        archive=archive,
+        archived=stats["total"] if archive else archive_count(StreetRequest),
+    )
+
+
+@app.route("/admin/requests/<int:req_id>/approve", methods=["POST"])
 @admin_required
 def approve_request(req_id):
     req = StreetRequest.query.get_or_404(req_id)
@@ -836,25 +3246,13 @@ def approve_request(req_id):
         flash("Эта заявка уже обработана.", "error")
         return redirect(url_for("admin_requests"))
 
-    new_street = Street(name=req.street_name, code=req.street_code)
-    db.session.add(new_street)
-    db.session.flush()
-
-    pav = Pavilion(
-        title=req.pavilion_title,
-        description=req.pavilion_desc,
-        street=new_street,
-    )
-    db.session.add(pav)
-
-    req.status = "approved"
-    req.street_id = new_street.id
-
-    db.session.commit()
+    item = moderate_requests("street", "approve", ids=[req.id])[0]
+    if item["result"] != "approved":
+        flash(f"Не удалось одобрить: {item['message']}.", "error")
+        return redirect(url_for("admin_requests"))
 
-    recalc_admin_counters()
     flash("Улица и павильон созданы.", "success")
-    return redirect(url_for("street_page", code=new_street.code))
+    return redirect(url_for("street_page", code=item["street_code"]))
 
 
 @app.route("/admin/requests/<int:req_id>/reject", methods=["POST"])
@@ -867,7 +3265,7 @@ def reject_request(req_id):
     else:
         req.status = "rejected"
         db.session.commit()
-        recalc_admin_counters()
+        bump_admin_counter("street", -1)
         flash("Заявка отклонена.", "info")
 
     return redirect(url_for("admin_requests"))
@@ -880,22 +3278,26 @@ def reject_request(req_id):
 @admin_required
 def admin_support():
     fio, group = get_student_info()
-    messages = SupportMessage.query.order_by(
-        SupportMessage.created_at.desc()
-    ).all()
+    archive = wants_archive()
+    stmt, id_col, cols = list_source(SupportMessage, SUPPORT_ROWS, archive)
+    # новые сверху; id растёт вместе с created_at
+    messages = iter_keyset(stmt, id_col, SupportRow, desc=True)
 
+    counts = count_by_status(cols)
     stats = {
-        "total": len(messages),
-        "new": sum(1 for m in messages if m.status == "new"),
-        "done": sum(1 for m in messages if m.status == "done"),
+        "total": counts["total"],
+        "new": counts.get("new", 0),
+        "done": counts.get("done", 0),
     }
 
-    return render_template(
+    return stream_page(
         "admin_support.html",
         fio=fio,
         group=group,
         messages=messages,
         stats=stats,
+        archive=archive,
+        archived=counts["total"] if archive else archive_count(SupportMessage),
     )
 
 
@@ -903,10 +3305,12 @@ def admin_support():
 @admin_required
 def close_support(msg_id):
     msg = SupportMessage.query.get_or_404(msg_id)
+    was_new = msg.status == "new"
     msg.status = "done"
     db.session.commit()
+    if was_new:
+        bump_admin_counter("support", -1)
 
-    recalc_admin_counters()
     flash("Обращение помечено как обработанное.", "success")
     return redirect(url_for("admin_support"))
 
@@ -921,12 +3325,14 @@ def admin_support_reply(msg_id):
         flash("Нельзя отправить пустой ответ.", "error")
         return redirect(url_for("admin_support"))
 
+    was_new = msg.status == "new"
     msg.admin_reply = reply_text
     msg.replied_at = datetime.utcnow()
     msg.status = "done"
     db.session.commit()
+    if was_new:
+        bump_admin_counter("support", -1)
 
-    recalc_admin_counters()
     flash("Ответ отправлен и сохранён.", "success")
     return redirect(url_for("admin_support"))
 
@@ -939,12 +3345,14 @@ def admin_support_reply(msg_id):
 def admin_users():
     """Список всех пользователей для администратора."""
     fio, group = get_student_info()
-    users = User.query.order_by(User.id).all()
-    return render_template(
+    users = iter_keyset(USER_ROWS, User.id, UserRow)
+    users_total = db.session.execute(select(db.func.count(User.id))).scalar()
+    return stream_page(
         "admin_users.html",
         fio=fio,
         group=group,
         users=users,
+        users_total=users_total,
     )
 
 
@@ -965,35 +3373,91 @@ def admin_delete_user(user_id):
         flash("Нельзя удалить администраторский аккаунт.", "error")
         return redirect(url_for("admin_users"))
 
-    # 1. сообщения по объявлениям
-    AdMessage.query.filter(
-        (AdMessage.sender_id == user_id) | (AdMessage.receiver_id == user_id)
-    ).delete(synchronize_session=False)
+    if user.deleted_at is not None:
+        flash("Учётная запись уже удаляется.", "info")
+        return redirect(url_for("admin_users"))
 
-    # 2. обращения в поддержку
-    SupportMessage.query.filter_by(user_id=user_id).delete(
-        synchronize_session=False
+    schedule_deletion("user", user.id, label=f"Пользователь {user.username}")
+
+    flash("Учётная запись удалена, связанные данные очищаются в фоне.", "success")
+    return redirect(url_for("admin_users"))
+
+
+@app.route("/admin/deletions")
+@admin_required
+def admin_deletions():
+    """Ход фоновых удалений."""
+    fio, group = get_student_info()
+    tasks = DeletionTask.query.order_by(DeletionTask.id.desc()).limit(100).all()
+    active = any(t.status in ("pending", "running") for t in tasks)
+    return render_template(
+        "admin_deletions.html",
+        fio=fio,
+        group=group,
+        tasks=tasks,
+        active=active,
     )
 
-    # 3. заявки
-    StreetRequest.query.filter_by(user_id=user_id).delete(
-        synchronize_session=False
+
+# ===== АДМИН: ОЧЕРЕДЬ ЗАДАЧ =====
+
+
+@app.route("/admin/jobs")
+@admin_required
+def admin_jobs():
+    fio, group = get_student_info()
+    status = request.args.get("status", "")
+
+    counts = dict(
+        db.session.query(Job.status, db.func.count(Job.id)).group_by(Job.status).all()
     )
-    AdRequest.query.filter_by(user_id=user_id).delete(synchronize_session=False)
-    PavilionRequest.query.filter_by(user_id=user_id).delete(
-        synchronize_session=False
+
+    q = Job.query
+    if status:
+        q = q.filter(Job.status == status)
+    jobs = q.order_by(Job.id.desc()).limit(100).all()
+
+    return render_template(
+        "admin_jobs.html",
+        fio=fio,
+        group=group,
+        jobs=jobs,
+        counts=counts,
+        status=status,
+        periodic=PERIODIC_JOBS,
+        workers=len(_job_threads),
     )
 
-    # 4. если это мастер – удаляем все его объявления
-    if user.role == "master":
-        Ad.query.filter_by(master_id=user_id).delete(synchronize_session=False)
 
-    # 5. сам пользователь
-    db.session.delete(user)
-    db.session.commit()
+@app.route("/admin/jobs/<int:job_id>/retry", methods=["POST"])
+@admin_required
+def admin_retry_job(job_id):
+    job = Job.query.get_or_404(job_id)
+    if job.status in ("failed", "cancelled"):
+        job.status = "queued"
+        job.attempts = 0
+        job.run_at = datetime.utcnow()
+        job.finished_at = None
+        db.session.commit()
+        wake_job_workers()
+        flash(f"Задача #{job.id} снова в очереди.", "success")
+    else:
+        flash("Повторить можно только упавшую или отменённую задачу.", "error")
+    return redirect(url_for("admin_jobs"))
 
-    flash("Учётная запись удалена.", "success")
-    return redirect(url_for("admin_users"))
+
+@app.route("/admin/jobs/<int:job_id>/cancel", methods=["POST"])
+@admin_required
+def admin_cancel_job(job_id):
+    job = Job.query.get_or_404(job_id)
+    if job.status == "queued":
+        job.status = "cancelled"
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+        flash(f"Задача #{job.id} отменена.", "success")
+    else:
+        flash("Отменить можно только задачу, которая ещё ждёт в очереди.", "error")
+    return redirect(url_for("admin_jobs"))
 
 
 # ===== АДМИН: ПАВИЛЬОНЫ И ОБЪЯВЛЕНИЯ =====
@@ -1002,10 +3466,11 @@ def admin_delete_user(user_id):
 @app.route("/admin/pavilion/<int:pavilion_id>/clear", methods=["POST"])
 @admin_required
 def admin_clear_pavilion(pavilion_id):
-    pavilion = Pavilion.query.get_or_404(pavilion_id)
+    pavilion = get_live_or_404(Pavilion, pavilion_id)
 
-    Ad.query.filter_by(pavilion_id=pavilion.id).delete()
-    db.session.commit()
+    schedule_deletion(
+        "pavilion_ads", pavilion.id, label=f"Объявления павильона «{pavilion.title}»"
+    )
 
     flash("Все объявления в павильоне удалены.", "success")
     return redirect(url_for("pavilion_page", pavilion_id=pavilion.id))
@@ -1014,12 +3479,10 @@ def admin_clear_pavilion(pavilion_id):
 @app.route("/admin/pavilion/<int:pavilion_id>/delete", methods=["POST"])
 @admin_required
 def admin_delete_pavilion(pavilion_id):
-    pavilion = Pavilion.query.get_or_404(pavilion_id)
+    pavilion = get_live_or_404(Pavilion, pavilion_id)
     street_code = pavilion.street.code
 
-    Ad.query.filter_by(pavilion_id=pavilion.id).delete()
-    db.session.delete(pavilion)
-    db.session.commit()
+    schedule_deletion("pavilion", pavilion.id, label=f"Павильон «{pavilion.title}»")
 
     flash("Павильон удалён.", "success")
     return redirect(url_for("street_page", code=street_code))
@@ -1028,11 +3491,10 @@ def admin_delete_pavilion(pavilion_id):
 @app.route("/admin/ad/<int:ad_id>/delete", methods=["POST"])
 @admin_required
 def admin_delete_ad(ad_id):
-    ad = Ad.query.get_or_404(ad_id)
+    ad = get_live_or_404(Ad, ad_id)
     pavilion_id = ad.pavilion_id
 
-    db.session.delete(ad)
-    db.session.commit()
+    schedule_deletion("ad", ad.id, label=f"Объявление «{ad.title}»")
 
     flash("Объявление удалено.", "success")
     return redirect(url_for("pavilion_page", pavilion_id=pavilion_id))
@@ -1042,7 +3504,7 @@ def admin_delete_ad(ad_id):
 @admin_required
 def admin_edit_ad(ad_id):
     """Редактирование текста объявления администратором."""
-    ad = Ad.query.get_or_404(ad_id)
+    ad = get_live_or_404(Ad, ad_id)
 
     fio, group = get_student_info()
     errors = []
@@ -1089,7 +3551,7 @@ def admin_delete_ad_legacy(ad_id):
 @login_required
 def delete_own_ad(ad_id):
     """Удаление объявления самим мастером."""
-    ad = Ad.query.get_or_404(ad_id)
+    ad = get_live_or_404(Ad, ad_id)
     user_id = session.get("user_id")
     role = session.get("user_role")
 
@@ -1100,8 +3562,7 @@ def delete_own_ad(ad_id):
 
     pavilion_id = ad.pavilion_id
 
-    db.session.delete(ad)
-    db.session.commit()
+    schedule_deletion("ad", ad.id, label=f"Объявление «{ad.title}»")
 
     flash("Объявление удалено.", "success")
     return redirect(url_for("pavilion_page", pavilion_id=pavilion_id))
@@ -1111,7 +3572,7 @@ def delete_own_ad(ad_id):
 @login_required
 def edit_own_ad(ad_id):
     """Редактирование объявления самим мастером."""
-    ad = Ad.query.get_or_404(ad_id)
+    ad = get_live_or_404(Ad, ad_id)
     user_id = session.get("user_id")
     role = session.get("user_role")
 
@@ -1167,75 +3628,17 @@ def ad_messages():
 
     fio, group = get_student_info()
 
-    ads = Ad.query.filter_by(master_id=user_id).all()
-    if not ads:
-        recalc_unread_total()
-        html = render_template("ad_messages.html", items=[], fio=fio, group=group)
-        resp = make_response(html)
-        resp.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
-        resp.headers["Pragma"] = "no-cache"
-        resp.headers["Expires"] = "0"
-        return resp
-
-    ad_ids = [a.id for a in ads]
-    ad_map = {a.id: a for a in ads}
-
-    all_msgs = (
-        AdMessage.query.filter(AdMessage.ad_id.in_(ad_ids))
-        .order_by(AdMessage.created_at)
-        .all()
-    )
-
-    threads = {}
-    client_ids = set()
-
-    for m in all_msgs:
-        if m.sender_id == user_id and m.receiver_id != user_id:
-            client_id = m.receiver_id
-        elif m.receiver_id == user_id and m.sender_id != user_id:
-            client_id = m.sender_id
-        else:
-            continue
-
-        key = (m.ad_id, client_id)
-        if key not in threads:
-            threads[key] = {
-                "ad": ad_map.get(m.ad_id),
-                "client_id": client_id,
-                "unread_count": 0,
-                "last_time": m.created_at,
-            }
-        else:
-            if (
-                m.created_at
-                and threads[key]["last_time"]
-                and m.created_at > threads[key]["last_time"]
-            ):
-                threads[key]["last_time"] = m.created_at
-
-        if m.receiver_id == user_id and not m.is_read:
-            threads[key]["unread_count"] += 1
-
-        client_ids.add(client_id)
-
-    users = User.query.filter(User.id.in_(client_ids)).all() if client_ids else []
-    user_map = {u.id: u.username for u in users}
-
-    items = []
-    total_unread = 0
-    for (ad_id, client_id), data in threads.items():
-        data["client_name"] = user_map.get(client_id, f"ID {client_id}")
-        items.append(data)
-        total_unread += data["unread_count"]
+    archive = wants_archive()
+    if archive:
+        items = fetch_rows(ThreadRow, MASTER_THREADS_ARCHIVE, {"uid": user_id})
+    else:
+        items = fetch_rows(ThreadRow, MASTER_THREADS, {"uid": user_id})
+        # непрочитанные по живым объявлениям — заодно обновляем бейдж
+        header_badges().set("unread_total", sum(it.unread_count for it in items))
 
-    items.sort(
-        key=lambda x: x["last_time"] or datetime.min,
-        reverse=True,
+    html = render_template(
+        "ad_messages.html", items=items, archive=archive, fio=fio, group=group
     )
-
-    session["unread_total"] = total_unread
-
-    html = render_template("ad_messages.html", items=items, fio=fio, group=group)
     resp = make_response(html)
     resp.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
     resp.headers["Pragma"] = "no-cache"
@@ -1243,13 +3646,27 @@ def ad_messages():
     return resp
 
 
+def archived_chat(conds, include):
+    """Сообщения диалога из архива и их число; сами строки — только если include.
+
+    conds(m) строит условия диалога и для AdMessage, и для колонок архива.
+    """
+    arch = ARCHIVE_TABLES["ad_messages"]
+    if not include:
+        return [], archive_count(AdMessage, *conds(arch.c))
+    rows = db.session.execute(
+        select(arch).where(*conds(arch.c)).order_by(arch.c.created_at, arch.c.id)
+    ).all()
+    return rows, len(rows)
+
+
 @app.route("/ad/<int:ad_id>/chat", methods=["GET", "POST"])
 def ad_chat(ad_id):
     if "user_id" not in session:
         return redirect(url_for("login"))
 
     user_id = session["user_id"]
-    ad = Ad.query.get_or_404(ad_id)
+    ad = get_live_or_404(Ad, ad_id)
     master_id = ad.master_id
 
     if master_id is None:
@@ -1270,7 +3687,6 @@ def ad_chat(ad_id):
                 )
                 db.session.add(msg)
                 db.session.commit()
-                recalc_unread_total()
 
             return redirect(url_for("ad_chat", ad_id=ad.id))
 
@@ -1278,26 +3694,26 @@ def ad_chat(ad_id):
             ad_id=ad.id, receiver_id=user_id, is_read=False
         ).update({"is_read": True}, synchronize_session=False)
         db.session.commit()
-        recalc_unread_total()
-
-        messages = (
-            AdMessage.query.filter(
-                AdMessage.ad_id == ad.id,
-                or_(
-                    AdMessage.sender_id == user_id,
-                    AdMessage.receiver_id == user_id,
-                ),
-            )
-            .order_by(AdMessage.created_at)
-            .all()
-        )
 
-        if not messages:
+        def conds(m):
+            return [m.ad_id == ad.id, or_(m.sender_id == user_id, m.receiver_id == user_id)]
+
+        messages = AdMessage.query.filter(*conds(AdMessage)).order_by(AdMessage.created_at).all()
+        archived, archived_count = archived_chat(conds, wants_archive())
+
+        if not messages and not archived_count:
+            def conds(m):
+                return [m.ad_id == ad.id]
+
             messages = (
                 AdMessage.query.filter_by(ad_id=ad.id)
                 .order_by(AdMessage.created_at)
                 .all()
             )
+            archived, archived_count = archived_chat(conds, wants_archive())
+
+        # архивные сообщения всегда старше оставшихся в рабочей таблице
+        messages = archived + messages
 
         user_ids = {m.sender_id for m in messages} | {m.receiver_id for m in messages}
         users = User.query.filter(User.id.in_(user_ids)).all() if user_ids else []
@@ -1312,6 +3728,9 @@ def ad_chat(ad_id):
             users_map=users_map,
             current_user_id=user_id,
             master_id=master_id,
+            archive=wants_archive(),
+            archived_count=archived_count,
+            client_id=None,
             fio=fio,
             group=group,
         )
@@ -1325,6 +3744,12 @@ def ad_chat(ad_id):
             .order_by(AdMessage.created_at.desc())
             .first()
         )
+        if last_msg is None:
+            # вся переписка могла уехать в архив
+            arch = ARCHIVE_TABLES["ad_messages"]
+            last_msg = db.session.execute(
+                select(arch).where(arch.c.ad_id == ad.id).order_by(arch.c.created_at.desc()).limit(1)
+            ).first()
         if last_msg:
             if last_msg.sender_id != master_id:
                 client_id = last_msg.sender_id
@@ -1359,7 +3784,6 @@ def ad_chat(ad_id):
             )
             db.session.add(msg)
             db.session.commit()
-            recalc_unread_total()
 
         return redirect(url_for("ad_chat", ad_id=ad.id, client_id=client_id))
 
@@ -1370,17 +3794,17 @@ def ad_chat(ad_id):
         AdMessage.is_read.is_(False),
     ).update({"is_read": True}, synchronize_session=False)
     db.session.commit()
-    recalc_unread_total()
 
-    messages = (
-        AdMessage.query.filter(
-            AdMessage.ad_id == ad.id,
-            AdMessage.sender_id.in_(participants),
-            AdMessage.receiver_id.in_(participants),
-        )
-        .order_by(AdMessage.created_at)
-        .all()
-    )
+    def conds(m):
+        return [
+            m.ad_id == ad.id,
+            m.sender_id.in_(participants),
+            m.receiver_id.in_(participants),
+        ]
+
+    messages = AdMessage.query.filter(*conds(AdMessage)).order_by(AdMessage.created_at).all()
+    archived, archived_count = archived_chat(conds, wants_archive())
+    messages = archived + messages
 
     user_ids = {m.sender_id for m in messages} | {m.receiver_id for m in messages}
     users = User.query.filter(User.id.in_(user_ids)).all() if user_ids else []
@@ -1395,6 +3819,9 @@ def ad_chat(ad_id):
         users_map=users_map,
         current_user_id=user_id,
         master_id=master_id,
+        archive=wants_archive(),
+        archived_count=archived_count,
+        client_id=client_id,
         fio=fio,
         group=group,
     )
@@ -1417,67 +3844,14 @@ def user_messages():
 
     fio, group = get_student_info()
 
-    all_msgs = (
-        AdMessage.query.filter(
-            (AdMessage.sender_id == user_id) | (AdMessage.receiver_id == user_id)
-        )
-        .order_by(AdMessage.created_at)
-        .all()
+    archive = wants_archive()
+    items = fetch_rows(
+        ThreadRow, USER_THREADS_ARCHIVE if archive else USER_THREADS, {"uid": user_id}
     )
 
-    if not all_msgs:
-        items = []
-    else:
-        threads = {}
-        ad_ids = set()
-
-        for m in all_msgs:
-            ad_ids.add(m.ad_id)
-
-        ads = Ad.query.filter(Ad.id.in_(ad_ids)).all()
-        ad_map = {a.id: a for a in ads}
-
-        for m in all_msgs:
-            ad = ad_map.get(m.ad_id)
-            if not ad or not ad.master_id:
-                continue
-
-            master_id = ad.master_id
-            key = (m.ad_id, master_id)
-
-            if key not in threads:
-                threads[key] = {
-                    "ad": ad,
-                    "master_id": master_id,
-                    "unread_count": 0,
-                    "last_time": m.created_at,
-                }
-            else:
-                if (
-                    m.created_at
-                    and threads[key]["last_time"]
-                    and m.created_at > threads[key]["last_time"]
-                ):
-                    threads[key]["last_time"] = m.created_at
-
-            if m.receiver_id == user_id and not m.is_read:
-                threads[key]["unread_count"] += 1
-
-        master_ids = {data["master_id"] for data in threads.values()}
-        users = User.query.filter(User.id.in_(master_ids)).all() if master_ids else []
-        master_map = {u.id: u.username for u in users}
-
-        items = []
-        for (ad_id, master_id), data in threads.items():
-            data["master_name"] = master_map.get(master_id, f"ID {master_id}")
-            items.append(data)
-
-        items.sort(
-            key=lambda x: x["last_time"] or datetime.min,
-            reverse=True,
-        )
-
-    return render_template("user_messages.html", items=items, fio=fio, group=group)
+    return render_template(
+        "user_messages.html", items=items, archive=archive, fio=fio, group=group
+    )
 
 
 # ===== ЗАЯВКА НА НОВЫЙ ПАВИЛЬОН =====
@@ -1530,7 +3904,7 @@ def pavilion_request(street_id):
             db.session.add(req)
             db.session.commit()
 
-            recalc_admin_counters()
+            bump_admin_counter("pavilion", 1)
             flash(
                 "Заявка на павильон и первое объявление отправлена администратору.",
                 "success",
@@ -1556,29 +3930,13 @@ def admin_approve_pavilion_request(req_id):
         flash("Эта заявка уже обработана.", "error")
         return redirect(url_for("admin_ad_requests"))
 
-    pav = Pavilion(
-        title=req.pavilion_title,
-        description=req.pavilion_desc,
-        street_id=req.street_id,
-    )
-    db.session.add(pav)
-    db.session.flush()
-
-    ad = Ad(
-        title=req.ad_title,
-        text=req.ad_text,
-        author_name=req.user.username,
-        pavilion_id=pav.id,
-        master_id=req.user_id,
-    )
-    db.session.add(ad)
-
-    req.status = "approved"
-    db.session.commit()
+    item = moderate_requests("pavilion", "approve", ids=[req.id])[0]
+    if item["result"] != "approved":
+        flash(f"Не удалось одобрить: {item['message']}.", "error")
+        return redirect(url_for("admin_ad_requests"))
 
-    recalc_admin_counters()
     flash("Павильон создан, объявление опубликовано.", "success")
-    return redirect(url_for("pavilion_page", pavilion_id=pav.id))
+    return redirect(url_for("pavilion_page", pavilion_id=item["pavilion_id"]))
 
 
 @app.route("/admin/pavilion-requests/<int:req_id>/reject", methods=["POST"])
@@ -1591,7 +3949,7 @@ def admin_reject_pavilion_request(req_id):
     else:
         req.status = "rejected"
         db.session.commit()
-        recalc_admin_counters()
+        bump_admin_counter("pavilion", -1)
         flash("Заявка на павильон отклонена.", "info")
 
     return redirect(url_for("admin_ad_requests"))
@@ -1605,26 +3963,23 @@ def admin_reject_pavilion_request(req_id):
 def admin_ad_requests():
     fio, group = get_student_info()
 
-    ad_requests = AdRequest.query.order_by(AdRequest.created_at.desc()).all()
-    pav_requests = PavilionRequest.query.order_by(
-        PavilionRequest.created_at.desc()
-    ).all()
+    archive = wants_archive()
+    ad_stmt, ad_id, ad_cols = list_source(AdRequest, AD_REQUEST_ROWS, archive)
+    pav_stmt, pav_id, pav_cols = list_source(PavilionRequest, PAVILION_REQUEST_ROWS, archive)
 
-    stats_ads = {
-        "total": len(ad_requests),
-        "pending": sum(1 for r in ad_requests if r.status == "pending"),
-        "approved": sum(1 for r in ad_requests if r.status == "approved"),
-        "rejected": sum(1 for r in ad_requests if r.status == "rejected"),
-    }
+    ad_requests = iter_keyset(ad_stmt, ad_id, AdRequestRow, desc=True)
+    pav_requests = iter_keyset(pav_stmt, pav_id, PavilionRequestRow, desc=True)
 
+    stats_ads = {"pending": 0, "approved": 0, "rejected": 0, **count_by_status(ad_cols)}
     stats_pav = {
-        "total": len(pav_requests),
-        "pending": sum(1 for r in pav_requests if r.status == "pending"),
-        "approved": sum(1 for r in pav_requests if r.status == "approved"),
-        "rejected": sum(1 for r in pav_requests if r.status == "rejected"),
+        "pending": 0, "approved": 0, "rejected": 0, **count_by_status(pav_cols)
     }
+    if archive:
+        archived = stats_ads["total"] + stats_pav["total"]
+    else:
+        archived = archive_count(AdRequest) + archive_count(PavilionRequest)
 
-    return render_template(
+    return stream_page(
         "admin_ad_requests.html",
         fio=fio,
         group=group,
@@ -1632,6 +3987,8 @@ def admin_ad_requests():
         pav_requests=pav_requests,
         stats_ads=stats_ads,
         stats_pav=stats_pav,
+        archive=archive,
+        archived=archived,
     )
 
 
@@ -1644,21 +4001,13 @@ def admin_approve_ad_request(req_id):
         flash("Эта заявка уже обработана.", "error")
         return redirect(url_for("admin_ad_requests"))
 
-    ad = Ad(
-        title=req.title,
-        text=req.text,
-        author_name=req.user.username,
-        pavilion_id=req.pavilion_id,
-        master_id=req.user_id,
-    )
-    db.session.add(ad)
-
-    req.status = "approved"
-    db.session.commit()
+    item = moderate_requests("ad", "approve", ids=[req.id])[0]
+    if item["result"] != "approved":
+        flash(f"Не удалось одобрить: {item['message']}.", "error")
+        return redirect(url_for("admin_ad_requests"))
 
-    recalc_admin_counters()
     flash("Объявление опубликовано.", "success")
-    return redirect(url_for("pavilion_page", pavilion_id=req.pavilion_id))
+    return redirect(url_for("pavilion_page", pavilion_id=item["pavilion_id"]))
 
 
 @app.route("/admin/ad-requests/<int:req_id>/reject", methods=["POST"])
@@ -1671,12 +4020,1817 @@ def admin_reject_ad_request(req_id):
     else:
         req.status = "rejected"
         db.session.commit()
-        recalc_admin_counters()
+        bump_admin_counter("ad", -1)
         flash("Заявка на объявление отклонена.", "info")
 
     return redirect(url_for("admin_ad_requests"))
 
 
+# ===== НАЗНАЧЕНИЕ МАСТЕРОВ =====
+
+# веса нагрузки: объявление, открытый диалог, непрочитанное сообщение
+LOAD_WEIGHT_AD = 1.0
+LOAD_WEIGHT_THREAD = 3.0
+LOAD_WEIGHT_UNREAD = 0.5
+# насколько сильно опыт в павильоне/на улице перевешивает нагрузку
+EXPERTISE_BONUS_PAVILION = 4.0
+EXPERTISE_BONUS_STREET = 1.5
+
+ASSIGN_STRATEGIES = ("load", "expertise")
+ASSIGN_SCOPES = ("unassigned", "rebalance")
+
+MASTER_WORKLOAD_SQL = """
+WITH threads AS (
+    SELECT a.master_id AS master_id,
+           m.ad_id AS ad_id,
+           CASE WHEN m.sender_id = a.master_id
+                THEN m.receiver_id ELSE m.sender_id END AS client_id,
+           MAX(m.id) AS last_id
+    FROM ad_messages m
+    JOIN ads a ON a.id = m.ad_id
+    WHERE a.master_id IS NOT NULL AND a.deleted_at IS NULL
+    GROUP BY 1, 2, 3
+)
+SELECT u.id AS master_id,
+       u.username AS username,
+       (SELECT COUNT(*) FROM ads
+         WHERE ads.master_id = u.id AND ads.deleted_at IS NULL) AS ads,
+       (SELECT COUNT(*) FROM threads t
+          JOIN ad_messages lm ON lm.id = t.last_id
+         WHERE t.master_id = u.id AND lm.sender_id != u.id) AS open_threads,
+       (SELECT COUNT(*) FROM ad_messages am
+         WHERE am.receiver_id = u.id AND am.is_read = 0) AS unread
+FROM users u
+WHERE u.role = 'master' AND u.deleted_at IS NULL
+ORDER BY u.id
+"""
+
+# объявления без живого мастера (NULL или мастер удалён/сменил роль)
+UNASSIGNED_ADS_SQL = """
+SELECT a.id, a.pavilion_id, p.street_id
+FROM ads a
+JOIN pavilions p ON p.id = a.pavilion_id
+WHERE a.deleted_at IS NULL AND p.deleted_at IS NULL
+  AND (a.master_id IS NULL
+       OR a.master_id NOT IN (SELECT id FROM users
+                              WHERE role = 'master' AND deleted_at IS NULL))
+ORDER BY a.id
+"""
+
+# объявления без переписки — их можно переназначать, не ломая диалоги
+MOVABLE_ADS_SQL = """
+SELECT a.id, a.pavilion_id, p.street_id, a.master_id
+FROM ads a
+JOIN pavilions p ON p.id = a.pavilion_id
+WHERE a.deleted_at IS NULL AND p.deleted_at IS NULL
+  AND NOT EXISTS (SELECT 1 FROM ad_messages m WHERE m.ad_id = a.id)
+ORDER BY a.id
+"""
+
+EXPERTISE_SQL = """
+SELECT a.master_id, a.pavilion_id, p.street_id, COUNT(*) AS cnt
+FROM ads a
+JOIN pavilions p ON p.id = a.pavilion_id
+WHERE a.deleted_at IS NULL
+  AND a.master_id IN (SELECT id FROM users WHERE role = 'master' AND deleted_at IS NULL)
+GROUP BY 1, 2, 3
+"""
+
+
+def master_workload():
+    """Нагрузка мастеров одним запросом: объявления, открытые диалоги, непрочитанные."""
+    rows = db.session.execute(text(MASTER_WORKLOAD_SQL)).mappings().all()
+    result = []
+    for r in rows:
+        item = dict(r)
+        item["load"] = (
+            item["ads"] * LOAD_WEIGHT_AD
+            + item["open_threads"] * LOAD_WEIGHT_THREAD
+            + item["unread"] * LOAD_WEIGHT_UNREAD
+        )
+        result.append(item)
+    return result
+
+
+def plan_master_assignment(strategy="load", scope="unassigned"):
+    """План распределения объявлений: [(ad_id, master_id)] и отчёт по мастерам.
+
+    Нагрузка и опыт считаются в SQL, в Python остаётся только жадный выбор
+    наименее загруженного мастера для каждого объявления.
+    """
+    if strategy not in ASSIGN_STRATEGIES:
+        raise ValueError(f"неизвестная стратегия: {strategy}")
+    if scope not in ASSIGN_SCOPES:
+        raise ValueError(f"неизвестный режим: {scope}")
+
+    masters = master_workload()
+    report = {
+        "strategy": strategy,
+        "scope": scope,
+        "masters": [],
+        "plan": [],
+        "changed": 0,
+    }
+    if not masters:
+        return report
+
+    load = {m["master_id"]: m["load"] for m in masters}
+    new_ads = {m["master_id"]: 0 for m in masters}
+
+    if scope == "unassigned":
+        targets = [
+            (ad_id, pav_id, street_id, None)
+            for ad_id, pav_id, street_id in db.session.execute(text(UNASSIGNED_ADS_SQL))
+        ]
+    else:
+        targets = list(db.session.execute(text(MOVABLE_ADS_SQL)))
+        # переносимые объявления снимаем с текущей нагрузки
+        for _, _, _, master_id in targets:
+            if master_id in load:
+                load[master_id] -= LOAD_WEIGHT_AD
+
+    pav_exp = {}
+    street_exp = {}
+    if strategy == "expertise":
+        for master_id, pav_id, street_id, cnt in db.session.execute(text(EXPERTISE_SQL)):
+            pav_exp.setdefault(pav_id, {})[master_id] = cnt
+            street_exp.setdefault(street_id, {})
+            street_exp[street_id][master_id] = street_exp[street_id].get(master_id, 0) + cnt
+
+    for ad_id, pav_id, street_id, old_master in targets:
+        # для стратегии load словари опыта пустые и остаётся чистая нагрузка
+        by_pav = pav_exp.get(pav_id, {})
+        by_street = street_exp.get(street_id, {})
+
+        def score(mid):
+            return (
+                load[mid]
+                - EXPERTISE_BONUS_PAVILION * min(by_pav.get(mid, 0), 3)
+                - EXPERTISE_BONUS_STREET * min(by_street.get(mid, 0), 3),
+                mid,
+            )
+
+        best = min(load, key=score)
+        load[best] += LOAD_WEIGHT_AD
+        new_ads[best] += 1
+        report["plan"].append((ad_id, best))
+        if best != old_master:
+            report["changed"] += 1
+
+    for m in masters:
+        mid = m["master_id"]
+        report["masters"].append(
+            {
+                "master_id": mid,
+                "username": m["username"],
+                "ads": m["ads"],
+                "open_threads": m["open_threads"],
+                "unread": m["unread"],
+                "load_before": m["load"],
+                "assigned": new_ads[mid],
+                "load_after": load[mid],
+            }
+        )
+    report["masters"].sort(key=lambda x: x["load_after"], reverse=True)
+    return report
+
+
+def apply_master_assignment(plan):
+    """Применение плана одним UPDATE ... FROM через временную таблицу."""
+    if not plan:
+        return 0
+
+    db.session.execute(
+        text(
+            "CREATE TEMP TABLE IF NOT EXISTS tmp_assign ("
+            "ad_id INTEGER PRIMARY KEY, master_id INTEGER NOT NULL)"
+        )
+    )
+    db.session.execute(text("DELETE FROM tmp_assign"))
+    db.session.execute(
+        text("INSERT INTO tmp_assign (ad_id, master_id) VALUES (:ad_id, :master_id)"),
+        [{"ad_id": ad_id, "master_id": master_id} for ad_id, master_id in plan],
+    )
+    # author_name совпадает с логином, как и в карточке объявления
+    result = db.session.execute(
+        text(
+            "UPDATE ads SET master_id = t.master_id, author_name = u.username "
+            "FROM tmp_assign t JOIN users u ON u.id = t.master_id "
+            "WHERE ads.id = t.ad_id"
+        )
+    )
+    db.session.execute(text("DROP TABLE tmp_assign"))
+    record_changes("ads", [ad_id for ad_id, _ in plan])
+    db.session.commit()
+    return result.rowcount
+
+
+@job_handler("assign_masters", max_attempts=3)
+def assign_masters_job(payload, job_id=None):
+    report = plan_master_assignment(payload["strategy"], payload["scope"])
+    apply_master_assignment(report["plan"])
+
+
+@app.route("/admin/masters/assign", methods=["GET", "POST"])
+@admin_required
+def admin_assign_masters():
+    """Распределение объявлений между мастерами: предпросмотр и применение."""
+    source = request.form if request.method == "POST" else request.args
+    strategy = source.get("strategy", "load")
+    scope = source.get("scope", "unassigned")
+    if strategy not in ASSIGN_STRATEGIES:
+        strategy = "load"
+    if scope not in ASSIGN_SCOPES:
+        scope = "unassigned"
+
+    if request.method == "POST":
+        # план пересчитается в воркере на актуальных данных
+        enqueue_job(
+            "assign_masters",
+            {"strategy": strategy, "scope": scope},
+            unique_key="assign_masters",
+        )
+        flash("Распределение запущено в фоне, обновите страницу через пару секунд.", "success")
+        return redirect(url_for("admin_assign_masters", strategy=strategy, scope=scope))
+
+    report = plan_master_assignment(strategy, scope)
+
+    fio, group = get_student_info()
+    return render_template(
+        "admin_assign_masters.html",
+        fio=fio,
+        group=group,
+        report=report,
+        strategies=ASSIGN_STRATEGIES,
+        scopes=ASSIGN_SCOPES,
+    )
+
+
+# ===== JSON API v1 (только чтение) =====
+
+API_DEFAULT_LIMIT = 20
+API_MAX_LIMIT = 100
+
+
+def _count_subquery(count_col, *where):
+    return select(db.func.count(count_col)).where(*where).scalar_subquery()
+
+
+# ресурс → доступные поля (колонки или подзапросы-счётчики), условия и фильтры
+API_RESOURCES = {
+    "streets": {
+        "id": Street.id,
+        "fields": {
+            "id": Street.id,
+            "name": Street.name,
+            "code": Street.code,
+            "pavilions_count": _count_subquery(
+                Pavilion.id, Pavilion.street_id == Street.id, Pavilion.deleted_at.is_(None)
+            ),
+        },
+        "default": ["id", "name", "code", "pavilions_count"],
+        "where": [],
+        "filters": {"code": Street.code},
+    },
+    "pavilions": {
+        "id": Pavilion.id,
+        "fields": {
+            "id": Pavilion.id,
+            "title": Pavilion.title,
+            "description": Pavilion.description,
+            "street_id": Pavilion.street_id,
+            "ads_count": _count_subquery(
+                Ad.id, Ad.pavilion_id == Pavilion.id, Ad.deleted_at.is_(None)
+            ),
+        },
+        "default": ["id", "title", "street_id", "ads_count"],
+        "where": [Pavilion.deleted_at.is_(None)],
+        "filters": {"street_id": Pavilion.street_id},
+    },
+    "ads": {
+        "id": Ad.id,
+        "fields": {
+            "id": Ad.id,
+            "title": Ad.title,
+            "text": Ad.text,
+            "author_name": Ad.author_name,
+            "pavilion_id": Ad.pavilion_id,
+            "master_id": Ad.master_id,
+        },
+        "default": ["id", "title", "author_name", "pavilion_id", "master_id"],
+        "where": [Ad.deleted_at.is_(None)],
+        "filters": {"pavilion_id": Ad.pavilion_id, "master_id": Ad.master_id},
+    },
+    # публичный профиль мастера: без e-mail и пароля
+    "masters": {
+        "id": User.id,
+        "fields": {
+            "id": User.id,
+            "username": User.username,
+            "full_name": User.full_name,
+            "avatar_filename": User.avatar_filename,
+            "ads_count": _count_subquery(
+                Ad.id, Ad.master_id == User.id, Ad.deleted_at.is_(None)
+            ),
+        },
+        "default": ["id", "username", "full_name", "avatar_filename", "ads_count"],
+        "where": [User.role == "master", User.deleted_at.is_(None)],
+        "filters": {},
+    },
+}
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+@app.errorhandler(ApiError)
+def handle_api_error(e):
+    return jsonify({"error": str(e)}), e.status
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} не сериализуется в JSON")
+
+
+def encode_cursor(last_id):
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        return int(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (ValueError, UnicodeDecodeError):
+        raise ApiError("некорректный cursor")
+
+
+def api_response(payload):
+    """JSON-ответ с ETag: если у клиента та же версия — 304 без тела."""
+    body = json.dumps(
+        payload, ensure_ascii=False, separators=(",", ":"), default=_json_default
+    ).encode("utf-8")
+    etag = hashlib.sha1(body).hexdigest()
+
+    # сравнение слабое, как требует If-None-Match: сжатие делает ETag слабым (W/"…")
+    if request.if_none_match.contains_weak(etag):
+        resp = make_response("", 304)
+    else:
+        resp = make_response(body)
+        resp.mimetype = "application/json"
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+
+def _resource_select(resource, names):
+    spec = API_RESOURCES[resource]
+    # id нужен для курсора, в ответ попадёт только если его просили
+    cols = [spec["fields"][n].label(n) for n in names]
+    if "id" not in names:
+        cols.append(spec["id"].label("id"))
+    return select(*cols).where(*spec["where"])
+
+
+def _api_select(resource):
+    """SELECT только запрошенных полей (fields=a,b,c)."""
+    spec = API_RESOURCES[resource]
+    raw = request.args.get("fields")
+    names = [f.strip() for f in raw.split(",") if f.strip()] if raw else spec["default"]
+
+    unknown = [n for n in names if n not in spec["fields"]]
+    if unknown:
+        raise ApiError(
+            "неизвестные поля: " + ", ".join(unknown)
+            + "; доступны: " + ", ".join(spec["fields"])
+        )
+    return _resource_select(resource, names), names
+
+
+def _rows_to_dicts(rows, names):
+    return [{n: row[n] for n in names} for row in rows]
+
+
+def api_list(resource):
+    spec = API_RESOURCES[resource]
+    stmt, names = _api_select(resource)
+
+    for name, col in spec["filters"].items():
+        value = request.args.get(name)
+        if value is not None:
+            stmt = stmt.where(col == value)
+
+    try:
+        limit = int(request.args.get("limit", API_DEFAULT_LIMIT))
+    except ValueError:
+        raise ApiError("limit должен быть числом")
+    limit = max(1, min(limit, API_MAX_LIMIT))
+
+    cursor = request.args.get("cursor")
+    if cursor:
+        stmt = stmt.where(spec["id"] > decode_cursor(cursor))
+
+    # берём на одну строку больше, чтобы понять, есть ли следующая страница
+    rows = db.session.execute(stmt.order_by(spec["id"]).limit(limit + 1)).mappings().all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]["id"])
+
+    return api_response({"data": _rows_to_dicts(rows, names), "next_cursor": next_cursor})
+
+
+def api_detail(resource, obj_id):
+    spec = API_RESOURCES[resource]
+    stmt, names = _api_select(resource)
+    row = db.session.execute(stmt.where(spec["id"] == obj_id)).mappings().first()
+    if row is None:
+        raise ApiError("не найдено", status=404)
+    return api_response({"data": _rows_to_dicts([row], names)[0]})
+
+
+@app.route("/api/v1/changes")
+def api_v1_changes():
+    """Дельта-синхронизация.
+
+    Без since возвращает только текущий токен: клиент сначала выгружает
+    списки, потом ходит сюда с этим токеном. В ответе — актуальные строки
+    изменённых объектов и id удалённых; каждый объект не больше одного раза.
+    """
+    latest = db.session.execute(select(db.func.max(ChangeLog.id))).scalar() or 0
+    since = request.args.get("since")
+    if since is None:
+        return api_response({"next": encode_cursor(latest), "has_more": False})
+
+    since = decode_cursor(since)
+    if since < change_log_horizon():
+        raise ApiError("токен устарел, нужна полная синхронизация", status=410)
+
+    try:
+        limit = int(request.args.get("limit", API_MAX_LIMIT))
+    except ValueError:
+        raise ApiError("limit должен быть числом")
+    limit = max(1, min(limit, API_MAX_LIMIT * 5))
+
+    last_id = db.func.max(ChangeLog.id).label("last_id")
+    changed = db.session.execute(
+        select(ChangeLog.entity, ChangeLog.entity_id, last_id)
+        .where(ChangeLog.id > since)
+        .group_by(ChangeLog.entity, ChangeLog.entity_id)
+        .order_by(last_id)
+        .limit(limit + 1)
+    ).all()
+    has_more = len(changed) > limit
+    changed = changed[:limit]
+
+    ids_by_entity = {}
+    for entity, entity_id, _ in changed:
+        ids_by_entity.setdefault(entity, []).append(entity_id)
+
+    changes, deleted = {}, {}
+    for entity, ids in ids_by_entity.items():
+        spec = API_RESOURCES[entity]
+        rows = db.session.execute(
+            _resource_select(entity, spec["default"]).where(spec["id"].in_(ids))
+        ).mappings().all()
+        if rows:
+            changes[entity] = _rows_to_dicts(rows, spec["default"])
+        # нет живой строки — значит объект удалён (мягко или насовсем)
+        alive = {row["id"] for row in rows}
+        gone = [i for i in ids if i not in alive]
+        if gone:
+            deleted[entity] = gone
+
+    next_token = changed[-1].last_id if changed else max(since, latest)
+    return api_response(
+        {
+            "changes": changes,
+            "deleted": deleted,
+            "next": encode_cursor(next_token),
+            "has_more": has_more,
+        }
+    )
+
+
+@app.route("/api/v1/<resource>")
+def api_v1_list(resource):
+    if resource not in API_RESOURCES:
+        raise ApiError("неизвестный ресурс", status=404)
+    return api_list(resource)
+
+
+@app.route("/api/v1/<resource>/<int:obj_id>")
+def api_v1_detail(resource, obj_id):
+    if resource not in API_RESOURCES:
+        raise ApiError("неизвестный ресурс", status=404)
+    return api_detail(resource, obj_id)
+
+
+# ===== СЖАТИЕ ОТВЕТОВ =====
+
+app.config.setdefault("COMPRESS_MIN_SIZE", 1024)
+app.config.setdefault("COMPRESS_GZIP_LEVEL", 6)
+app.config.setdefault("COMPRESS_BROTLI_QUALITY", 4)
+app.config.setdefault("COMPRESS_MIMETYPES", None)  # None — набор по умолчанию
+# выгрузки большие и потоковые — сжимаем быстрее, а не сильнее
+app.config.setdefault(
+    "COMPRESS_LEVELS",
+    {"text/csv": {"gzip": 1, "br": 1}, "application/x-ndjson": {"gzip": 1, "br": 1}},
+)
+
+compression = CompressionMiddleware(
+    app.wsgi_app,
+    min_size=app.config["COMPRESS_MIN_SIZE"],
+    gzip_level=app.config["COMPRESS_GZIP_LEVEL"],
+    brotli_quality=app.config["COMPRESS_BROTLI_QUALITY"],
+    mimetypes=app.config["COMPRESS_MIMETYPES"],
+    levels=app.config["COMPRESS_LEVELS"],
+)
+app.wsgi_app = compression
+
+
+@app.route("/admin/compression", methods=["GET", "POST"])
+@admin_required
+def admin_compression():
+    """Сколько сжатие экономит трафика и сколько стоит CPU (по этому воркеру)."""
+    if request.method == "POST":
+        compression.reset_stats()
+        flash("Статистика сжатия сброшена.", "success")
+        return redirect(url_for("admin_compression"))
+
+    fio, group = get_student_info()
+    rows = compression.stats()
+    totals = {
+        "responses": sum(r["responses"] for r in rows),
+        "bytes_in": sum(r["bytes_in"] for r in rows),
+        "bytes_out": sum(r["bytes_out"] for r in rows),
+        "cpu_ms": sum(r["cpu_ms"] for r in rows),
+    }
+    totals["ratio"] = totals["bytes_in"] / totals["bytes_out"] if totals["bytes_out"] else 0.0
+    return render_template(
+        "admin_compression.html",
+        fio=fio,
+        group=group,
+        rows=rows,
+        totals=totals,
+        worker=f"{socket.gethostname()}:{os.getpid()}",
+    )
+
+
+# ===== МЕТРИКИ =====
+# /metrics в формате Prometheus; значения всех воркеров машины складываются
+# через файлы в METRICS_DIR (см. metrics.py)
+
+METRICS_DIR = os.environ.get("METRICS_DIR", os.path.join(BASE_DIR, "cache", "metrics"))
+app.config.setdefault("METRICS_FLUSH_INTERVAL", 1.0)
+# без входа /metrics отдаётся только с этой машины и не через прокси
+METRICS_LOCAL_ADDRS = {"127.0.0.1", "::1"}
+
+metrics = Registry(METRICS_DIR, flush_interval=app.config["METRICS_FLUSH_INTERVAL"])
+# снаружи сжатия: размер ответа — то, что ушло клиенту
+app.wsgi_app = MetricsMiddleware(app.wsgi_app, metrics, prefix="fair")
+
+SQL_DURATION = metrics.histogram(
+    "fair_sql_duration_seconds",
+    "Время SQL-запросов по источнику (эндпоинт, job:вид, <script>) и типу",
+    ("source", "op"),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0),
+)
+SQL_PER_REQUEST = metrics.histogram(
+    "fair_sql_queries_per_request",
+    "Сколько SQL-запросов делает один HTTP-запрос",
+    ("endpoint",),
+    buckets=(1, 2, 3, 5, 10, 20, 50, 100, 250, 1000),
+)
+SESSION_SIZE = metrics.histogram(
+    "fair_session_size_bytes",
+    "Размер cookie сессии",
+    buckets=(64, 128, 256, 512, 1024, 2048, 3072, 4096),
+)
+DB_LOCK_ERRORS = metrics.counter(
+    "fair_db_lock_errors_total",
+    "Запросы, не дождавшиеся блокировки SQLite (database is locked)",
+    ("source",),
+)
+DB_LOCK_RETRIES = metrics.counter(
+    "fair_db_lock_retries_total",
+    "Фоновые задачи, отложенные на повтор из-за блокировки SQLite",
+    ("kind",),
+)
+CACHE_EVENTS = metrics.counter(
+    "fair_cache_events_total", "Обращения к общему кэшу по исходу", ("event",)
+)
+CACHE_LOCAL_ENTRIES = metrics.gauge(
+    "fair_cache_local_entries", "Записей в локальном LRU воркеров"
+)
+
+SQL_OPS = {"SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "PRAGMA"}
+
+
+def sql_op(statement):
+    words = statement.split(None, 1)
+    op = words[0].upper() if words else ""
+    return op if op in SQL_OPS else "OTHER"
+
+
+def metrics_source():
+    """Откуда пришёл запрос к базе: эндпоинт, фоновая задача или скрипт."""
+    if has_request_context():
+        return request.endpoint or "<unmatched>"
+    if has_app_context() and g.get("job_kind"):
+        return f"job:{g.job_kind}"
+    return "<script>"
+
+
+def is_lock_error(exc):
+    orig = getattr(exc, "orig", exc)
+    return isinstance(orig, sqlite3.OperationalError) and "locked" in str(orig)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _sql_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("sql_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _sql_finished(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["sql_started"].pop()
+    SQL_DURATION.observe(elapsed, source=metrics_source(), op=sql_op(statement))
+    if has_request_context():
+        # в environ, а не в g: потоковая страница отдаёт тело уже в другом контексте
+        environ = request.environ
+        environ["fair.sql_queries"] = environ.get("fair.sql_queries", 0) + 1
+    if elapsed >= app.config["SLOW_QUERY_THRESHOLD"]:
+        record_slow_query(conn, statement, parameters, executemany, elapsed)
+
+
+@event.listens_for(Engine, "handle_error")
+def _sql_failed(ctx):
+    # handle_error приходит и на ошибки вне execute (connect) — тогда таймера нет
+    if ctx.connection is not None:
+        started = ctx.connection.info.get("sql_started")
+        if started:
+            started.pop()
+    if is_lock_error(ctx.original_exception):
+        DB_LOCK_ERRORS.inc(source=metrics_source())
+
+
+@app.after_request
+def observe_sql_per_request(resp):
+    environ = request.environ
+    endpoint = request.endpoint or "<unmatched>"
+    # потоковые страницы ходят в базу, пока отдают тело, — считаем при закрытии ответа
+    resp.call_on_close(
+        lambda: SQL_PER_REQUEST.observe(environ.get("fair.sql_queries", 0), endpoint=endpoint)
+    )
+    return resp
+
+
+class MeteredSessionInterface(SecureCookieSessionInterface):
+    """Обычная подписанная cookie плюс замер её размера."""
+
+    def save_session(self, app, session, response):
+        super().save_session(app, session, response)
+        name = self.get_cookie_name(app)
+        size = len(request.cookies.get(name, ""))
+        for header in response.headers.getlist("Set-Cookie"):
+            if header.startswith(name + "="):
+                size = len(header.split(";", 1)[0]) - len(name) - 1
+        if size:
+            SESSION_SIZE.observe(size)
+
+
+app.session_interface = MeteredSessionInterface()
+
+
+@metrics.add_collector
+def collect_cache_stats():
+    stats = cache.stats()
+    for event_name in CACHE_STAT_NAMES:
+        CACHE_EVENTS.set(stats[event_name], event=event_name)
+    CACHE_LOCAL_ENTRIES.set(stats["local_entries"])
+
+
+@app.route("/metrics")
+def prometheus_metrics():
+    """Для Prometheus с этой же машины или для администратора."""
+    local = (
+        request.remote_addr in METRICS_LOCAL_ADDRS
+        and "X-Forwarded-For" not in request.headers
+    )
+    if not local and session.get("user_role") != "admin":
+        abort(403)
+    resp = make_response(metrics.render())
+    resp.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+
+# ===== МЕДЛЕННЫЕ ЗАПРОСЫ =====
+# Запросы дольше SLOW_QUERY_THRESHOLD секунд попадают в кольцевой буфер воркера
+# вместе с параметрами, местом вызова и планом (EXPLAIN QUERY PLAN на том же
+# соединении). Админка группирует их по отпечатку — тексту запроса без значений.
+
+app.config.setdefault("SLOW_QUERY_THRESHOLD", 0.1)
+app.config.setdefault("SLOW_QUERY_BUFFER", 500)
+app.config.setdefault("SLOW_QUERY_EXPLAIN", True)
+
+SLOW_PARAM_LIMIT = 200  # символов на значение параметра
+SLOW_STATEMENT_LIMIT = 8000
+SLOW_CALLER_DEPTH = 3  # сколько функций app.py показывать в цепочке вызова
+SLOW_EXPLAINABLE = {"SELECT", "INSERT", "UPDATE", "DELETE", "WITH"}
+# служебные функции записи — в цепочке вызова их не показываем
+SLOW_HOOK_FUNCTIONS = {"_sql_finished", "record_slow_query", "_slow_caller"}
+
+slow_queries = deque(maxlen=app.config["SLOW_QUERY_BUFFER"])
+_slow_queries_lock = threading.Lock()
+
+SLOW_QUERIES_TOTAL = metrics.counter(
+    "fair_sql_slow_queries_total", "SQL-запросы дольше SLOW_QUERY_THRESHOLD", ("source",)
+)
+
+_FP_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_FP_NUMBERS = re.compile(r"\b\d+(?:\.\d+)?\b")
+_FP_SPACES = re.compile(r"\s+")
+_FP_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+
+def query_fingerprint(statement):
+    """Текст запроса без значений: строки и числа → ?, списки IN (?, ?, ...) → (...)."""
+    fp = _FP_STRINGS.sub("?", statement)
+    fp = _FP_NUMBERS.sub("?", fp)
+    fp = _FP_SPACES.sub(" ", fp).strip()
+    return _FP_LISTS.sub("(...)", fp)
+
+
+def _slow_params(statement, parameters, executemany):
+    extra = 0
+    if executemany:
+        extra = len(parameters) - 1
+        parameters = parameters[0] if parameters else ()
+    if "password" in statement.lower():
+        return "скрыты: в запросе есть пароль"
+    values = parameters.values() if isinstance(parameters, dict) else parameters
+    shown = []
+    for value in values or ():
+        value = repr(value)
+        if len(value) > SLOW_PARAM_LIMIT:
+            value = value[:SLOW_PARAM_LIMIT] + "…"
+        shown.append(value)
+    result = ", ".join(shown)
+    if extra > 0:
+        result += f" (и ещё {extra} наборов)"
+    return result
+
+
+def _slow_caller():
+    """Цепочка функций app.py, из которых пришёл запрос: помощник ← view."""
+    chain = []
+    frame = sys._getframe(1)
+    while frame is not None and len(chain) < SLOW_CALLER_DEPTH:
+        code = frame.f_code
+        if code.co_filename == __file__ and code.co_name not in SLOW_HOOK_FUNCTIONS:
+            chain.append(f"{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return " ← ".join(chain)
+
+
+def explain_plan(conn, statement, parameters):
+    """EXPLAIN QUERY PLAN на том же соединении, строки с отступами по вложенности."""
+    cur = conn.connection.driver_connection.cursor()
+    try:
+        rows = cur.execute("EXPLAIN QUERY PLAN " + statement, parameters).fetchall()
+    finally:
+        cur.close()
+    depth = {0: -1}
+    lines = []
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, -1) + 1
+        lines.append("  " * depth[node_id] + detail)
+    return lines
+
+
+def record_slow_query(conn, statement, parameters, executemany, elapsed):
+    # ошибка здесь не должна ронять сам запрос
+    try:
+        source = metrics_source()
+        plan = []
+        if app.config["SLOW_QUERY_EXPLAIN"] and sql_op(statement) in SLOW_EXPLAINABLE:
+            first = parameters[0] if executemany and parameters else parameters
+            try:
+                plan = explain_plan(conn, statement, first)
+            except sqlite3.Error as e:
+                plan = [f"план не получен: {e}"]
+        fingerprint = query_fingerprint(statement)
+        entry = {
+            "at": datetime.utcnow(),
+            "duration": elapsed,
+            "fp_id": hashlib.sha1(fingerprint.encode()).hexdigest()[:12],
+            "fingerprint": fingerprint,
+            "statement": statement[:SLOW_STATEMENT_LIMIT],
+            "params": _slow_params(statement, parameters, executemany),
+            "source": source,
+            "path": f"{request.method} {request.full_path.rstrip('?')}" if has_request_context() else None,
+            "caller": _slow_caller(),
+            "plan": plan,
+        }
+        with _slow_queries_lock:
+            slow_queries.append(entry)
+        SLOW_QUERIES_TOTAL.inc(source=source)
+    except Exception:
+        app.logger.exception("Не удалось записать медленный запрос")
+
+
+def slow_query_groups():
+    """Буфер, сгруппированный по отпечатку; самые дорогие по суммарному времени — сверху."""
+    with _slow_queries_lock:
+        entries = list(slow_queries)
+    groups = {}
+    for q in entries:
+        group = groups.get(q["fp_id"])
+        if group is None:
+            group = groups[q["fp_id"]] = {
+                "fp_id": q["fp_id"],
+                "fingerprint": q["fingerprint"],
+                "count": 0,
+                "total": 0.0,
+                "max": 0.0,
+                "last": q["at"],
+                "sources": Counter(),
+                "slowest": q,
+            }
+        group["count"] += 1
+        group["total"] += q["duration"]
+        group["last"] = max(group["last"], q["at"])
+        group["sources"][q["source"]] += 1
+        if q["duration"] >= group["max"]:
+            group["max"] = q["duration"]
+            group["slowest"] = q
+    rows = sorted(groups.values(), key=lambda r: r["total"], reverse=True)
+    for row in rows:
+        row["avg"] = row["total"] / row["count"]
+    return rows, len(entries)
+
+
+@app.route("/admin/slow-queries", methods=["GET", "POST"])
+@admin_required
+def admin_slow_queries():
+    """Медленные запросы этого воркера по отпечаткам; ?fp= — все случаи одного."""
+    if request.method == "POST":
+        with _slow_queries_lock:
+            slow_queries.clear()
+        flash("Журнал медленных запросов очищен.", "success")
+        return redirect(url_for("admin_slow_queries"))
+
+    fio, group = get_student_info()
+    groups, total = slow_query_groups()
+    fp_id = request.args.get("fp")
+    entries = []
+    if fp_id:
+        with _slow_queries_lock:
+            entries = [q for q in reversed(slow_queries) if q["fp_id"] == fp_id]
+    return render_template(
+        "admin_slow_queries.html",
+        fio=fio,
+        group=group,
+        groups=groups,
+        total=total,
+        fp_id=fp_id,
+        entries=entries,
+        threshold_ms=app.config["SLOW_QUERY_THRESHOLD"] * 1000,
+        capacity=slow_queries.maxlen,
+        worker=f"{socket.gethostname()}:{os.getpid()}",
+    )
+
+
+# ===== ПРОФИЛИРОВАНИЕ ЗАПРОСОВ =====
+# Админ добавляет к адресу ?_profile=1 (или шлёт заголовок X-Profile: 1) — запрос
+# целиком, вместе с отдачей тела, идёт под семплирующим профайлером (profiler.py).
+# Профили лежат в PROFILE_DIR и смотрятся в /admin/profiles.
+
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(BASE_DIR, "cache", "profiles"))
+app.config.setdefault("PROFILE_INTERVAL", 0.001)
+app.config.setdefault("PROFILE_MAX_SECONDS", 30)
+app.config.setdefault("PROFILE_KEEP", 50)
+
+
+def profile_allowed(environ):
+    """Кто смотрит, если это админ; запрос Flask ещё не начат — сессию читаем сами."""
+    req = app.request_class(environ, populate_request=False)
+    sess = app.session_interface.open_session(app, req)
+    if sess is None or sess.get("user_role") != "admin":
+        return None
+    return sess.get("username") or f"#{sess.get('user_id')}"
+
+
+# снаружи всех мидлварей: в профиль попадают и сжатие, и метрики
+app.wsgi_app = ProfilerMiddleware(
+    app.wsgi_app,
+    PROFILE_DIR,
+    allow=profile_allowed,
+    base_dir=BASE_DIR,
+    interval=app.config["PROFILE_INTERVAL"],
+    max_seconds=app.config["PROFILE_MAX_SECONDS"],
+    keep=app.config["PROFILE_KEEP"],
+)
+
+
+@app.route("/admin/profiles")
+@admin_required
+def admin_profiles():
+    fio, group = get_student_info()
+    return render_template(
+        "admin_profiles.html",
+        fio=fio,
+        group=group,
+        profiles=list_profiles(PROFILE_DIR),
+        keep=app.config["PROFILE_KEEP"],
+    )
+
+
+@app.route("/admin/profiles/<profile_id>")
+@admin_required
+def admin_profile(profile_id):
+    try:
+        meta = load_profile(PROFILE_DIR, profile_id)
+        samples = load_collapsed(PROFILE_DIR, profile_id)
+    except (OSError, ValueError):
+        abort(404)
+
+    fio, group = get_student_info()
+    top_self, top_total = top_functions(samples)
+    return render_template(
+        "admin_profile.html",
+        fio=fio,
+        group=group,
+        meta=meta,
+        tree=flame_tree(samples),
+        top_self=top_self,
+        top_total=top_total,
+        total=sum(weight for _, weight in samples) or 1,
+    )
+
+
+@app.route("/admin/profiles/<profile_id>/<any(collapsed, speedscope):fmt>")
+@admin_required
+def admin_profile_file(profile_id, fmt):
+    try:
+        path = profile_file(PROFILE_DIR, profile_id, fmt)
+    except ValueError:
+        abort(404)
+    if not os.path.exists(path):
+        abort(404)
+    return send_file(
+        path,
+        mimetype="text/plain" if fmt == "collapsed" else "application/json",
+        as_attachment=True,
+        download_name=os.path.basename(path),
+    )
+
+
+# ===== АДМИН: КЭШ =====
+
+@app.route("/admin/cache", methods=["GET", "POST"])
+@admin_required
+def admin_cache():
+    """Попадания и вытеснения общего кэша (счётчики — по этому воркеру)."""
+    if request.method == "POST":
+        if request.form.get("action") == "clear":
+            cache.clear()
+            flash("Кэш сброшен во всех воркерах.", "success")
+        else:
+            cache.reset_stats()
+            flash("Статистика кэша сброшена.", "success")
+        return redirect(url_for("admin_cache"))
+
+    fio, group = get_student_info()
+    return render_template(
+        "admin_cache.html",
+        fio=fio,
+        group=group,
+        stats=cache.stats(),
+        worker=f"{socket.gethostname()}:{os.getpid()}",
+    )
+
+
+# ===== АДМИН: ВЫГРУЗКИ =====
+
+# таблица → колонки в выгрузке, колонка даты и колонка для фильтра по статусу
+EXPORTS = {
+    "users": {
+        "title": "Пользователи",
+        "model": User,
+        # хеш пароля не выгружается
+        "columns": ["id", "username", "email", "role", "full_name",
+                    "avatar_filename", "created_at", "deleted_at"],
+        "date": "created_at",
+        "status": "role",
+        "statuses": ["user", "master", "admin"],
+    },
+    "ad_messages": {
+        "title": "Сообщения по объявлениям",
+        "model": AdMessage,
+        "columns": ["id", "ad_id", "sender_id", "receiver_id", "text", "created_at", "is_read"],
+        "date": "created_at",
+        "status": None,
+        "statuses": [],
+    },
+    "support_messages": {
+        "title": "Обращения в поддержку",
+        "model": SupportMessage,
+        "columns": ["id", "user_id", "subject", "text", "status", "created_at",
+                    "admin_reply", "replied_at"],
+        "date": "created_at",
+        "status": "status",
+        "statuses": ["new", "done"],
+    },
+    "street_requests": {
+        "title": "Заявки на улицы",
+        "model": StreetRequest,
+        "columns": ["id", "user_id", "street_name", "street_code", "pavilion_title",
+                    "pavilion_desc", "status", "created_at", "street_id"],
+        "date": "created_at",
+        "status": "status",
+        "statuses": ["pending", "approved", "rejected"],
+    },
+    "ad_requests": {
+        "title": "Заявки на объявления",
+        "model": AdRequest,
+        "columns": ["id", "user_id", "pavilion_id", "title", "text", "status", "created_at"],
+        "date": "created_at",
+        "status": "status",
+        "statuses": ["pending", "approved", "rejected"],
+    },
+    "pavilion_requests": {
+        "title": "Заявки на павильоны",
+        "model": PavilionRequest,
+        "columns": ["id", "user_id", "street_id", "title", "pavilion_title", "pavilion_desc",
+                    "ad_title", "ad_text", "status", "created_at"],
+        "date": "created_at",
+        "status": "status",
+        "statuses": ["pending", "approved", "rejected"],
+    },
+}
+
+for _name, _spec in EXPORTS.items():
+    _spec["row"] = namedtuple(f"Export_{_name}", _spec["columns"])
+
+EXPORT_FORMATS = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+
+
+def _parse_day(value, name):
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise ApiError(f"{name}: нужна дата вида ГГГГ-ММ-ДД")
+
+
+def export_select(name, args, archive=False):
+    """SELECT выгрузки с фильтрами из строки запроса, колонка id и id, с которого продолжать.
+
+    archive — выгрузить архивные строки таблицы вместо рабочих.
+    """
+    spec = EXPORTS[name]
+    if archive and name not in ARCHIVE_TABLES:
+        raise ApiError("у этой таблицы нет архива")
+    model = spec["model"]
+    stmt = select(*(getattr(model, c) for c in spec["columns"]))
+
+    date_col = getattr(model, spec["date"])
+    date_from = _parse_day(args.get("from"), "from")
+    date_to = _parse_day(args.get("to"), "to")
+    if date_from:
+        stmt = stmt.where(date_col >= date_from)
+    if date_to:
+        # дата «по» включительно
+        stmt = stmt.where(date_col < date_to + timedelta(days=1))
+
+    statuses = [s for s in args.getlist("status") if s]
+    if statuses:
+        if spec["status"] is None:
+            raise ApiError("у этой таблицы нет статуса")
+        stmt = stmt.where(getattr(model, spec["status"]).in_(statuses))
+
+    try:
+        after = int(args["after_id"]) if args.get("after_id") else None
+    except ValueError:
+        raise ApiError("after_id должен быть числом")
+    stmt, id_col, _ = list_source(model, stmt, archive)
+    return stmt, id_col, after
+
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.isoformat(sep=" ")
+    if isinstance(value, bool):
+        return int(value)
+    return value
+
+
+def export_csv(rows, columns, header=True):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    if header:
+        writer.writerow(columns)
+    for row in rows:
+        writer.writerow([_csv_value(v) for v in row])
+        if buf.tell() >= STREAM_CHUNK_SIZE:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def export_jsonl(rows):
+    buf, size = [], 0
+    for row in rows:
+        line = json.dumps(row._asdict(), ensure_ascii=False, default=_json_default) + "\n"
+        buf.append(line)
+        size += len(line)
+        if size >= STREAM_CHUNK_SIZE:
+            yield "".join(buf)
+            buf, size = [], 0
+    yield "".join(buf)
+
+
+@app.route("/admin/exports")
+@admin_required
+def admin_exports():
+    fio, group = get_student_info()
+    return render_template(
+        "admin_exports.html", fio=fio, group=group, exports=EXPORTS, archived=ARCHIVE_TABLES
+    )
+
+
+@app.route("/admin/exports/<name>.<fmt>")
+@admin_required
+def admin_export(name, fmt):
+    """Потоковая выгрузка таблицы в CSV или JSONL, по возрастанию id.
+
+    Память не растёт с размером таблицы: строки читаются пачками по id и сразу
+    уходят клиенту. Оборвавшуюся выгрузку можно докачать: ?after_id=<id
+    последней полученной строки>. При продолжении CSV идёт без заголовка,
+    чтобы его можно было дописать в конец уже скачанного файла. С ?archive=1
+    выгружаются архивные строки таблицы — рабочих в такой выгрузке нет.
+    """
+    if name not in EXPORTS or fmt not in EXPORT_FORMATS:
+        abort(404)
+    spec = EXPORTS[name]
+    archive = wants_archive()
+    stmt, id_col, after = export_select(name, request.args, archive)
+    rows = iter_keyset(stmt, id_col, spec["row"], after=after)
+
+    if fmt == "csv":
+        body = export_csv(rows, spec["columns"], header=after is None)
+    else:
+        body = export_jsonl(rows)
+
+    resp = app.response_class(stream_with_context(body), mimetype=EXPORT_FORMATS[fmt])
+    suffix = f"-after-{after}" if after else ""
+    prefix = f"{name}-archive" if archive else name
+    resp.headers["Content-Disposition"] = (
+        f"attachment; filename={prefix}-{date.today():%Y%m%d}{suffix}.{fmt}"
+    )
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+
+# ===== АДМИН: РЕЗЕРВНЫЕ КОПИИ =====
+# Снимки снимает backup.py через online backup API; здесь — задачи очереди,
+# чтобы копию можно было запустить из админки, не дожидаясь ответа страницы.
+
+BACKUP_DIR = os.environ.get("BACKUP_DIR", os.path.join(BASE_DIR, "backups"))
+app.config.setdefault("BACKUP_PAGES", backup.BACKUP_PAGES)
+app.config.setdefault("BACKUP_SLEEP", backup.BACKUP_SLEEP)
+app.config.setdefault("BACKUP_KEEP", backup.BACKUP_KEEP)
+BACKUP_HEARTBEAT = JOB_LOCK_TIMEOUT / 3
+
+
+def backup_in_progress():
+    """Резервная копия стоит в очереди или снимается — архив ждёт её."""
+    return db.session.query(
+        Job.query.filter(
+            Job.kind == "backup_database", Job.status.in_(("queued", "running"))
+        ).exists()
+    ).scalar()
+
+
+def archive_in_progress():
+    """Идёт перенос в архив: его запуск открыт, и задача обслуживания жива."""
+    return db.session.query(
+        MaintenanceRun.query.filter_by(task="archive", status="running").exists()
+    ).scalar() and db.session.query(
+        Job.query.filter_by(kind="db_maintenance", status="running").exists()
+    ).scalar()
+
+
+@job_handler("backup_database", max_attempts=2, priority=1)
+def backup_database(payload, job_id=None):
+    # fair.db и archive.db копируются по очереди; если между копиями пачка
+    # строк переедет в архив, пара разойдётся, поэтому с переносом не пересекаемся
+    if archive_in_progress():
+        raise JobDeferred("идёт перенос в архив", delay=MAINTENANCE_BUDGET)
+    # своя транзакция открыта — копия ждала бы её; закрываем до начала
+    db.session.commit()
+    last = {"beat": time.monotonic()}
+
+    def progress(done, total):
+        # heartbeat пишет в базу, и SQLite начинает копию заново, поэтому редко
+        if job_id is not None and time.monotonic() - last["beat"] > BACKUP_HEARTBEAT:
+            job_heartbeat(job_id)
+            db.session.commit()
+            last["beat"] = time.monotonic()
+
+    attached = []
+    if ARCHIVE_SCHEMA and os.path.exists(ARCHIVE_PATH):
+        attached.append(ARCHIVE_PATH)
+
+    manifest = backup.create_backup(
+        DB_PATH,
+        BACKUP_DIR,
+        pages=app.config["BACKUP_PAGES"],
+        sleep=app.config["BACKUP_SLEEP"],
+        keep=app.config["BACKUP_KEEP"],
+        progress=progress,
+        attached=attached,
+    )
+    app.logger.info(
+        "backup %s: %s байт, шагов %s, перезапусков %s",
+        manifest["name"], manifest["gz_size"], manifest["steps"], manifest["restarts"],
+    )
+
+
+@job_handler("verify_backup", max_attempts=1)
+def verify_backup_job(payload, job_id=None):
+    manifest = backup.verify_backup(payload.get("name"), BACKUP_DIR)
+    if not manifest["verified"]["ok"]:
+        raise backup.BackupError("; ".join(manifest["verified"]["errors"]))
+
+
+@app.route("/admin/backups", methods=["GET", "POST"])
+@admin_required
+def admin_backups():
+    if request.method == "POST":
+        if request.form.get("action") == "verify":
+            name = request.form.get("name", "")
+            enqueue_job("verify_backup", {"name": name}, unique_key=f"verify_backup:{name}")
+            flash(f"Проверка снимка {name} поставлена в очередь.", "success")
+        else:
+            enqueue_job("backup_database", unique_key="backup_database")
+            flash("Резервная копия поставлена в очередь.", "success")
+        return redirect(url_for("admin_backups"))
+
+    fio, group = get_student_info()
+    running = Job.query.filter(
+        Job.kind.in_(("backup_database", "verify_backup")),
+        Job.status.in_(("queued", "running")),
+    ).order_by(Job.id).all()
+    return render_template(
+        "admin_backups.html",
+        fio=fio,
+        group=group,
+        backups=backup.list_backups(BACKUP_DIR),
+        running=running,
+        backup_dir=BACKUP_DIR,
+        keep=app.config["BACKUP_KEEP"],
+    )
+
+
+# ===== ОБСЛУЖИВАНИЕ БАЗЫ =====
+# ANALYZE, инкрементальный VACUUM, проверки целостности и внешних ключей,
+# поиск строк-сирот и размеры таблиц. Сами задачи идут только в ночное окно
+# MAINTENANCE_WINDOW и не дольше MAINTENANCE_BUDGET за запуск; большие проверки
+# идут по таблицам и диапазонам rowid с паузами, а если не успели — запоминают,
+# где остановились, и продолжают в следующий раз.
+
+MAINTENANCE_CHECK_INTERVAL = 30 * 60
+MAINTENANCE_BUDGET = 60  # с на один запуск задачи
+MAINTENANCE_PAUSE = 0.05  # пауза между шагами, чтобы пропустить запросы сайта
+MAINTENANCE_VACUUM_PAGES = 256
+MAINTENANCE_ORPHAN_CHUNK = 5000  # rowid за шаг
+app.config.setdefault("MAINTENANCE_WINDOW", (2, 6))  # часы по времени сервера, [с, до)
+# ночной проход только находит сирот; исправлять — кнопкой в админке или этим флагом
+app.config.setdefault("MAINTENANCE_FIX_ORPHANS", False)
+
+MAINTENANCE_TASKS = {}
+
+
+def maintenance_task(name, title, every=None):
+    """Регистрирует задачу обслуживания. every=None — только вручную.
+
+    Функция получает (cursor, deadline, tick) и возвращает словарь со status,
+    summary, details и cursor (не None — не закончила, продолжит с него).
+    """
+
+    def decorator(func):
+        MAINTENANCE_TASKS[name] = {"func": func, "title": title, "every": every}
+        return func
+
+    return decorator
+
+
+def in_maintenance_window(now=None):
+    start, end = app.config["MAINTENANCE_WINDOW"]
+    hour = (now or datetime.now()).hour
+    return start <= hour < end if start <= end else hour >= start or hour < end
+
+
+def _pragma(sql):
+    result = db.session.execute(text(sql))
+    return result.fetchall() if result.returns_rows else []
+
+
+def _user_tables():
+    return [
+        row[0]
+        for row in _pragma(
+            "SELECT name FROM sqlite_master WHERE type = 'table' "
+            "AND name NOT LIKE 'sqlite_%' ORDER BY name"
+        )
+    ]
+
+
+def last_maintenance_runs():
+    """Последний запуск каждой задачи: task → MaintenanceRun."""
+    latest = (
+        select(db.func.max(MaintenanceRun.id)).group_by(MaintenanceRun.task).scalar_subquery()
+    )
+    runs = MaintenanceRun.query.filter(MaintenanceRun.id.in_(latest)).all()
+    return {run.task: run for run in runs}
+
+
+def due_maintenance_tasks(now=None):
+    now = now or datetime.utcnow()
+    last = last_maintenance_runs()
+    due = []
+    for name, spec in MAINTENANCE_TASKS.items():
+        if spec["every"] is None:
+            continue
+        run = last.get(name)
+        if (
+            run is None
+            or run.status == "partial"
+            or run.finished_at is None
+            or run.finished_at + timedelta(seconds=spec["every"]) <= now
+        ):
+            due.append(name)
+    return due
+
+
+def run_maintenance_task(name, deadline, job_id=None, start=None):
+    """start — курсор нового прохода вместо того, где задача остановилась."""
+    last = (
+        MaintenanceRun.query.filter_by(task=name).order_by(MaintenanceRun.id.desc()).first()
+    )
+    cursor = json.loads(last.cursor) if last and last.status == "partial" and last.cursor else None
+    if start is not None:
+        cursor = start
+
+    run = MaintenanceRun(task=name, status="running")
+    db.session.add(run)
+    db.session.commit()
+    started = time.perf_counter()
+
+    def tick():
+        # между шагами: отпускаем базу и продлеваем задачу в очереди
+        if job_id is not None:
+            job_heartbeat(job_id)
+        db.session.commit()
+        time.sleep(MAINTENANCE_PAUSE)
+
+    try:
+        result = MAINTENANCE_TASKS[name]["func"](cursor, deadline, tick)
+    except Exception as e:
+        db.session.rollback()
+        app.logger.exception("обслуживание %s упало", name)
+        result = {"status": "failed", "summary": str(e)[:300]}
+
+    run.status = "partial" if result.get("cursor") is not None else result["status"]
+    run.summary = result.get("summary")
+    run.details = json.dumps(result.get("details"), ensure_ascii=False, default=_json_default)
+    run.cursor = json.dumps(result["cursor"]) if result.get("cursor") is not None else None
+    run.finished_at = datetime.utcnow()
+    run.duration = time.perf_counter() - started
+    db.session.commit()
+    return run
+
+
+@maintenance_task("optimize", "Статистика планировщика (ANALYZE / PRAGMA optimize)", every=6 * 3600)
+def maintenance_optimize(cursor, deadline, tick):
+    has_stats = _pragma("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'")
+    if not has_stats:
+        # первый раз — полный ANALYZE, дальше optimize обновляет только устаревшее
+        _pragma("ANALYZE")
+        summary = "Выполнен полный ANALYZE"
+    else:
+        _pragma("PRAGMA analysis_limit=1000")
+        _pragma("PRAGMA optimize")
+        summary = "Выполнен PRAGMA optimize"
+    stats = _pragma("SELECT COUNT(*) FROM sqlite_stat1")[0][0]
+    db.session.commit()
+    return {"status": "ok", "summary": f"{summary}, строк статистики: {stats}"}
+
+
+@maintenance_task("vacuum", "Инкрементальный VACUUM", every=6 * 3600)
+def maintenance_vacuum(cursor, deadline, tick):
+    mode = _pragma("PRAGMA auto_vacuum")[0][0]
+    free = _pragma("PRAGMA freelist_count")[0][0]
+    if mode != 2:
+        return {
+            "status": "skipped",
+            "summary": f"auto_vacuum не INCREMENTAL, свободных страниц: {free}",
+            "details": {"freelist": free},
+        }
+
+    released = 0
+    while free:
+        if time.monotonic() > deadline:
+            break
+        db.session.commit()
+        # incremental_vacuum отдаёт по странице на каждый шаг выполнения, а
+        # execute() делает только первый шаг; executescript доводит до конца
+        raw = db.session.connection().connection.driver_connection
+        raw.executescript(f"PRAGMA incremental_vacuum({MAINTENANCE_VACUUM_PAGES})")
+        tick()
+        left = _pragma("PRAGMA freelist_count")[0][0]
+        released += free - left
+        free = left
+    return {
+        "status": "ok",
+        "summary": f"Освобождено страниц: {released}, осталось свободных: {free}",
+        "details": {"released": released, "freelist": free},
+        "cursor": {} if free else None,
+    }
+
+
+@maintenance_task("auto_vacuum", "Перевод базы на auto_vacuum=INCREMENTAL (полный VACUUM)")
+def maintenance_enable_incremental_vacuum(cursor, deadline, tick):
+    """Разовая операция: VACUUM переписывает весь файл и на это время блокирует базу."""
+    if _pragma("PRAGMA auto_vacuum")[0][0] == 2:
+        return {"status": "ok", "summary": "Уже включено"}
+    db.session.commit()
+    with db.engine.connect() as conn:
+        # вне транзакции, иначе VACUUM не выполнится
+        conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.exec_driver_sql("VACUUM")
+        mode = conn.exec_driver_sql("PRAGMA auto_vacuum").scalar()
+    if mode != 2:
+        return {"status": "failed", "summary": "VACUUM прошёл, но режим не сменился"}
+    return {"status": "ok", "summary": "auto_vacuum=INCREMENTAL, файл перестроен"}
+
+
+def _per_table(cursor, deadline, tick, check):
+    """Обход таблиц по одной; cursor — сколько таблиц уже проверено."""
+    tables = _user_tables()
+    state = cursor or {"done": 0, "problems": {}}
+    while state["done"] < len(tables):
+        if time.monotonic() > deadline:
+            return state, True
+        table = tables[state["done"]]
+        found = check(table)
+        if found:
+            state["problems"][table] = found
+        state["done"] += 1
+        tick()
+    return state, False
+
+
+@maintenance_task("integrity", "Проверка целостности", every=24 * 3600)
+def maintenance_integrity(cursor, deadline, tick):
+    def check(table):
+        rows = [row[0] for row in _pragma(f'PRAGMA integrity_check("{table}")')]
+        return [] if rows == ["ok"] else rows[:20]
+
+    state, unfinished = _per_table(cursor, deadline, tick, check)
+    problems = state["problems"]
+    return {
+        "status": "problems" if problems else "ok",
+        "summary": (
+            f"Проверено таблиц: {state['done']}, с ошибками: {len(problems)}"
+        ),
+        "details": problems,
+        "cursor": state if unfinished else None,
+    }
+
+
+@maintenance_task("foreign_keys", "Проверка внешних ключей", every=24 * 3600)
+def maintenance_foreign_keys(cursor, deadline, tick):
+    def check(table):
+        counts = Counter(row[2] for row in _pragma(f'PRAGMA foreign_key_check("{table}")'))
+        return dict(counts)  # родительская таблица → сколько строк без родителя
+
+    state, unfinished = _per_table(cursor, deadline, tick, check)
+    problems = state["problems"]
+    total = sum(sum(parents.values()) for parents in problems.values())
+    return {
+        "status": "problems" if problems else "ok",
+        "summary": f"Проверено таблиц: {state['done']}, нарушений: {total}",
+        "details": problems,
+        "cursor": state if unfinished else None,
+    }
+
+
+def orphan_checks():
+    """Внешние ключи моделей: (таблица, колонка, родитель, колонка родителя, ondelete)."""
+    existing = set(_user_tables())
+    checks = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing:
+            continue
+        for fk in sorted(table.foreign_keys, key=lambda f: f.parent.name):
+            checks.append((
+                table.name, fk.parent.name, fk.column.table.name, fk.column.name,
+                (fk.ondelete or "").upper(),
+            ))
+    return checks
+
+
+@maintenance_task("orphans", "Строки-сироты", every=24 * 3600)
+def maintenance_orphans(cursor, deadline, tick):
+    """Строки, чей родитель уже удалён (остались с тех пор, как внешние ключи не проверялись).
+
+    Без MAINTENANCE_FIX_ORPHANS и не из кнопки «Исправить» — только отчёт.
+    С исправлением по ondelete внешнего ключа: CASCADE — строка удаляется,
+    SET NULL — ссылка обнуляется, иначе только попадает в отчёт.
+    """
+    checks = orphan_checks()
+    state = {
+        "check": 0, "after": 0, "found": {}, "fixed": {},
+        "fix": app.config["MAINTENANCE_FIX_ORPHANS"],
+    }
+    state.update(cursor or {})
+    fix = state["fix"]
+
+    while state["check"] < len(checks):
+        if time.monotonic() > deadline:
+            return _orphans_result(state, unfinished=True)
+        child, col, parent, parent_col, ondelete = checks[state["check"]]
+        key = f"{child}.{col}"
+        top = _pragma(f'SELECT MAX(rowid) FROM "{child}"')[0][0] or 0
+        if state["after"] >= top:
+            state["check"] += 1
+            state["after"] = 0
+            continue
+
+        lo, hi = state["after"], state["after"] + MAINTENANCE_ORPHAN_CHUNK
+        rowids = [
+            row[0]
+            for row in db.session.execute(
+                text(
+                    f'SELECT c.rowid FROM "{child}" c WHERE c.rowid > :lo AND c.rowid <= :hi '
+                    f'AND c."{col}" IS NOT NULL AND NOT EXISTS '
+                    f'(SELECT 1 FROM "{parent}" p WHERE p."{parent_col}" = c."{col}")'
+                ),
+                {"lo": lo, "hi": hi},
+            )
+        ]
+        if rowids:
+            state["found"][key] = state["found"].get(key, 0) + len(rowids)
+            if fix and ondelete in ("CASCADE", "SET NULL"):
+                where = f'rowid IN ({",".join(str(r) for r in rowids)})'
+                if ondelete == "CASCADE":
+                    db.session.execute(text(f'DELETE FROM "{child}" WHERE {where}'))
+                else:
+                    db.session.execute(text(f'UPDATE "{child}" SET "{col}" = NULL WHERE {where}'))
+                state["fixed"][key] = state["fixed"].get(key, 0) + len(rowids)
+        state["after"] = hi
+        tick()
+
+    return _orphans_result(state, unfinished=False)
+
+
+def _orphans_result(state, unfinished):
+    found = sum(state["found"].values())
+    fixed = sum(state["fixed"].values())
+    return {
+        "status": "problems" if found > fixed else "ok",
+        "summary": (
+            f"Найдено сирот: {found}, исправлено: {fixed}" if state["fix"]
+            else f"Найдено сирот: {found} (только отчёт)"
+        ),
+        "details": {"found": state["found"], "fixed": state["fixed"]},
+        "cursor": state if unfinished else None,
+    }
+
+
+@maintenance_task("sizes", "Размеры таблиц и индексов (dbstat)", every=6 * 3600)
+def maintenance_sizes(cursor, deadline, tick):
+    page_size = _pragma("PRAGMA page_size")[0][0]
+    page_count = _pragma("PRAGMA page_count")[0][0]
+    free = _pragma("PRAGMA freelist_count")[0][0]
+    rows = _pragma(
+        "SELECT s.name, COALESCE(m.type, 'table'), COALESCE(m.tbl_name, s.name), "
+        "s.pgsize, s.pageno, s.unused "
+        "FROM dbstat s LEFT JOIN sqlite_master m ON m.name = s.name "
+        "WHERE s.aggregate = 1 ORDER BY s.pgsize DESC"
+    )
+    objects = [
+        {"name": name, "type": kind, "table": table, "bytes": size, "pages": pages, "unused": unused}
+        for name, kind, table, size, pages, unused in rows
+    ]
+    return {
+        "status": "ok",
+        "summary": (
+            f"База {page_size * page_count / 1024 / 1024:.1f} МБ, "
+            f"свободно {page_size * free / 1024 / 1024:.1f} МБ"
+        ),
+        "details": {
+            "page_size": page_size,
+            "page_count": page_count,
+            "freelist": free,
+            "auto_vacuum": _pragma("PRAGMA auto_vacuum")[0][0],
+            "objects": objects,
+        },
+    }
+
+
+@job_handler("db_maintenance", max_attempts=1, priority=-1)
+def db_maintenance(payload, job_id=None):
+    """Периодически — просроченные задачи в ночное окно; из админки — указанные сразу."""
+    names = payload.get("tasks")
+    if not names:
+        if not in_maintenance_window():
+            return
+        names = due_maintenance_tasks()
+    for name in names:
+        if name not in MAINTENANCE_TASKS:
+            continue
+        start = {"fix": True} if name == "orphans" and payload.get("fix_orphans") else None
+        run_maintenance_task(
+            name, time.monotonic() + MAINTENANCE_BUDGET, job_id=job_id, start=start
+        )
+
+
+periodic_job("db_maintenance", every_seconds=MAINTENANCE_CHECK_INTERVAL)
+
+
+@app.route("/admin/maintenance", methods=["GET", "POST"])
+@admin_required
+def admin_maintenance():
+    if request.method == "POST":
+        task = request.form.get("task", "")
+        payload = {}
+        if task == "all":
+            names = [n for n, spec in MAINTENANCE_TASKS.items() if spec["every"] is not None]
+        elif task == "orphans_fix":
+            names = ["orphans"]
+            payload["fix_orphans"] = True
+        elif task in MAINTENANCE_TASKS:
+            names = [task]
+        else:
+            abort(400)
+        payload["tasks"] = names
+        enqueue_job("db_maintenance", payload, unique_key=f"db_maintenance:{task}")
+        flash("Обслуживание поставлено в очередь.", "success")
+        return redirect(url_for("admin_maintenance"))
+
+    fio, group = get_student_info()
+    last = last_maintenance_runs()
+    tasks = []
+    for name, spec in MAINTENANCE_TASKS.items():
+        run = last.get(name)
+        details = json.loads(run.details) if run and run.details else None
+        next_at = None
+        if spec["every"] is not None and run is not None and run.finished_at is not None:
+            next_at = run.finished_at + timedelta(seconds=spec["every"])
+        tasks.append({
+            "name": name,
+            "title": spec["title"],
+            "every": spec["every"],
+            "run": run,
+            "details": details,
+            "next_at": next_at,
+        })
+    sizes = next((t["details"] for t in tasks if t["name"] == "sizes"), None)
+    running = Job.query.filter(
+        Job.kind == "db_maintenance", Job.status.in_(("queued", "running"))
+    ).count()
+    return render_template(
+        "admin_maintenance.html",
+        fio=fio,
+        group=group,
+        tasks=tasks,
+        sizes=sizes,
+        running=running,
+        window=app.config["MAINTENANCE_WINDOW"],
+        budget=MAINTENANCE_BUDGET,
+        fix_orphans=app.config["MAINTENANCE_FIX_ORPHANS"],
+    )
+
+
+# ===== АРХИВ: ПЕРЕНОС СТАРЫХ СТРОК =====
+# Обработанные заявки, закрытые обращения и прочитанные сообщения старше
+# ARCHIVE_AFTER_DAYS дней пачками переносятся в архивные таблицы. Каждая пачка —
+# одна транзакция (вставка в архив и удаление из рабочей таблицы), так что строка
+# не теряется и не двоится, даже если архив — отдельный файл. Страницы
+# показывают архив по ?archive=1.
+
+app.config.setdefault(
+    "ARCHIVE_AFTER_DAYS",
+    {
+        "ad_messages": 180,
+        "support_messages": 90,
+        "street_requests": 60,
+        "ad_requests": 60,
+        "pavilion_requests": 60,
+    },
+)
+ARCHIVE_BATCH = 500
+
+PROCESSED_STATUSES = ("approved", "rejected")
+
+# какие строки таблицы уже «холодные»
+ARCHIVE_RULES = {
+    "ad_messages": lambda cutoff: and_(
+        AdMessage.created_at < cutoff, AdMessage.is_read.is_(True)
+    ),
+    "support_messages": lambda cutoff: and_(
+        SupportMessage.created_at < cutoff, SupportMessage.status == "done"
+    ),
+    "street_requests": lambda cutoff: and_(
+        StreetRequest.created_at < cutoff, StreetRequest.status.in_(PROCESSED_STATUSES)
+    ),
+    "ad_requests": lambda cutoff: and_(
+        AdRequest.created_at < cutoff, AdRequest.status.in_(PROCESSED_STATUSES)
+    ),
+    "pavilion_requests": lambda cutoff: and_(
+        PavilionRequest.created_at < cutoff, PavilionRequest.status.in_(PROCESSED_STATUSES)
+    ),
+}
+
+
+def archive_batch(name, cutoff, batch=ARCHIVE_BATCH):
+    """Переносит в архив до batch холодных строк таблицы name, возвращает сколько."""
+    model = ARCHIVED_MODELS[name][0]
+    hot = model.__table__
+    arch = ARCHIVE_TABLES[name]
+    ids = db.session.execute(
+        select(hot.c.id)
+        .where(ARCHIVE_RULES[name](cutoff))
+        .order_by(hot.c.id)
+        .limit(batch)
+    ).scalars().all()
+    if not ids:
+        return 0
+
+    names = [c.name for c in hot.columns]
+    db.session.execute(
+        insert(arch).from_select(
+            names + ["archived_at"],
+            select(*hot.columns, literal(datetime.utcnow(), db.DateTime)).where(
+                hot.c.id.in_(ids)
+            ),
+        )
+    )
+    db.session.execute(delete(hot).where(hot.c.id.in_(ids)))
+    db.session.commit()
+    return len(ids)
+
+
+@maintenance_task("archive", "Перенос старых строк в архив", every=24 * 3600)
+def maintenance_archive(cursor, deadline, tick):
+    moved = dict(cursor["moved"]) if cursor else {}
+    now = datetime.utcnow()
+    for name, days in app.config["ARCHIVE_AFTER_DAYS"].items():
+        if not days:
+            continue
+        cutoff = now - timedelta(days=days)
+        while True:
+            if time.monotonic() > deadline:
+                return _archive_result(moved, unfinished=True)
+            if backup_in_progress():
+                # копия снимает fair.db и archive.db по очереди — не двигаем строки
+                # между ними; продолжим со следующей проверки
+                result = _archive_result(moved, unfinished=True)
+                result["summary"] += " (остановлено: идёт резервная копия)"
+                return result
+            count = archive_batch(name, cutoff)
+            if count:
+                moved[name] = moved.get(name, 0) + count
+            tick()
+            if count < ARCHIVE_BATCH:
+                break
+    return _archive_result(moved, unfinished=False)
+
+
+def _archive_result(moved, unfinished):
+    parts = ", ".join(f"{name}: {count}" for name, count in moved.items())
+    return {
+        "status": "ok",
+        "summary": f"Перенесено в архив: {parts}" if moved else "Переносить нечего",
+        "details": moved,
+        "cursor": {"moved": moved} if unfinished else None,
+    }
+
+
 # ===== ЗАПУСК =====
 
 if __name__ == "__main__":
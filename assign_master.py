@@ -1,26 +1,51 @@
-from app import app, db, User, Ad
-
-with app.app_context():
-    # берём только мастеров, пропуская админа
-    masters = (
-        User.query
-        .filter(User.role == "master")
-        .order_by(User.id)
-        .all()
-    )
-
-    if not masters:
-        print("Мастеров в БД нет.")
-        exit()
-
-    ads = Ad.query.order_by(Ad.id).all()
-
-    i = 0
-    for ad in ads:
-        master = masters[i % len(masters)]
-        ad.master_id = master.id
-        ad.author_name = master.username   # чтобы имя в карточке совпадало с логином
-        i += 1
-
-    db.session.commit()
-    print(f"Готово, распределили {len(ads)} объявлений между {len(masters)} мастерами.")
+"""Распределение объявлений между мастерами с учётом их нагрузки.
+
+    python assign_master.py                      # объявления без мастера
+    python assign_master.py --scope rebalance    # все объявления без переписки
+    python assign_master.py --strategy expertise --dry-run
+"""
+import argparse
+
+from app import (
+    app,
+    ASSIGN_SCOPES,
+    ASSIGN_STRATEGIES,
+    apply_master_assignment,
+    plan_master_assignment,
+)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Назначение мастеров объявлениям.")
+    parser.add_argument("--strategy", choices=ASSIGN_STRATEGIES, default="load")
+    parser.add_argument("--scope", choices=ASSIGN_SCOPES, default="unassigned")
+    parser.add_argument("--dry-run", action="store_true", help="только показать план")
+    args = parser.parse_args(argv)
+
+    with app.app_context():
+        report = plan_master_assignment(args.strategy, args.scope)
+
+        if not report["masters"]:
+            print("Мастеров в БД нет.")
+            return
+
+        print(f"{'мастер':<16}{'объявл.':>8}{'диалоги':>9}{'непроч.':>9}"
+              f"{'было':>8}{'+':>5}{'станет':>8}")
+        for m in report["masters"]:
+            print(
+                f"{m['username']:<16}{m['ads']:>8}{m['open_threads']:>9}{m['unread']:>9}"
+                f"{m['load_before']:>8.1f}{m['assigned']:>5}{m['load_after']:>8.1f}"
+            )
+
+        if args.dry_run:
+            print(f"Dry-run: в плане {len(report['plan'])} объявлений, "
+                  f"сменят мастера {report['changed']}.")
+            return
+
+        updated = apply_master_assignment(report["plan"])
+        print(f"Готово, распределили {updated} объявлений "
+              f"между {len(report['masters'])} мастерами.")
+
+
+if __name__ == "__main__":
+    main()
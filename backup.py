@@ -0,0 +1,421 @@
+"""Резервные копии базы через online backup API SQLite.
+
+Копировать fair.db файлом, пока приложение работает, нельзя: можно поймать
+файл посреди записи. Здесь копия снимается через sqlite3.Connection.backup()
+по BACKUP_PAGES страниц за шаг, а между шагами делается пауза — блокировка
+чтения держится только на время шага, и запросы на запись успевают пройти.
+
+Если за время копирования базу кто-то изменил, SQLite начинает копию заново.
+После max_restarts таких перезапусков остаток копируется одним шагом:
+писатели подождут, зато копия гарантированно закончится.
+
+Снимок — это fair-ГГГГММДД-ЧЧММСС.db.gz и рядом .json с контрольными суммами
+(сжатого файла и самой базы), числом строк в таблицах и результатом
+последней проверки. Файл .json пишется последним: нет его — нет и снимка.
+Префикс имени — имя файла базы.
+
+Связанные базы (архивная archive.db) снимаются в тот же снимок: рядом ложится
+fair-ГГГГММДД-ЧЧММСС.archive.db.gz, а её суммы и счётчики пишутся в тот же
+манифест (attached). Так пара проверяется и восстанавливается вместе: строка,
+перенесённая в архив, не может оказаться в одной копии и пропасть из другой.
+Перенос в архив на время копии должен стоять — из приложения это следит
+задача backup_database; из командной строки снимайте копию вне ночного окна.
+
+Примеры:
+    python backup.py create
+    python backup.py create --pages 128 --sleep 0.1 --keep 14
+    python backup.py create --attach database/archive.db
+    python backup.py list
+    python backup.py verify                     # последний снимок
+    python backup.py verify fair-20261019-030000 --restore-to /tmp/fair.db
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DB = os.path.join(BASE_DIR, "database", "fair.db")
+DEFAULT_ARCHIVE = os.path.join(BASE_DIR, "database", "archive.db")
+DEFAULT_DIR = os.environ.get("BACKUP_DIR", os.path.join(BASE_DIR, "backups"))
+
+BACKUP_PAGES = 256  # страниц за шаг (при 4 КБ на страницу — 1 МБ)
+BACKUP_SLEEP = 0.05  # пауза между шагами, с
+BACKUP_KEEP = 7
+BACKUP_MAX_RESTARTS = 3
+COPY_CHUNK = 1024 * 1024
+
+
+class BackupError(Exception):
+    """Снимок не создан или не прошёл проверку."""
+
+
+class _Restarted(Exception):
+    pass
+
+
+def _file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _table_counts(conn):
+    names = [
+        row[0]
+        for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' "
+            "AND name NOT LIKE 'sqlite_%' ORDER BY name"
+        )
+    ]
+    return {name: conn.execute(f'SELECT COUNT(*) FROM "{name}"').fetchone()[0] for name in names}
+
+
+def _manifest_path(backup_dir, name):
+    return os.path.join(backup_dir, name + ".json")
+
+
+def _snapshot_path(backup_dir, name):
+    return os.path.join(backup_dir, name + ".db.gz")
+
+
+def _write_manifest(backup_dir, manifest):
+    path = _manifest_path(backup_dir, manifest["name"])
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def load_manifest(backup_dir, name):
+    try:
+        with open(_manifest_path(backup_dir, name), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise BackupError(f"снимок {name} не найден")
+
+
+def backup_prefix(db_path):
+    """Префикс имён снимков базы: fair.db → fair."""
+    return os.path.splitext(os.path.basename(db_path))[0]
+
+
+def list_backups(backup_dir=DEFAULT_DIR, prefix=None):
+    """Манифесты снимков, новые сверху; с prefix — только снимки этой базы."""
+    if not os.path.isdir(backup_dir):
+        return []
+    names = sorted(
+        (
+            f[:-5] for f in os.listdir(backup_dir)
+            if f.endswith(".json") and (prefix is None or f.startswith(prefix + "-"))
+        ),
+        reverse=True,
+    )
+    result = []
+    for name in names:
+        try:
+            result.append(load_manifest(backup_dir, name))
+        except (BackupError, ValueError):
+            continue
+    return result
+
+
+# --- снятие копии ---
+
+def _copy_online(src, dst, pages, sleep, max_restarts, progress):
+    """Постраничная копия; возвращает (шагов, перезапусков)."""
+    state = {"steps": 0, "restarts": 0, "remaining": None}
+
+    def on_step(status, remaining, total):
+        state["steps"] += 1
+        if state["remaining"] is not None and remaining > state["remaining"]:
+            # базу изменили другим соединением — SQLite начал копию сначала
+            state["restarts"] += 1
+            if state["restarts"] > max_restarts:
+                raise _Restarted()
+        state["remaining"] = remaining
+        if progress is not None:
+            progress(total - remaining, total)
+        if remaining:
+            time.sleep(sleep)
+
+    try:
+        src.backup(dst, pages=pages, progress=on_step)
+    except _Restarted:
+        # дальше одним шагом: база под блокировкой чтения, пока не скопируется
+        src.backup(dst, pages=-1)
+        state["steps"] += 1
+    return state["steps"], state["restarts"]
+
+
+def _snapshot_file(db_path, backup_dir, name, pages, sleep, max_restarts, progress):
+    """Копирует одну базу в name.db.gz; возвращает её суммы и счётчики."""
+    raw_tmp = os.path.join(backup_dir, name + ".db.tmp")
+    gz_tmp = _snapshot_path(backup_dir, name) + ".tmp"
+    try:
+        src = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=30)
+        dst = sqlite3.connect(raw_tmp)
+        try:
+            steps, restarts = _copy_online(src, dst, pages, sleep, max_restarts, progress)
+            check = dst.execute("PRAGMA quick_check").fetchone()[0]
+            if check != "ok":
+                raise BackupError(f"копия {os.path.basename(db_path)} повреждена: {check}")
+            page_size = dst.execute("PRAGMA page_size").fetchone()[0]
+            page_count = dst.execute("PRAGMA page_count").fetchone()[0]
+            tables = _table_counts(dst)
+        finally:
+            dst.close()
+            src.close()
+
+        raw_sha = hashlib.sha256()
+        with open(raw_tmp, "rb") as f_in, gzip.open(gz_tmp, "wb", compresslevel=6) as f_out:
+            for chunk in iter(lambda: f_in.read(COPY_CHUNK), b""):
+                raw_sha.update(chunk)
+                f_out.write(chunk)
+
+        info = {
+            "source": os.path.abspath(db_path),
+            "page_size": page_size,
+            "page_count": page_count,
+            "size": os.path.getsize(raw_tmp),
+            "gz_size": os.path.getsize(gz_tmp),
+            "sha256": _file_sha256(gz_tmp),
+            "raw_sha256": raw_sha.hexdigest(),
+            "tables": tables,
+            "steps": steps,
+            "restarts": restarts,
+        }
+        os.replace(gz_tmp, _snapshot_path(backup_dir, name))
+        return info
+    finally:
+        for path in (raw_tmp, gz_tmp):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def create_backup(db_path=DEFAULT_DB, backup_dir=DEFAULT_DIR, pages=BACKUP_PAGES,
+                  sleep=BACKUP_SLEEP, keep=BACKUP_KEEP, max_restarts=BACKUP_MAX_RESTARTS,
+                  progress=None, attached=()):
+    """Снимает сжатую копию базы и удаляет лишние старые. Возвращает манифест.
+
+    attached — пути связанных баз, которые попадают в тот же снимок.
+    progress(скопировано_страниц, всего_страниц) вызывается после каждого шага.
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    started = time.perf_counter()
+    now = datetime.utcnow()
+    name = f"{backup_prefix(db_path)}-{now:%Y%m%d-%H%M%S}"
+    if os.path.exists(_manifest_path(backup_dir, name)):
+        raise BackupError(f"снимок {name} уже есть")
+
+    written = []
+    try:
+        manifest = {"name": name, "created_at": now.isoformat(timespec="seconds")}
+        manifest.update(
+            _snapshot_file(db_path, backup_dir, name, pages, sleep, max_restarts, progress)
+        )
+        written.append(name)
+        manifest["attached"] = []
+        for path in attached:
+            part_name = f"{name}.{backup_prefix(path)}"
+            part = _snapshot_file(path, backup_dir, part_name, pages, sleep, max_restarts, progress)
+            written.append(part_name)
+            part["name"] = part_name
+            part["file"] = os.path.basename(path)
+            manifest["attached"].append(part)
+            manifest["steps"] += part["steps"]
+            manifest["restarts"] += part["restarts"]
+        manifest["duration"] = round(time.perf_counter() - started, 3)
+        manifest["verified"] = None
+        _write_manifest(backup_dir, manifest)
+    except BaseException:
+        # без манифеста снимка нет — и его частей тоже
+        for part_name in written:
+            os.remove(_snapshot_path(backup_dir, part_name))
+        raise
+
+    manifest["removed"] = prune_backups(backup_dir, keep, prefix=backup_prefix(db_path))
+    return manifest
+
+
+def prune_backups(backup_dir=DEFAULT_DIR, keep=BACKUP_KEEP, prefix=None):
+    """Оставляет keep последних снимков (каждой базы отдельно), возвращает имена удалённых."""
+    removed = []
+    if prefix is None:
+        prefixes = {m["name"].rsplit("-", 2)[0] for m in list_backups(backup_dir)}
+        for p in sorted(prefixes):
+            removed += prune_backups(backup_dir, keep, prefix=p)
+        return removed
+    for manifest in list_backups(backup_dir, prefix)[keep:]:
+        name = manifest["name"]
+        # сначала манифест: без него полуудалённый снимок не виден в списке
+        os.remove(_manifest_path(backup_dir, name))
+        for part_name in [name] + [p["name"] for p in manifest.get("attached", [])]:
+            if os.path.exists(_snapshot_path(backup_dir, part_name)):
+                os.remove(_snapshot_path(backup_dir, part_name))
+        removed.append(name)
+    return removed
+
+
+# --- проверка восстановлением ---
+
+def _check_snapshot(gz_path, info, restored):
+    """Разворачивает одну базу снимка в restored; возвращает список ошибок."""
+    if not os.path.exists(gz_path):
+        raise BackupError(f"нет файла {os.path.basename(gz_path)}")
+    if _file_sha256(gz_path) != info["sha256"]:
+        raise BackupError(f"контрольная сумма {os.path.basename(gz_path)} не совпадает")
+
+    raw_sha = hashlib.sha256()
+    with gzip.open(gz_path, "rb") as f_in, open(restored, "wb") as f_out:
+        for chunk in iter(lambda: f_in.read(COPY_CHUNK), b""):
+            raw_sha.update(chunk)
+            f_out.write(chunk)
+    if raw_sha.hexdigest() != info["raw_sha256"]:
+        raise BackupError(f"контрольная сумма базы {os.path.basename(gz_path)} не совпадает")
+
+    errors = []
+    conn = sqlite3.connect(f"file:{restored}?mode=ro", uri=True)
+    try:
+        problems = [row[0] for row in conn.execute("PRAGMA integrity_check")]
+        if problems != ["ok"]:
+            errors.extend(f"integrity: {p}" for p in problems[:20])
+        fk = conn.execute("PRAGMA foreign_key_check").fetchall()
+        if fk:
+            tables = sorted({row[0] for row in fk})
+            errors.append(f"нарушений внешних ключей: {len(fk)} ({', '.join(tables)})")
+        counts = _table_counts(conn)
+    finally:
+        conn.close()
+    for table, rows in info["tables"].items():
+        if counts.get(table) != rows:
+            errors.append(f"{table}: строк {counts.get(table)}, ожидалось {rows}")
+    return errors
+
+
+def verify_backup(name=None, backup_dir=DEFAULT_DIR, restore_to=None):
+    """Разворачивает снимок во временные файлы и проверяет его.
+
+    Сверяются контрольные суммы, integrity_check, foreign_key_check и число
+    строк в таблицах — у основной базы и у каждой связанной. Результат
+    дописывается в манифест. С restore_to основная база остаётся по этому
+    пути, связанные — рядом под своими именами файлов, и только если
+    проверку прошли все (существующие файлы не трогаются).
+    """
+    if name is None:
+        backups = list_backups(backup_dir, backup_prefix(DEFAULT_DB))
+        if not backups:
+            raise BackupError("снимков нет")
+        name = backups[0]["name"]
+    manifest = load_manifest(backup_dir, name)
+    parts = [(name, manifest, restore_to)]
+    for part in manifest.get("attached", []):
+        target = os.path.join(os.path.dirname(restore_to), part["file"]) if restore_to else None
+        parts.append((part["name"], part, target))
+    for _, _, target in parts:
+        if target and os.path.exists(target):
+            raise BackupError(f"{target} уже существует")
+
+    started = time.perf_counter()
+    errors = []
+    restored = {
+        part_name: os.path.join(backup_dir, part_name + ".restore.tmp") for part_name, _, _ in parts
+    }
+    try:
+        for part_name, info, _ in parts:
+            try:
+                gz_path = _snapshot_path(backup_dir, part_name)
+                errors.extend(_check_snapshot(gz_path, info, restored[part_name]))
+            except BackupError as e:
+                errors.append(str(e))
+        if restore_to and not errors:
+            for part_name, _, target in parts:
+                shutil.move(restored[part_name], target)
+    finally:
+        for path in restored.values():
+            if os.path.exists(path):
+                os.remove(path)
+
+    manifest["verified"] = {
+        "at": datetime.utcnow().isoformat(timespec="seconds"),
+        "ok": not errors,
+        "errors": errors,
+        "duration": round(time.perf_counter() - started, 3),
+    }
+    _write_manifest(backup_dir, manifest)
+    return manifest
+
+
+# --- командная строка ---
+
+def _size(n):
+    return f"{n / 1024 / 1024:.1f} МБ"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Резервные копии базы FairMarket")
+    parser.add_argument("--dir", default=DEFAULT_DIR, help="каталог снимков")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_create = sub.add_parser("create", help="снять копию")
+    p_create.add_argument("--db", default=DEFAULT_DB)
+    p_create.add_argument("--pages", type=int, default=BACKUP_PAGES, help="страниц за шаг")
+    p_create.add_argument("--sleep", type=float, default=BACKUP_SLEEP, help="пауза между шагами, с")
+    p_create.add_argument("--keep", type=int, default=BACKUP_KEEP, help="сколько снимков хранить")
+    p_create.add_argument(
+        "--attach", action="append",
+        help="связанная база в тот же снимок; по умолчанию database/archive.db, если есть",
+    )
+
+    sub.add_parser("list", help="список снимков")
+
+    p_verify = sub.add_parser("verify", help="проверить снимок восстановлением")
+    p_verify.add_argument("name", nargs="?", help="имя снимка, по умолчанию последний")
+    p_verify.add_argument("--restore-to", help="оставить развёрнутую базу по этому пути")
+
+    args = parser.parse_args(argv)
+
+    try:
+        if args.cmd == "create":
+            attached = args.attach
+            if attached is None:
+                attached = [DEFAULT_ARCHIVE] if os.path.exists(DEFAULT_ARCHIVE) else []
+            m = create_backup(
+                args.db, args.dir, pages=args.pages, sleep=args.sleep, keep=args.keep,
+                attached=attached,
+            )
+            print(
+                f"{m['name']}: {_size(m['size'])} → {_size(m['gz_size'])}, "
+                f"шагов {m['steps']}, перезапусков {m['restarts']}, {m['duration']:.1f} с"
+            )
+            for name in m["removed"]:
+                print(f"  удалён старый снимок {name}")
+        elif args.cmd == "list":
+            for m in list_backups(args.dir):
+                verified = m.get("verified")
+                status = "не проверен" if not verified else ("ок" if verified["ok"] else "ОШИБКИ")
+                print(f"{m['name']}  {_size(m['gz_size']):>10}  {status}")
+        else:
+            m = verify_backup(args.name, args.dir, restore_to=args.restore_to)
+            verified = m["verified"]
+            if verified["ok"]:
+                print(f"{m['name']}: проверка пройдена за {verified['duration']:.1f} с")
+            else:
+                print(f"{m['name']}: проверка НЕ пройдена", file=sys.stderr)
+                for error in verified["errors"]:
+                    print(f"  {error}", file=sys.stderr)
+                sys.exit(1)
+    except BackupError as e:
+        print(f"Ошибка: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""Сравнение списков на ORM-объектах и на лёгких строках (namedtuple).
+
+Для каждого списка выполняет «старый» запрос (целые сущности через ORM, как
+раньше во вьюхах) и «новый» (только нужные столбцы в namedtuple), меряет
+время и пик памяти (tracemalloc). Имеет смысл гонять на большой базе.
+
+Примеры:
+    python bench_list_views.py
+    python bench_list_views.py --repeat 10
+"""
+import argparse
+import gc
+import statistics
+import time
+import tracemalloc
+
+from sqlalchemy import select
+
+from app import (
+    app, db, User, SupportMessage, AdRequest, Ad, Street,
+    fetch_rows, UserRow, USER_ROWS, SupportRow, SUPPORT_ROWS,
+    AdRequestRow, AD_REQUEST_ROWS, AdCard, AD_CARDS, StreetCard, STREET_CARDS,
+    ThreadRow, MASTER_THREADS, USER_THREADS, AdMessage,
+)
+
+
+def orm_users():
+    return [(u.id, u.username, u.email, u.role) for u in User.query.order_by(User.id).all()]
+
+
+def orm_support():
+    rows = SupportMessage.query.order_by(SupportMessage.created_at.desc()).all()
+    return [(m.id, m.user.username if m.user else None) for m in rows]
+
+
+def orm_ad_requests():
+    rows = AdRequest.query.order_by(AdRequest.created_at.desc()).all()
+    return [(r.id, r.user.username if r.user else None) for r in rows]
+
+
+def orm_featured():
+    rows = Ad.query.filter_by(deleted_at=None).order_by(Ad.id.desc()).limit(12).all()
+    return [(a.id, a.pavilion.title if a.pavilion else None) for a in rows]
+
+
+def orm_streets():
+    return [(s.id, len(s.pavilions)) for s in Street.query.order_by(Street.id).all()]
+
+
+def orm_master_threads(user_id):
+    """Как раньше собирались диалоги мастера: все сообщения его объявлений."""
+    ad_map = {a.id: a for a in Ad.query.filter_by(master_id=user_id, deleted_at=None).all()}
+    msgs = (
+        AdMessage.query.filter(AdMessage.ad_id.in_(list(ad_map)))
+        .order_by(AdMessage.created_at)
+        .all()
+    )
+    threads = {}
+    for m in msgs:
+        peer = m.receiver_id if m.sender_id == user_id else m.sender_id
+        t = threads.setdefault((m.ad_id, peer), {"ad": ad_map[m.ad_id], "unread": 0})
+        t["last_time"] = m.created_at
+        if m.receiver_id == user_id and not m.is_read:
+            t["unread"] += 1
+    for t in threads.values():
+        t["title"] = t["ad"].pavilion.title if t["ad"].pavilion else None
+    return threads
+
+
+def orm_user_threads(user_id):
+    """Как раньше собирались диалоги пользователя."""
+    msgs = (
+        AdMessage.query.filter(
+            (AdMessage.sender_id == user_id) | (AdMessage.receiver_id == user_id)
+        )
+        .order_by(AdMessage.created_at)
+        .all()
+    )
+    ad_map = {
+        a.id: a
+        for a in Ad.query.filter(Ad.id.in_({m.ad_id for m in msgs}), Ad.deleted_at.is_(None))
+    }
+    threads = {}
+    for m in msgs:
+        ad = ad_map.get(m.ad_id)
+        if ad is None or not ad.master_id:
+            continue
+        t = threads.setdefault((m.ad_id, ad.master_id), {"ad": ad, "unread": 0})
+        t["last_time"] = m.created_at
+        if m.receiver_id == user_id and not m.is_read:
+            t["unread"] += 1
+    for t in threads.values():
+        t["master"] = db.session.get(User, t["ad"].master_id)
+    return threads
+
+
+def busiest(column, role):
+    """Пользователь с указанной ролью, у которого больше всего строк."""
+    row = db.session.execute(
+        select(column, db.func.count())
+        .join(User, User.id == column)
+        .where(User.role == role)
+        .group_by(column)
+        .order_by(db.func.count().desc())
+        .limit(1)
+    ).first()
+    return row[0] if row else 0
+
+
+def measure(fn, repeat):
+    """Среднее время (мс) и пик памяти (КБ) одного вызова."""
+    times = []
+    for _ in range(repeat):
+        db.session.expunge_all()
+        t0 = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - t0) * 1000)
+
+    db.session.expunge_all()
+    gc.collect()
+    tracemalloc.start()
+    result = fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    return statistics.mean(times), peak / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк списков: ORM против namedtuple")
+    parser.add_argument("--repeat", type=int, default=5, help="прогонов каждого запроса")
+    args = parser.parse_args()
+
+    master_id = busiest(Ad.master_id, "master")
+    sender_id = busiest(AdMessage.sender_id, "user")
+
+    cases = [
+        ("admin_users", orm_users, lambda: fetch_rows(UserRow, USER_ROWS.order_by(User.id))),
+        ("admin_support", orm_support,
+         lambda: fetch_rows(SupportRow, SUPPORT_ROWS.order_by(SupportMessage.id.desc()))),
+        ("admin_ad_requests", orm_ad_requests,
+         lambda: fetch_rows(AdRequestRow, AD_REQUEST_ROWS.order_by(AdRequest.id.desc()))),
+        ("index: объявления", orm_featured, lambda: fetch_rows(AdCard, AD_CARDS.limit(12))),
+        ("index: улицы", orm_streets, lambda: fetch_rows(StreetCard, STREET_CARDS)),
+        ("ad_messages", lambda: orm_master_threads(master_id),
+         lambda: fetch_rows(ThreadRow, MASTER_THREADS, {"uid": master_id})),
+        ("user_messages", lambda: orm_user_threads(sender_id),
+         lambda: fetch_rows(ThreadRow, USER_THREADS, {"uid": sender_id})),
+    ]
+
+    print(f"Строк: users={User.query.count()}, support={SupportMessage.query.count()}, "
+          f"ad_messages={AdMessage.query.count()}")
+    print(f"{'список':<24} {'ORM мс':>9} {'DTO мс':>9} {'ORM КБ':>10} {'DTO КБ':>10}")
+    for name, old, new in cases:
+        old_ms, old_kb = measure(old, args.repeat)
+        new_ms, new_kb = measure(new, args.repeat)
+        print(f"{name:<24} {old_ms:9.1f} {new_ms:9.1f} {old_kb:10.0f} {new_kb:10.0f}")
+
+
+if __name__ == "__main__":
+    with app.app_context():
+        main()
@@ -0,0 +1,141 @@
+"""Замер времени загрузки и рендера шаблонов.
+
+Для каждого шаблона:
+  * загрузка из исходника (компиляция) и из кэша байткода;
+  * время render() внутри настоящих запросов к страницам — гостем,
+    мастером и администратором (сигналы before_render_template/template_rendered).
+
+Примеры:
+    python bench_templates.py
+    python bench_templates.py --repeat 50
+"""
+import argparse
+import statistics
+import time
+
+from flask import before_render_template, template_rendered, url_for
+
+from app import app, Street, Pavilion, Ad, User
+
+
+def measure_load(env, name, repeat):
+    """Среднее время загрузки шаблона (мс) без кэша байткода и с ним."""
+    bcc = env.bytecode_cache
+    result = {}
+    for label, cache in (("source", None), ("bytecode", bcc)):
+        env.bytecode_cache = cache
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            env.loader.load(env, name)
+        result[label] = (time.perf_counter() - t0) * 1000 / repeat
+    env.bytecode_cache = bcc
+    return result
+
+
+def bench_pages():
+    """Страницы для прогона: (кто смотрит, адрес)."""
+    street = Street.query.order_by(Street.id).first()
+    pavilion = Pavilion.query.filter_by(deleted_at=None).order_by(Pavilion.id).first()
+    ad = Ad.query.filter_by(deleted_at=None).order_by(Ad.id).first()
+
+    pages = [
+        (None, url_for("index")),
+        (None, url_for("how_it_works")),
+        (None, url_for("about")),
+        (None, url_for("login")),
+        (None, url_for("register")),
+    ]
+    if street:
+        pages.append((None, url_for("street_page", code=street.code)))
+    if pavilion:
+        pages.append((None, url_for("pavilion_page", pavilion_id=pavilion.id)))
+    if ad:
+        pages.append((None, url_for("ad_page", ad_id=ad.id)))
+
+    pages += [
+        ("master", url_for("ad_messages")),
+        ("admin", url_for("admin_dashboard")),
+        ("admin", url_for("admin_requests")),
+        ("admin", url_for("admin_ad_requests")),
+        ("admin", url_for("admin_support")),
+        ("admin", url_for("admin_users")),
+        ("admin", url_for("admin_jobs")),
+        ("admin", url_for("admin_deletions")),
+    ]
+    return pages
+
+
+def login_as(client, role):
+    with client.session_transaction() as sess:
+        sess.clear()
+        if role is None:
+            return
+        user = User.query.filter_by(role=role, deleted_at=None).first()
+        if user is None:
+            return
+        sess["user_id"] = user.id
+        sess["user_role"] = user.role
+        sess["username"] = user.username
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк шаблонов")
+    parser.add_argument("--repeat", type=int, default=20, help="прогонов каждой страницы")
+    args = parser.parse_args()
+
+    env = app.jinja_env
+    renders = {}
+    started = {}
+
+    def on_before(sender, template, context, **extra):
+        started[template.name] = time.perf_counter()
+
+    def on_rendered(sender, template, context, **extra):
+        t0 = started.pop(template.name, None)
+        if t0 is not None:
+            renders.setdefault(template.name, []).append(
+                (time.perf_counter() - t0) * 1000
+            )
+
+    before_render_template.connect(on_before, app)
+    template_rendered.connect(on_rendered, app)
+
+    with app.test_request_context():
+        pages = bench_pages()
+
+    client = app.test_client()
+    for role, path in pages:
+        for _ in range(args.repeat):
+            login_as(client, role)
+            resp = client.get(path)
+            if resp.status_code != 200:
+                print(f"  {path}: HTTP {resp.status_code}")
+                break
+
+    # чтобы байткод точно был в кэше
+    for name in env.list_templates(extensions=["html"]):
+        env.get_template(name)
+
+    print("Время в мс: загрузка из исходника / из байткода, рендер в запросах")
+    print(
+        f"{'шаблон':<34} {'исходник':>9} {'байткод':>9} "
+        f"{'рендеров':>9} {'рендер ср.':>11} {'p95':>8}"
+    )
+    rows = []
+    for name in env.list_templates(extensions=["html"]):
+        load = measure_load(env, name, repeat=5)
+        times = renders.get(name, [])
+        mean = statistics.mean(times) if times else 0.0
+        p95 = sorted(times)[int(len(times) * 0.95) - 1] if times else 0.0
+        rows.append((mean, name, load, len(times), p95))
+
+    for mean, name, load, count, p95 in sorted(rows, key=lambda r: r[0], reverse=True):
+        print(
+            f"{name:<34} {load['source']:9.2f} {load['bytecode']:9.2f} "
+            f"{count:9d} {mean:11.2f} {p95:8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    with app.app_context():
+        main()
@@ -0,0 +1,360 @@
+"""Двухуровневый кэш: локальный LRU в памяти воркера + общий слой в SQLite.
+
+Воркеры (prefork, несколько процессов) не видят память друг друга, поэтому
+всё, что кладётся в кэш, пишется ещё и в общий файл SQLite. Промах в локальном
+LRU сначала идёт туда и только потом к вызывающему коду.
+
+Ключи имеют вид "пространство:имя" ("counters:admin", "featured:ids").
+Сброс делается целым пространством через invalidate(): в общей базе растёт
+номер версии пространства, и все воркеры выбрасывают свои локальные копии.
+Чтобы не читать таблицу версий на каждый get(), воркер раз в check_interval
+секунд спрашивает PRAGMA data_version — число меняется, только если другое
+соединение что-то записало в файл кэша.
+
+Подключение:
+    cache = Cache("cache/shared.db", local_size=2048)
+    value = cache.get_or_set("counters:admin", compute_counters, ttl=60)
+    cache.invalidate("counters")
+"""
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache_entries (
+    key TEXT PRIMARY KEY,
+    namespace TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    expires REAL NOT NULL,
+    value BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_cache_entries_expires ON cache_entries (expires);
+CREATE TABLE IF NOT EXISTS cache_versions (
+    namespace TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+"""
+
+STAT_NAMES = (
+    "local_hits",
+    "shared_hits",
+    "misses",
+    "sets",
+    "updates",
+    "expired",
+    "local_evictions",
+    "shared_evictions",
+    "invalidations",
+    "errors",
+)
+
+
+def _namespace(key):
+    return key.split(":", 1)[0]
+
+
+class Cache:
+    def __init__(self, path, local_size=1024, default_ttl=300, shared_size=10000,
+                 check_interval=0.5, prune_every=200):
+        """check_interval — как часто (с) проверять сбросы из других воркеров."""
+        self.path = path
+        self.local_size = local_size
+        self.default_ttl = default_ttl
+        self.shared_size = shared_size
+        self.check_interval = check_interval
+        self.prune_every = prune_every
+
+        self._local = OrderedDict()  # key -> (expires, version, value)
+        self._versions = {}  # namespace -> версия, которую видел этот процесс
+        self._checked = 0.0
+        self._sets_since_prune = 0
+        self._lock = threading.Lock()
+        self._thread = threading.local()
+        self._stats = dict.fromkeys(STAT_NAMES, 0)
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    # --- соединение с общим слоем ---
+
+    def _conn(self):
+        """Своё соединение на каждый поток; после fork создаётся заново."""
+        state = self._thread
+        if getattr(state, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            state.conn = conn
+            state.pid = os.getpid()
+            state.data_version = None
+        return state.conn
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._stats[name] += n
+
+    # --- синхронизация версий между воркерами ---
+
+    def _sync(self):
+        now = time.monotonic()
+        if now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        try:
+            conn = self._conn()
+            data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self._thread.data_version:
+                return
+            self._thread.data_version = data_version
+            rows = conn.execute("SELECT namespace, version FROM cache_versions").fetchall()
+        except sqlite3.Error:
+            self._count("errors")
+            return
+        with self._lock:
+            changed = {ns for ns, version in rows if self._versions.get(ns, 0) != version}
+            if not changed:
+                return
+            self._versions.update(rows)
+            self._drop_local(changed)
+
+    def _drop_local(self, namespaces):
+        # вызывается под self._lock
+        for key in [k for k in self._local if _namespace(k) in namespaces]:
+            del self._local[key]
+
+    def version(self, namespace):
+        with self._lock:
+            return self._versions.get(namespace, 0)
+
+    # --- чтение и запись ---
+
+    def get(self, key, default=None):
+        self._sync()
+        ns = _namespace(key)
+        now = time.time()
+        with self._lock:
+            item = self._local.get(key)
+            if item is not None:
+                expires, version, value = item
+                if expires > now and version == self._versions.get(ns, 0):
+                    self._local.move_to_end(key)
+                    self._stats["local_hits"] += 1
+                    return value
+                del self._local[key]
+                self._stats["expired"] += 1
+            current = self._versions.get(ns, 0)
+
+        try:
+            row = self._conn().execute(
+                "SELECT version, expires, value FROM cache_entries WHERE key = ?", (key,)
+            ).fetchone()
+        except sqlite3.Error:
+            self._count("errors")
+            row = None
+
+        if row is not None:
+            version, expires, blob = row
+            if expires > now and version == current:
+                value = pickle.loads(blob)
+                self._put_local(key, expires, version, value)
+                self._count("shared_hits")
+                return value
+            self._count("expired")
+
+        self._count("misses")
+        return default
+
+    def set(self, key, value, ttl=None, version=None):
+        """version — версия пространства, при которой значение посчитано.
+
+        Если за это время пространство сбросили, запись сразу считается
+        устаревшей и не вернётся из get().
+        """
+        ns = _namespace(key)
+        if version is None:
+            version = self.version(ns)
+        expires = time.time() + (self.default_ttl if ttl is None else ttl)
+        self._put_local(key, expires, version, value)
+        self._count("sets")
+        try:
+            self._conn().execute(
+                "INSERT OR REPLACE INTO cache_entries (key, namespace, version, expires, value) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, ns, version, expires, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)),
+            )
+        except sqlite3.Error:
+            self._count("errors")
+            return
+
+        with self._lock:
+            self._sets_since_prune += 1
+            if self._sets_since_prune < self.prune_every:
+                return
+            self._sets_since_prune = 0
+        self.prune()
+
+    def get_or_set(self, key, factory, ttl=None):
+        value = self.get(key, MISSING)
+        if value is MISSING:
+            version = self.version(_namespace(key))
+            value = factory()
+            self.set(key, value, ttl=ttl, version=version)
+        return value
+
+    def update(self, key, func):
+        """Атомарно заменяет значение на func(value) в общем слое.
+
+        Под блокировкой записи SQLite, поэтому параллельные поправки из разных
+        воркеров не теряются. Версия пространства растёт, как при invalidate(),
+        но остальные записи пространства остаются в общем слое: другие воркеры
+        просто перечитают их оттуда. Если свежей записи нет, значение не
+        создаётся (его посчитает следующий get_or_set()), а версия всё равно
+        растёт — чтобы не записалось значение, посчитанное до поправки.
+        Возвращает новое значение или None.
+        """
+        ns = _namespace(key)
+        value = None
+        try:
+            conn = self._conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = conn.execute(
+                    "INSERT INTO cache_versions (namespace, version) VALUES (?, 1) "
+                    "ON CONFLICT (namespace) DO UPDATE SET version = version + 1 "
+                    "RETURNING version",
+                    (ns,),
+                ).fetchone()[0]
+                row = conn.execute(
+                    "SELECT version, expires, value FROM cache_entries WHERE key = ?", (key,)
+                ).fetchone()
+                conn.execute(
+                    "UPDATE cache_entries SET version = ? WHERE namespace = ? AND version = ?",
+                    (version, ns, version - 1),
+                )
+                if row is not None and row[0] == version - 1 and row[1] > time.time():
+                    value = func(pickle.loads(row[2]))
+                    conn.execute(
+                        "UPDATE cache_entries SET value = ? WHERE key = ?",
+                        (pickle.dumps(value, pickle.HIGHEST_PROTOCOL), key),
+                    )
+                    expires = row[1]
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error:
+            # без общего слоя поправить значение надёжно нельзя — сбрасываем
+            self._count("errors")
+            self.invalidate(ns)
+            return None
+
+        with self._lock:
+            self._versions[ns] = max(version, self._versions.get(ns, 0))
+            self._drop_local({ns})
+            self._stats["updates"] += 1
+        if value is not None:
+            self._put_local(key, expires, version, value)
+        return value
+
+    def _put_local(self, key, expires, version, value):
+        with self._lock:
+            self._local[key] = (expires, version, value)
+            self._local.move_to_end(key)
+            while len(self._local) > self.local_size:
+                self._local.popitem(last=False)
+                self._stats["local_evictions"] += 1
+
+    # --- сброс ---
+
+    def invalidate(self, namespace):
+        """Сбрасывает пространство во всех воркерах."""
+        try:
+            conn = self._conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = conn.execute(
+                    "INSERT INTO cache_versions (namespace, version) VALUES (?, 1) "
+                    "ON CONFLICT (namespace) DO UPDATE SET version = version + 1 "
+                    "RETURNING version",
+                    (namespace,),
+                ).fetchone()[0]
+                conn.execute("DELETE FROM cache_entries WHERE namespace = ?", (namespace,))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error:
+            self._count("errors")
+            version = self.version(namespace) + 1
+
+        with self._lock:
+            self._versions[namespace] = max(version, self._versions.get(namespace, 0))
+            self._drop_local({namespace})
+            self._stats["invalidations"] += 1
+
+    def clear(self):
+        """Сбрасывает все пространства, о которых знает общий слой."""
+        try:
+            rows = self._conn().execute(
+                "SELECT namespace FROM cache_versions "
+                "UNION SELECT DISTINCT namespace FROM cache_entries"
+            ).fetchall()
+        except sqlite3.Error:
+            self._count("errors")
+            rows = []
+        with self._lock:
+            namespaces = {ns for (ns,) in rows} | {_namespace(k) for k in self._local}
+        for ns in namespaces:
+            self.invalidate(ns)
+
+    def prune(self):
+        """Удаляет из общего слоя просроченное и самые старые записи сверх shared_size."""
+        try:
+            conn = self._conn()
+            expired = conn.execute(
+                "DELETE FROM cache_entries WHERE expires <= ?", (time.time(),)
+            ).rowcount
+            extra = conn.execute("SELECT COUNT(*) FROM cache_entries").fetchone()[0] - self.shared_size
+            evicted = 0
+            if extra > 0:
+                evicted = conn.execute(
+                    "DELETE FROM cache_entries WHERE key IN "
+                    "(SELECT key FROM cache_entries ORDER BY expires LIMIT ?)",
+                    (extra,),
+                ).rowcount
+        except sqlite3.Error:
+            self._count("errors")
+            return
+        with self._lock:
+            self._stats["expired"] += expired
+            self._stats["shared_evictions"] += evicted
+
+    # --- статистика ---
+
+    def stats(self):
+        """Счётчики этого процесса и размеры обоих слоёв."""
+        with self._lock:
+            result = dict(self._stats)
+            result["local_entries"] = len(self._local)
+            result["versions"] = dict(sorted(self._versions.items()))
+        result["local_size"] = self.local_size
+        result["shared_size"] = self.shared_size
+        try:
+            result["shared_entries"] = self._conn().execute(
+                "SELECT COUNT(*) FROM cache_entries"
+            ).fetchone()[0]
+        except sqlite3.Error:
+            result["shared_entries"] = None
+        lookups = result["local_hits"] + result["shared_hits"] + result["misses"]
+        result["lookups"] = lookups
+        result["hit_ratio"] = (result["local_hits"] + result["shared_hits"]) / lookups if lookups else 0.0
+        return result
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = dict.fromkeys(STAT_NAMES, 0)
@@ -0,0 +1,448 @@
+"""Импорт и экспорт каталога (улицы, павильоны, объявления).
+
+Формат записи (CSV с заголовком или JSONL) — одна плоская строка:
+
+    street_code, street_name, pavilion_title, pavilion_description,
+    ad_title, ad_text, author_name, master
+
+Улица ищется по коду, павильон — по названию внутри улицы, объявление —
+по заголовку внутри павильона. Если запись уже есть, она обновляется,
+а не создаётся заново, поэтому повторный импорт ничего не ломает и
+переписки по объявлениям остаются на месте.
+
+Примеры:
+    python catalog_io.py import catalog.csv
+    python catalog_io.py import catalog.jsonl --chunk 1000 --dry-run
+    python catalog_io.py export catalog.csv
+    python catalog_io.py export - --format jsonl > catalog.jsonl
+"""
+import argparse
+import csv
+import json
+import sys
+import time
+
+from sqlalchemy import insert, select, update
+from sqlalchemy.orm import aliased
+
+from app import app, db, record_changes, Street, Pavilion, Ad, User
+
+FIELDS = [
+    "street_code",
+    "street_name",
+    "pavilion_title",
+    "pavilion_description",
+    "ad_title",
+    "ad_text",
+    "author_name",
+    "master",
+]
+
+# ограничения длины берём из моделей
+MAX_LEN = {
+    "street_code": Street.__table__.c.code.type.length,
+    "street_name": Street.__table__.c.name.type.length,
+    "pavilion_title": Pavilion.__table__.c.title.type.length,
+    "ad_title": Ad.__table__.c.title.type.length,
+    "author_name": Ad.__table__.c.author_name.type.length,
+}
+
+
+class RowError(ValueError):
+    """Ошибка валидации одной строки файла."""
+
+
+def detect_format(path: str, fmt: str | None) -> str:
+    if fmt:
+        return fmt
+    if path.endswith(".jsonl") or path.endswith(".ndjson"):
+        return "jsonl"
+    return "csv"
+
+
+# ===== ЧТЕНИЕ =====
+
+
+def read_records(fh, fmt: str):
+    """Построчно отдаёт (номер строки, dict) без загрузки файла целиком."""
+    if fmt == "jsonl":
+        for line_no, line in enumerate(fh, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                data = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield line_no, RowError(f"некорректный JSON: {e.msg}")
+                continue
+            if not isinstance(data, dict):
+                yield line_no, RowError("ожидался JSON-объект")
+                continue
+            yield line_no, data
+    else:
+        reader = csv.DictReader(fh)
+        for data in reader:
+            yield reader.line_num, data
+
+
+def clean_record(raw: dict, masters: dict) -> dict:
+    """Проверка и нормализация одной записи."""
+    rec = {}
+    for name in FIELDS:
+        value = raw.get(name)
+        if value is None:
+            value = ""
+        if not isinstance(value, str):
+            value = str(value)
+        rec[name] = value.strip()
+
+    code = rec["street_code"]
+    if not code:
+        raise RowError("не указан street_code")
+    cleaned = code.replace("_", "")
+    # islower() ложно для кода из одних цифр, поэтому сравниваем с lower()
+    if not cleaned.isalnum() or code != code.lower() or not code.isascii():
+        raise RowError(
+            "street_code только строчными латинскими буквами, цифрами и подчёркиваниями"
+        )
+
+    if rec["ad_title"] and not rec["pavilion_title"]:
+        raise RowError("объявление без павильона (pavilion_title пустой)")
+    if rec["ad_title"] and not rec["ad_text"]:
+        raise RowError("у объявления нет текста (ad_text)")
+    if rec["ad_text"] and not rec["ad_title"]:
+        raise RowError("у объявления нет заголовка (ad_title)")
+
+    if rec["master"] and rec["master"] not in masters:
+        raise RowError(f"мастер {rec['master']!r} не найден")
+
+    for name, limit in MAX_LEN.items():
+        if limit and len(rec[name]) > limit:
+            raise RowError(f"{name} длиннее {limit} символов")
+
+    return rec
+
+
+# ===== ЗАПИСЬ ПАЧКИ =====
+
+
+def upsert_chunk(chunk: list[tuple[int, dict]], masters: dict, stats: dict) -> list:
+    """Upsert одной пачки: по одному SELECT и по одному bulk INSERT/UPDATE на таблицу.
+
+    Возвращает список (номер строки, ошибка) для пропущенных записей.
+    """
+    skipped = []
+
+    # --- улицы ---
+    codes = {r["street_code"] for _, r in chunk}
+    street_ids = dict(
+        db.session.execute(
+            select(Street.code, Street.id).where(Street.code.in_(codes))
+        ).all()
+    )
+
+    new_streets = {}
+    upd_streets = {}
+    for _, r in chunk:
+        code = r["street_code"]
+        if not r["street_name"]:
+            continue
+        if code in street_ids:
+            upd_streets[code] = {"id": street_ids[code], "name": r["street_name"]}
+        else:
+            new_streets[code] = {"code": code, "name": r["street_name"]}
+
+    # без названия новую улицу не создать
+    records = []
+    for line_no, r in chunk:
+        code = r["street_code"]
+        if code in street_ids or code in new_streets:
+            records.append(r)
+        else:
+            skipped.append((line_no, f"улицы {code!r} нет, нужен street_name"))
+
+    if new_streets:
+        db.session.execute(insert(Street), list(new_streets.values()))
+        street_ids.update(
+            db.session.execute(
+                select(Street.code, Street.id).where(Street.code.in_(new_streets))
+            ).all()
+        )
+        record_changes("streets", [street_ids[code] for code in new_streets])
+        stats["streets_new"] += len(new_streets)
+    if upd_streets:
+        db.session.execute(update(Street), list(upd_streets.values()))
+        record_changes("streets", [row["id"] for row in upd_streets.values()])
+        stats["streets_upd"] += len(upd_streets)
+
+    # --- павильоны (ключ: улица + название) ---
+    pav_records = [r for r in records if r["pavilion_title"]]
+    if not pav_records:
+        return skipped
+
+    sids = {street_ids[r["street_code"]] for r in pav_records}
+    pav_ids = {
+        (sid, title): pid
+        for pid, sid, title in db.session.execute(
+            select(Pavilion.id, Pavilion.street_id, Pavilion.title).where(
+                Pavilion.street_id.in_(sids)
+            )
+        )
+    }
+
+    new_pavs = {}
+    upd_pavs = {}
+    for r in pav_records:
+        key = (street_ids[r["street_code"]], r["pavilion_title"])
+        row = {"title": key[1], "street_id": key[0]}
+        if r["pavilion_description"]:
+            row["description"] = r["pavilion_description"]
+        if key in pav_ids:
+            if "description" in row:
+                upd_pavs[key] = {"id": pav_ids[key], "description": row["description"]}
+        else:
+            row.setdefault("description", None)
+            new_pavs[key] = row
+
+    if new_pavs:
+        db.session.execute(insert(Pavilion), list(new_pavs.values()))
+        pav_ids.update(
+            {
+                (sid, title): pid
+                for pid, sid, title in db.session.execute(
+                    select(Pavilion.id, Pavilion.street_id, Pavilion.title).where(
+                        Pavilion.street_id.in_({k[0] for k in new_pavs})
+                    )
+                )
+            }
+        )
+        record_changes("pavilions", [pav_ids[key] for key in new_pavs])
+        stats["pavilions_new"] += len(new_pavs)
+    if upd_pavs:
+        db.session.execute(update(Pavilion), list(upd_pavs.values()))
+        record_changes("pavilions", [row["id"] for row in upd_pavs.values()])
+        stats["pavilions_upd"] += len(upd_pavs)
+
+    # --- объявления (ключ: павильон + заголовок) ---
+    ad_records = [r for r in pav_records if r["ad_title"]]
+    if not ad_records:
+        return skipped
+
+    pids = {pav_ids[(street_ids[r["street_code"]], r["pavilion_title"])] for r in ad_records}
+    ad_ids = {
+        (pid, title): aid
+        for aid, pid, title in db.session.execute(
+            select(Ad.id, Ad.pavilion_id, Ad.title).where(Ad.pavilion_id.in_(pids))
+        )
+    }
+
+    new_ads = {}
+    upd_ads = {}
+    for r in ad_records:
+        pid = pav_ids[(street_ids[r["street_code"]], r["pavilion_title"])]
+        key = (pid, r["ad_title"])
+        row = {"text": r["ad_text"]}
+        if r["author_name"]:
+            row["author_name"] = r["author_name"]
+        if r["master"]:
+            row["master_id"] = masters[r["master"]]
+
+        if key in ad_ids:
+            row["id"] = ad_ids[key]
+            upd_ads[key] = row
+        else:
+            row.update({"title": key[1], "pavilion_id": pid})
+            # в старых базах author_name NOT NULL — подставляем логин мастера
+            row.setdefault("author_name", r["master"])
+            row.setdefault("master_id", None)
+            new_ads[key] = row
+
+    if new_ads:
+        record_changes(
+            "ads",
+            db.session.execute(
+                insert(Ad).returning(Ad.id), list(new_ads.values())
+            ).scalars().all(),
+        )
+        stats["ads_new"] += len(new_ads)
+    if upd_ads:
+        # bulk UPDATE по первичному ключу требует одинаковый набор колонок
+        by_cols = {}
+        for row in upd_ads.values():
+            by_cols.setdefault(tuple(sorted(row)), []).append(row)
+        for rows in by_cols.values():
+            db.session.execute(update(Ad), rows)
+        record_changes("ads", [row["id"] for row in upd_ads.values()])
+        stats["ads_upd"] += len(upd_ads)
+
+    return skipped
+
+
+def import_catalog(path: str, fmt: str | None = None, chunk_size: int = 500,
+                   dry_run: bool = False, strict: bool = False) -> dict:
+    fmt = detect_format(path, fmt)
+    stats = {
+        "rows": 0,
+        "errors": 0,
+        "streets_new": 0,
+        "streets_upd": 0,
+        "pavilions_new": 0,
+        "pavilions_upd": 0,
+        "ads_new": 0,
+        "ads_upd": 0,
+    }
+    started = time.monotonic()
+
+    with app.app_context():
+        masters = dict(
+            db.session.execute(
+                select(User.username, User.id).where(User.role == "master")
+            ).all()
+        )
+
+        def flush(chunk: list[tuple[int, dict]]) -> None:
+            if not chunk:
+                return
+            skipped = upsert_chunk(chunk, masters, stats)
+            for line_no, msg in skipped:
+                stats["errors"] += 1
+                print(f"  строка {line_no}: {msg}", file=sys.stderr)
+            if skipped and strict:
+                db.session.rollback()
+                raise SystemExit(1)
+
+            # dry-run идёт одной транзакцией и откатывается в конце: иначе
+            # улицы и павильоны из прошлых пачек «пропадали» бы для следующих
+            if not dry_run:
+                db.session.commit()
+
+            elapsed = time.monotonic() - started
+            print(
+                f"[import] {stats['rows']} строк, {elapsed:.1f} с — "
+                f"улицы +{stats['streets_new']}/~{stats['streets_upd']}, "
+                f"павильоны +{stats['pavilions_new']}/~{stats['pavilions_upd']}, "
+                f"объявления +{stats['ads_new']}/~{stats['ads_upd']}",
+                file=sys.stderr,
+            )
+
+        chunk = []
+        try:
+            with open(path, encoding="utf-8", newline="") as fh:
+                for line_no, raw in read_records(fh, fmt):
+                    stats["rows"] += 1
+                    try:
+                        if isinstance(raw, RowError):
+                            raise raw
+                        rec = clean_record(raw, masters)
+                    except RowError as e:
+                        stats["errors"] += 1
+                        print(f"  строка {line_no}: {e}", file=sys.stderr)
+                        if strict:
+                            raise SystemExit(1)
+                        continue
+
+                    chunk.append((line_no, rec))
+                    if len(chunk) >= chunk_size:
+                        flush(chunk)
+                        chunk = []
+
+            flush(chunk)
+        finally:
+            if dry_run:
+                db.session.rollback()
+
+    return stats
+
+
+# ===== ЭКСПОРТ =====
+
+
+def iter_catalog(batch_size: int = 1000):
+    """Строки каталога прямо из курсора, без построения ORM-объектов."""
+    master = aliased(User)
+    stmt = (
+        select(
+            Street.code.label("street_code"),
+            Street.name.label("street_name"),
+            Pavilion.title.label("pavilion_title"),
+            Pavilion.description.label("pavilion_description"),
+            Ad.title.label("ad_title"),
+            Ad.text.label("ad_text"),
+            Ad.author_name.label("author_name"),
+            master.username.label("master"),
+        )
+        .select_from(Street)
+        .outerjoin(Pavilion, Pavilion.street_id == Street.id)
+        .outerjoin(Ad, Ad.pavilion_id == Pavilion.id)
+        .outerjoin(master, master.id == Ad.master_id)
+        .order_by(Street.id, Pavilion.id, Ad.id)
+        .execution_options(yield_per=batch_size)
+    )
+    for row in db.session.execute(stmt):
+        yield {k: ("" if v is None else v) for k, v in row._mapping.items()}
+
+
+def export_catalog(path: str, fmt: str | None = None) -> int:
+    fmt = detect_format(path, fmt)
+    out = sys.stdout if path == "-" else open(path, "w", encoding="utf-8", newline="")
+    count = 0
+    try:
+        with app.app_context():
+            if fmt == "jsonl":
+                for rec in iter_catalog():
+                    out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                    count += 1
+            else:
+                writer = csv.DictWriter(out, fieldnames=FIELDS)
+                writer.writeheader()
+                for rec in iter_catalog():
+                    writer.writerow(rec)
+                    count += 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return count
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Импорт/экспорт каталога ярмарки.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_imp = sub.add_parser("import", help="загрузить каталог из CSV/JSONL")
+    p_imp.add_argument("path")
+    p_imp.add_argument("--format", choices=["csv", "jsonl"])
+    p_imp.add_argument("--chunk", type=int, default=500, help="строк в одном коммите")
+    p_imp.add_argument(
+        "--dry-run", action="store_true",
+        help="проверить без записи (одна транзакция, в конце откат)",
+    )
+    p_imp.add_argument("--strict", action="store_true", help="остановиться на первой ошибке")
+
+    p_exp = sub.add_parser("export", help="выгрузить каталог в CSV/JSONL")
+    p_exp.add_argument("path", help="файл или - для stdout")
+    p_exp.add_argument("--format", choices=["csv", "jsonl"])
+
+    args = parser.parse_args(argv)
+
+    if args.command == "import":
+        stats = import_catalog(
+            args.path,
+            fmt=args.format,
+            chunk_size=max(1, args.chunk),
+            dry_run=args.dry_run,
+            strict=args.strict,
+        )
+        mode = " (dry-run, ничего не записано)" if args.dry_run else ""
+        print(
+            f"Готово{mode}: строк {stats['rows']}, ошибок {stats['errors']}; "
+            f"улицы +{stats['streets_new']}/~{stats['streets_upd']}, "
+            f"павильоны +{stats['pavilions_new']}/~{stats['pavilions_upd']}, "
+            f"объявления +{stats['ads_new']}/~{stats['ads_upd']}."
+        )
+    else:
+        count = export_catalog(args.path, fmt=args.format)
+        print(f"Выгружено строк: {count}.", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""WSGI-мидлварь сжатия ответов (brotli / gzip).
+
+Сжимает ответ по мере того, как приложение отдаёт куски, поэтому потоковые
+страницы не ждут конца рендера. Не трогает маленькие ответы, ответы с уже
+заданным Content-Encoding и типы, которых нет в списке (картинки, архивы).
+Считает по эндпоинтам, сколько байт пришло и ушло и сколько CPU ушло на сжатие.
+
+Подключение:
+    app.wsgi_app = CompressionMiddleware(app.wsgi_app, min_size=1024)
+"""
+import threading
+import time
+import zlib
+
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:  # без brotli работаем только с gzip
+    brotli = None
+
+DEFAULT_MIMETYPES = {
+    "text/html",
+    "text/css",
+    "text/plain",
+    "text/csv",
+    "text/javascript",
+    "application/javascript",
+    "application/json",
+    "application/x-ndjson",
+    "image/svg+xml",
+}
+
+# ответы с этими кодами без тела или с частичным телом
+SKIP_STATUSES = {"204", "206", "304"}
+
+
+class _GzipStream:
+    def __init__(self, level):
+        # wbits=31 — zlib сам пишет gzip-заголовок и CRC
+        self._c = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def chunk(self, data):
+        return self._c.compress(data) + self._c.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._c.flush(zlib.Z_FINISH)
+
+
+class _BrotliStream:
+    def __init__(self, quality):
+        self._c = brotli.Compressor(quality=quality)
+
+    def chunk(self, data):
+        return self._c.process(data) + self._c.flush()
+
+    def finish(self):
+        return self._c.finish()
+
+
+class CompressionMiddleware:
+    def __init__(self, app, min_size=1024, gzip_level=6, brotli_quality=4,
+                 mimetypes=None, levels=None):
+        """levels — переопределения по типу: {"text/csv": {"gzip": 1, "br": 1}}."""
+        self.app = app
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.mimetypes = set(mimetypes or DEFAULT_MIMETYPES)
+        self.levels = levels or {}
+
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    # --- выбор кодировки ---
+
+    def negotiate(self, environ):
+        if environ.get("REQUEST_METHOD") == "HEAD":
+            return None
+        accepted = parse_accept_header(environ.get("HTTP_ACCEPT_ENCODING", ""))
+        br_q = accepted["br"] if brotli is not None else 0
+        gzip_q = accepted["gzip"]
+        if br_q and br_q >= gzip_q:
+            return "br"
+        if gzip_q:
+            return "gzip"
+        return None
+
+    def _should_compress(self, status, headers, mimetype):
+        if status.split(" ", 1)[0] in SKIP_STATUSES:
+            return False
+        if mimetype not in self.mimetypes:
+            return False
+        names = {name.lower(): value for name, value in headers}
+        if "content-encoding" in names:
+            return False
+        if "no-transform" in names.get("cache-control", ""):
+            return False
+        length = names.get("content-length")
+        # у потоковых ответов длины нет — их сжимаем всегда
+        return length is None or int(length) >= self.min_size
+
+    def _stream(self, encoding, mimetype):
+        level = self.levels.get(mimetype, {})
+        if encoding == "br":
+            return _BrotliStream(level.get("br", self.brotli_quality))
+        return _GzipStream(level.get("gzip", self.gzip_level))
+
+    # --- WSGI ---
+
+    def __call__(self, environ, start_response):
+        encoding = self.negotiate(environ)
+        state = {}
+
+        def _start_response(status, headers, exc_info=None):
+            mimetype = ""
+            for name, value in headers:
+                if name.lower() == "content-type":
+                    mimetype = value.split(";", 1)[0].strip().lower()
+
+            if mimetype in self.mimetypes:
+                headers = _add_vary(headers)
+            if encoding and self._should_compress(status, headers, mimetype):
+                state["mimetype"] = mimetype
+                # запрос Flask ещё доступен здесь, после ответа его уже убирают
+                state["endpoint"] = _endpoint(environ)
+                headers = [
+                    (name, _weak_etag(value) if name.lower() == "etag" else value)
+                    for name, value in headers
+                    if name.lower() != "content-length"
+                ]
+                headers.append(("Content-Encoding", encoding))
+            return start_response(status, headers, exc_info)
+
+        app_iter = self.app(environ, _start_response)
+        if "mimetype" not in state:
+            return app_iter
+        return self._compress(app_iter, encoding, state["mimetype"], state["endpoint"])
+
+    def _compress(self, app_iter, encoding, mimetype, endpoint):
+        stream = self._stream(encoding, mimetype)
+        size_in = size_out = 0
+        cpu = 0.0
+        try:
+            for data in app_iter:
+                if not data:
+                    continue
+                t0 = time.thread_time()
+                out = stream.chunk(data)
+                cpu += time.thread_time() - t0
+                size_in += len(data)
+                size_out += len(out)
+                if out:
+                    yield out
+
+            t0 = time.thread_time()
+            out = stream.finish()
+            cpu += time.thread_time() - t0
+            size_out += len(out)
+            yield out
+        finally:
+            if hasattr(app_iter, "close"):
+                app_iter.close()
+            self._record(endpoint, encoding, size_in, size_out, cpu)
+
+    # --- статистика ---
+
+    def _record(self, endpoint, encoding, size_in, size_out, cpu):
+        with self._lock:
+            row = self._stats.setdefault(
+                endpoint,
+                {"responses": 0, "br": 0, "gzip": 0, "bytes_in": 0, "bytes_out": 0, "cpu": 0.0},
+            )
+            row["responses"] += 1
+            row[encoding] += 1
+            row["bytes_in"] += size_in
+            row["bytes_out"] += size_out
+            row["cpu"] += cpu
+
+    def stats(self):
+        """Сводка по эндпоинтам этого процесса, самые тяжёлые по CPU — сверху."""
+        with self._lock:
+            rows = [{"endpoint": name, **row} for name, row in self._stats.items()]
+        for row in rows:
+            row["ratio"] = row["bytes_in"] / row["bytes_out"] if row["bytes_out"] else 0.0
+            row["cpu_ms"] = row["cpu"] * 1000
+            row["cpu_ms_avg"] = row["cpu_ms"] / row["responses"]
+        return sorted(rows, key=lambda r: r["cpu"], reverse=True)
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats.clear()
+
+
+def _add_vary(headers):
+    for i, (name, value) in enumerate(headers):
+        if name.lower() == "vary":
+            if "accept-encoding" not in value.lower():
+                headers = list(headers)
+                headers[i] = (name, value + ", Accept-Encoding")
+            return headers
+    return list(headers) + [("Vary", "Accept-Encoding")]
+
+
+def _weak_etag(value):
+    # сжатое тело отличается побайтно, сильный ETag тут был бы неверен
+    return value if value.startswith("W/") else "W/" + value
+
+
+def _endpoint(environ):
+    request = environ.get("werkzeug.request")
+    endpoint = getattr(request, "endpoint", None)
+    return endpoint or environ.get("PATH_INFO", "?")
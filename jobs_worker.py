@@ -0,0 +1,31 @@
+"""Отдельный процесс-воркер очереди фоновых задач.
+
+Веб-процессы по умолчанию сами запускают воркеры (JOBS_IN_PROCESS).
+При нескольких процессах приложения удобнее выключить это и держать
+один-два таких воркера:
+
+    python jobs_worker.py --threads 4
+"""
+import argparse
+import signal
+import threading
+
+from app import app, start_job_workers
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Воркер очереди задач FairMarket.")
+    parser.add_argument("--threads", type=int, default=2)
+    args = parser.parse_args(argv)
+
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+
+    start_job_workers(max(1, args.threads))
+    print(f"Воркер очереди запущен: потоков {max(1, args.threads)}. Ctrl+C — выход.")
+    stop.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,368 @@
+"""Метрики в формате Prometheus, общие для всех воркеров.
+
+Воркеры (prefork, несколько процессов) не видят память друг друга, поэтому
+каждый процесс копит значения у себя и раз в flush_interval секунд целиком
+переписывает свой файл <pid>.json в каталоге метрик (через временный файл и
+os.replace — читатель никогда не увидит половину). /metrics читает все файлы
+и складывает:
+  * счётчики и гистограммы — по всем процессам, в том числе завершившимся,
+    чтобы перезапуск воркера не откатывал счётчик назад;
+  * датчики (gauge) — только по живым процессам, то есть по файлам, которые
+    обновлялись не позже stale_after секунд назад. Живой процесс переписывает
+    свой файл не реже раза в heartbeat секунд, даже если ничего не менялось.
+Файлы старше expire секунд удаляются при чтении. Каталог стоит очищать при
+выкладке, как и кэш байткода.
+
+Подключение:
+    metrics = Registry("cache/metrics")
+    hits = metrics.counter("fair_hits_total", "Попадания", ("endpoint",))
+    hits.inc(endpoint="index")
+    app.wsgi_app = MetricsMiddleware(app.wsgi_app, metrics, prefix="fair")
+    text = metrics.render()
+"""
+import atexit
+import json
+import math
+import os
+import threading
+import time
+
+# секунды: от быстрых страниц из кэша до тяжёлых выгрузок
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# байты: от пустого редиректа до выгрузки
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        if value.is_integer():
+            return str(int(value))
+    return repr(value)
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, registry, name, doc, labelnames):
+        self.registry = registry
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name}: нужны метки {self.labelnames}, даны {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        self.registry._add(self.name, self._key(labels), amount)
+
+    def set(self, value, **labels):
+        """Для счётчиков, которые ведёт кто-то другой (статистика кэша): значение целиком."""
+        self.registry._set(self.name, self._key(labels), value)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        self.registry._add(self.name, self._key(labels), amount)
+
+    def dec(self, amount=1, **labels):
+        self.registry._add(self.name, self._key(labels), -amount)
+
+    def set(self, value, **labels):
+        self.registry._set(self.name, self._key(labels), value)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, registry, name, doc, labelnames, buckets):
+        super().__init__(registry, name, doc, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        self.registry._observe(self, self._key(labels), value)
+
+
+class Registry:
+    def __init__(self, path, flush_interval=1.0, heartbeat=15.0, stale_after=60.0,
+                 expire=7 * 24 * 3600):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.heartbeat = heartbeat
+        self.stale_after = stale_after
+        self.expire = expire
+
+        self._metrics = {}  # имя -> Counter/Gauge/Histogram
+        self._collectors = []
+        self._values = {}  # имя -> {метки: число или [по корзинам..., сумма, количество]}
+        self._lock = threading.Lock()
+        self._pid = None
+        self._dirty = False
+        self._written = 0.0
+        self._flush_lock = threading.Lock()
+
+        os.makedirs(path, exist_ok=True)
+        atexit.register(self._flush_at_exit)
+
+    # --- объявление метрик ---
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"метрика {metric.name} уже объявлена")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, doc, labelnames=()):
+        return self._register(Counter(self, name, doc, labelnames))
+
+    def gauge(self, name, doc, labelnames=()):
+        return self._register(Gauge(self, name, doc, labelnames))
+
+    def histogram(self, name, doc, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(self, name, doc, labelnames, buckets))
+
+    def add_collector(self, func):
+        """func() вызывается перед каждой записью файла и выставляет значения сама."""
+        self._collectors.append(func)
+        return func
+
+    # --- запись значений в своём процессе ---
+
+    def _check_pid(self):
+        # вызывается под self._lock; после fork копия родителя не наша — начинаем с нуля
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        self._pid = pid
+        self._values = {}
+        self._written = 0.0
+        threading.Thread(target=self._flush_loop, name="metrics-flush", daemon=True).start()
+
+    def _add(self, name, key, amount):
+        with self._lock:
+            self._check_pid()
+            series = self._values.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+            self._dirty = True
+
+    def _set(self, name, key, value):
+        with self._lock:
+            self._check_pid()
+            self._values.setdefault(name, {})[key] = value
+            self._dirty = True
+
+    def _observe(self, metric, key, value):
+        with self._lock:
+            self._check_pid()
+            series = self._values.setdefault(metric.name, {})
+            row = series.get(key)
+            if row is None:
+                # корзины не накопительные; последняя — +Inf, дальше сумма и количество
+                row = series[key] = [0] * (len(metric.buckets) + 3)
+            i = 0
+            for i, bound in enumerate(metric.buckets):
+                if value <= bound:
+                    break
+            else:
+                i = len(metric.buckets)
+            row[i] += 1
+            row[-2] += value
+            row[-1] += 1
+            self._dirty = True
+
+    # --- файл процесса ---
+
+    def _file(self, pid):
+        return os.path.join(self.path, f"{pid}.json")
+
+    def flush(self):
+        """Переписывает файл этого процесса текущими значениями."""
+        for func in self._collectors:
+            try:
+                func()
+            except Exception:
+                pass  # метрики не должны ронять процесс
+        with self._flush_lock:
+            with self._lock:
+                self._check_pid()
+                data = {
+                    # гистограммы копируем: json.dump идёт уже без блокировки
+                    name: [
+                        [list(key), list(value) if isinstance(value, list) else value]
+                        for key, value in series.items()
+                    ]
+                    for name, series in self._values.items()
+                }
+                self._dirty = False
+            path = self._file(self._pid)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"pid": self._pid, "metrics": data}, f, separators=(",", ":"))
+            os.replace(tmp, path)
+            self._written = time.monotonic()
+
+    def _flush_at_exit(self):
+        # скрипты, которые только импортировали приложение, файлов не оставляют
+        if self._pid == os.getpid():
+            self.flush()
+
+    def _flush_loop(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.flush_interval)
+            if self._dirty or time.monotonic() - self._written >= self.heartbeat:
+                try:
+                    self.flush()
+                except OSError:
+                    pass
+
+    # --- сбор по всем процессам ---
+
+    def collect(self):
+        """Сложенные значения всех процессов: {имя: {метки: значение}}."""
+        self.flush()
+        now = time.time()
+        merged = {}
+        for fname in os.listdir(self.path):
+            if not fname.endswith(".json"):
+                continue
+            path = os.path.join(self.path, fname)
+            try:
+                age = now - os.path.getmtime(path)
+                if age > self.expire:
+                    os.remove(path)
+                    continue
+                with open(path, encoding="utf-8") as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue  # файл удалили или переписывают прямо сейчас
+            live = age <= self.stale_after
+            for name, rows in data.get("metrics", {}).items():
+                metric = self._metrics.get(name)
+                if metric is None or (metric.kind == "gauge" and not live):
+                    continue
+                series = merged.setdefault(name, {})
+                for key, value in rows:
+                    key = tuple(key)
+                    if metric.kind == "histogram":
+                        acc = series.get(key)
+                        if acc is None or len(acc) != len(value):
+                            series[key] = list(value)
+                        else:
+                            series[key] = [a + b for a, b in zip(acc, value)]
+                    else:
+                        series[key] = series.get(key, 0) + value
+        return merged
+
+    def render(self):
+        """Текст в формате экспозиции Prometheus 0.0.4."""
+        merged = self.collect()
+        lines = []
+        for name, metric in self._metrics.items():
+            lines.append(f"# HELP {name} {metric.doc}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for key, value in sorted(merged.get(name, {}).items()):
+                if metric.kind != "histogram":
+                    lines.append(f"{name}{_labels(metric.labelnames, key)} {_number(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (math.inf,), value):
+                    cumulative += count
+                    le = 'le="' + _number(float(bound)) + '"'
+                    lines.append(
+                        f"{name}_bucket{_labels(metric.labelnames, key, le)} {cumulative}"
+                    )
+                labels = _labels(metric.labelnames, key)
+                lines.append(f"{name}_sum{labels} {_number(float(value[-2]))}")
+                lines.append(f"{name}_count{labels} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """Число запросов, время до конца отдачи тела, размер ответа и запросы в работе.
+
+    Стоит снаружи сжатия, поэтому размер — то, что реально ушло клиенту, а время
+    у потоковых ответов считается до последнего куска.
+    """
+
+    def __init__(self, app, registry, prefix="app", buckets=LATENCY_BUCKETS,
+                 size_buckets=SIZE_BUCKETS):
+        self.app = app
+        self.requests = registry.counter(
+            f"{prefix}_http_requests_total", "Запросы по эндпоинтам",
+            ("endpoint", "method", "status"),
+        )
+        self.latency = registry.histogram(
+            f"{prefix}_http_request_duration_seconds", "Время ответа до последнего байта",
+            ("endpoint", "method"), buckets=buckets,
+        )
+        self.size = registry.histogram(
+            f"{prefix}_http_response_size_bytes", "Размер тела ответа (после сжатия)",
+            ("endpoint",), buckets=size_buckets,
+        )
+        self.in_flight = registry.gauge(
+            f"{prefix}_http_requests_in_flight", "Запросы, которые сейчас обрабатываются"
+        )
+
+    def __call__(self, environ, start_response):
+        started = time.perf_counter()
+        state = {"status": "500", "endpoint": None}
+
+        def _start_response(status, headers, exc_info=None):
+            state["status"] = status.split(" ", 1)[0]
+            # запрос Flask ещё доступен здесь, после ответа его уже убирают
+            state["endpoint"] = _endpoint(environ)
+            return start_response(status, headers, exc_info)
+
+        self.in_flight.inc()
+        try:
+            app_iter = self.app(environ, _start_response)
+        except BaseException:
+            self._record(environ, state, started, 0)
+            raise
+        return self._measure(app_iter, environ, state, started)
+
+    def _measure(self, app_iter, environ, state, started):
+        size = 0
+        try:
+            for data in app_iter:
+                size += len(data)
+                yield data
+        finally:
+            if hasattr(app_iter, "close"):
+                app_iter.close()
+            self._record(environ, state, started, size)
+
+    def _record(self, environ, state, started, size):
+        self.in_flight.dec()
+        endpoint = state["endpoint"] or _endpoint(environ)
+        method = environ.get("REQUEST_METHOD", "?")
+        self.requests.inc(endpoint=endpoint, method=method, status=state["status"])
+        self.latency.observe(time.perf_counter() - started, endpoint=endpoint, method=method)
+        self.size.observe(size, endpoint=endpoint)
+
+
+def _endpoint(environ):
+    request = environ.get("werkzeug.request")
+    # без эндпоинта (404, 405) путь в метку не кладём — иначе меток будет без счёта
+    return getattr(request, "endpoint", None) or "<unmatched>"
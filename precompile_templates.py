@@ -0,0 +1,58 @@
+"""Прогрев кэша байткода Jinja при выкладке.
+
+Компилирует все шаблоны и складывает байткод в JINJA_CACHE_DIR, откуда его
+читают все воркеры. Если шаблон с ошибкой — выходит с кодом 1, чтобы выкладка
+остановилась до перезапуска воркеров.
+
+Примеры:
+    python precompile_templates.py
+    python precompile_templates.py --clear
+"""
+import argparse
+import sys
+import time
+
+from jinja2 import TemplateSyntaxError
+
+from app import app, JINJA_CACHE_DIR
+
+
+def precompile(clear: bool = False) -> int:
+    env = app.jinja_env
+    if clear:
+        env.bytecode_cache.clear()
+
+    errors = 0
+    started = time.perf_counter()
+    names = env.list_templates(extensions=["html"])
+    for name in names:
+        t0 = time.perf_counter()
+        try:
+            env.get_template(name)
+        except TemplateSyntaxError as e:
+            errors += 1
+            print(f"  ОШИБКА {name}:{e.lineno}: {e.message}", file=sys.stderr)
+            continue
+        print(f"  {name:<36} {(time.perf_counter() - t0) * 1000:7.1f} мс")
+
+    print(
+        f"Шаблонов: {len(names)}, ошибок: {errors}, "
+        f"{time.perf_counter() - started:.2f} с → {JINJA_CACHE_DIR}"
+    )
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Прогрев кэша байткода шаблонов")
+    parser.add_argument(
+        "--clear", action="store_true", help="сначала очистить кэш"
+    )
+    args = parser.parse_args()
+
+    with app.app_context():
+        errors = precompile(clear=args.clear)
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
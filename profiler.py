@@ -0,0 +1,349 @@
+"""Профилирование отдельных запросов по требованию (семплирующий профайлер).
+
+Пока идёт запрос, отдельный поток раз в interval секунд снимает стек потока,
+который этот запрос обрабатывает (sys._current_frames). Так в профиль
+попадает всё: before_request, view, SQL, рендер шаблонов и отдача тела
+потоковых страниц — мидлварь стоит снаружи приложения и держит семплер до
+закрытия ответа. Вес сэмпла — реальное время с предыдущего, поэтому паузы
+GIL не искажают картину.
+
+Профиль сохраняется тремя файлами в каталоге профилей:
+  <id>.json             — описание: запрос, длительность, время по фазам;
+  <id>.collapsed        — «свёрнутые» стеки (flamegraph.pl, speedscope, inferno),
+                          вес строки в микросекундах;
+  <id>.speedscope.json  — формат speedscope.app с порядком сэмплов во времени.
+
+Подключение:
+    app.wsgi_app = ProfilerMiddleware(app.wsgi_app, "cache/profiles", allow=is_admin)
+    # профилируется запрос с ?_profile=1 или заголовком X-Profile: 1,
+    # если allow(environ) вернул, от чьего имени профиль (иначе запрос идёт как обычно)
+"""
+import json
+import os
+import re
+import sys
+import threading
+import time
+from datetime import datetime
+from urllib.parse import parse_qs
+
+QUERY_FLAG = "_profile"
+HEADER = "HTTP_X_PROFILE"
+
+# фаза сэмпла — по первому совпадению, если идти от вершины стека вглубь
+PHASES = (
+    ("SQL", ("sqlalchemy/",)),
+    # у скомпилированных шаблонов файл кода — сам шаблон
+    ("шаблоны", ("jinja2/", ".html:")),
+    ("before_request", ("preprocess_request ",)),
+    ("after_request", ("process_response ",)),
+)
+OTHER_PHASE = "view и прочее"
+
+PROFILE_ID = re.compile(r"^[0-9a-f-]+$")
+
+
+def _wanted(environ):
+    if environ.get(HEADER, "") in ("1", "true", "yes"):
+        return True
+    query = environ.get("QUERY_STRING", "")
+    if QUERY_FLAG not in query:
+        return False
+    query = parse_qs(query)
+    return query.get(QUERY_FLAG, [""])[0] in ("1", "true", "yes")
+
+
+class Sampler:
+    """Снимает стек одного потока, пока не вызовут stop()."""
+
+    def __init__(self, thread_id, roots, base_dir, interval=0.001, max_seconds=30.0):
+        self.thread_id = thread_id
+        self.roots = roots  # объекты кода, выше которых стек не нужен (сервер, потоки)
+        self.base_dir = base_dir
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.samples = []  # (стек от корня к вершине, вес в мкс)
+        self._names = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.perf_counter() - self.started
+        return self.samples
+
+    def _name(self, code):
+        name = self._names.get(code)
+        if name is None:
+            path = code.co_filename.replace(os.sep, "/")
+            i = path.rfind("site-packages/")
+            if i >= 0:
+                path = path[i + len("site-packages/"):]
+            elif path.startswith(self.base_dir):
+                path = path[len(self.base_dir):].lstrip("/")
+            else:
+                path = path.rsplit("/", 1)[-1]
+            name = f"{code.co_name} ({path}:{code.co_firstlineno})".replace(";", ",")
+            self._names[code] = name
+        return name
+
+    def _run(self):
+        last = self.started
+        deadline = self.started + self.max_seconds
+        while not self._stop.wait(self.interval):
+            now = time.perf_counter()
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(self._name(frame.f_code))
+                if frame.f_code in self.roots:
+                    break
+                frame = frame.f_back
+            if stack:
+                stack.reverse()
+                self.samples.append((tuple(stack), int((now - last) * 1e6)))
+            last = now
+            if now > deadline:
+                break
+
+
+class ProfilerMiddleware:
+    def __init__(self, app, path, allow, base_dir=None, interval=0.001, max_seconds=30.0,
+                 keep=50):
+        """allow(environ) → кто смотрит (строка для описания профиля) или None."""
+        self.app = app
+        self.path = path
+        self.allow = allow
+        self.base_dir = (base_dir or os.getcwd()).replace(os.sep, "/").rstrip("/") + "/"
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.keep = keep
+        self._roots = {type(self).__call__.__code__, type(self)._iterate.__code__}
+        os.makedirs(path, exist_ok=True)
+
+    def __call__(self, environ, start_response):
+        if not _wanted(environ):
+            return self.app(environ, start_response)
+        user = self.allow(environ)
+        if not user:
+            return self.app(environ, start_response)
+
+        profile_id = f"{datetime.utcnow():%Y%m%d-%H%M%S}-{os.urandom(3).hex()}"
+        state = {"status": None, "endpoint": None}
+
+        def _start_response(status, headers, exc_info=None):
+            state["status"] = status.split(" ", 1)[0]
+            request = environ.get("werkzeug.request")
+            state["endpoint"] = getattr(request, "endpoint", None)
+            headers = list(headers) + [("X-Profile-Id", profile_id)]
+            return start_response(status, headers, exc_info)
+
+        sampler = Sampler(
+            threading.get_ident(), self._roots, self.base_dir, self.interval, self.max_seconds
+        )
+        sampler.start()
+        try:
+            app_iter = self.app(environ, _start_response)
+        except BaseException:
+            self._finish(sampler, profile_id, environ, state, user)
+            raise
+        return self._iterate(app_iter, sampler, profile_id, environ, state, user)
+
+    def _iterate(self, app_iter, sampler, profile_id, environ, state, user):
+        # тело может отдавать другой поток сервера — семплируем тот, что итерирует
+        sampler.thread_id = threading.get_ident()
+        try:
+            for data in app_iter:
+                yield data
+        finally:
+            if hasattr(app_iter, "close"):
+                app_iter.close()
+            self._finish(sampler, profile_id, environ, state, user)
+
+    def _finish(self, sampler, profile_id, environ, state, user):
+        samples = sampler.stop()
+        query = environ.get("QUERY_STRING", "")
+        meta = {
+            "id": profile_id,
+            "created_at": datetime.utcnow().isoformat(timespec="seconds"),
+            "method": environ.get("REQUEST_METHOD"),
+            "path": environ.get("PATH_INFO", "") + ("?" + query if query else ""),
+            "endpoint": state["endpoint"],
+            "status": state["status"] or "500",
+            "user": user,
+            "duration": round(sampler.duration, 6),
+            "interval": self.interval,
+            "samples": len(samples),
+            "phases": phase_summary(samples),
+        }
+        try:
+            save_profile(self.path, meta, samples)
+            prune_profiles(self.path, self.keep)
+        except OSError:
+            pass  # профиль — не повод ронять ответ
+
+
+# --- файлы ---
+
+def _file(path, profile_id, suffix):
+    if not PROFILE_ID.match(profile_id):
+        raise ValueError(f"неверный id профиля: {profile_id!r}")
+    return os.path.join(path, profile_id + suffix)
+
+
+def save_profile(path, meta, samples):
+    weights = {}
+    for stack, weight in samples:
+        weights[stack] = weights.get(stack, 0) + weight
+    with open(_file(path, meta["id"], ".collapsed"), "w", encoding="utf-8") as f:
+        for stack, weight in weights.items():
+            f.write(";".join(stack) + f" {weight}\n")
+
+    frames, index, stacks = [], {}, []
+    for stack, _ in samples:
+        ids = []
+        for name in stack:
+            if name not in index:
+                index[name] = len(frames)
+                frames.append({"name": name})
+            ids.append(index[name])
+        stacks.append(ids)
+    total = sum(weight for _, weight in samples)
+    speedscope = {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": f"{meta['method']} {meta['path']}",
+        "exporter": "profiler.py",
+        "shared": {"frames": frames},
+        "profiles": [
+            {
+                "type": "sampled",
+                "name": f"{meta['method']} {meta['path']}",
+                "unit": "microseconds",
+                "startValue": 0,
+                "endValue": total,
+                "samples": stacks,
+                "weights": [weight for _, weight in samples],
+            }
+        ],
+    }
+    with open(_file(path, meta["id"], ".speedscope.json"), "w", encoding="utf-8") as f:
+        json.dump(speedscope, f, ensure_ascii=False)
+    # описание последним: нет его — профиль в списке не виден
+    with open(_file(path, meta["id"], ".json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=1)
+
+
+def list_profiles(path):
+    """Описания профилей, новые сверху."""
+    if not os.path.isdir(path):
+        return []
+    names = sorted(
+        (f[:-5] for f in os.listdir(path)
+         if f.endswith(".json") and not f.endswith(".speedscope.json")),
+        reverse=True,
+    )
+    result = []
+    for name in names:
+        try:
+            result.append(load_profile(path, name))
+        except (OSError, ValueError):
+            continue
+    return result
+
+
+def load_profile(path, profile_id):
+    with open(_file(path, profile_id, ".json"), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def profile_file(path, profile_id, fmt):
+    """Путь к файлу профиля: fmt — collapsed или speedscope."""
+    suffix = {"collapsed": ".collapsed", "speedscope": ".speedscope.json"}[fmt]
+    return _file(path, profile_id, suffix)
+
+
+def load_collapsed(path, profile_id):
+    """[(стек, вес в мкс)] из .collapsed."""
+    samples = []
+    with open(profile_file(path, profile_id, "collapsed"), encoding="utf-8") as f:
+        for line in f:
+            stack, _, weight = line.rstrip("\n").rpartition(" ")
+            samples.append((tuple(stack.split(";")), int(weight)))
+    return samples
+
+
+def prune_profiles(path, keep):
+    for meta in list_profiles(path)[keep:]:
+        for suffix in (".json", ".collapsed", ".speedscope.json"):
+            try:
+                os.remove(_file(path, meta["id"], suffix))
+            except FileNotFoundError:
+                pass
+
+
+# --- разбор ---
+
+def phase_summary(samples):
+    """Время (мкс) по фазам запроса."""
+    result = {}
+    for stack, weight in samples:
+        phase = OTHER_PHASE
+        for name in reversed(stack):
+            for label, markers in PHASES:
+                if any(m in name for m in markers):
+                    phase = label
+                    break
+            else:
+                continue
+            break
+        result[phase] = result.get(phase, 0) + weight
+    return dict(sorted(result.items(), key=lambda kv: kv[1], reverse=True))
+
+
+def top_functions(samples, limit=25):
+    """Функции по собственному времени и по времени вместе с вызванными (мкс)."""
+    self_time, total_time = {}, {}
+    for stack, weight in samples:
+        self_time[stack[-1]] = self_time.get(stack[-1], 0) + weight
+        for name in set(stack):
+            total_time[name] = total_time.get(name, 0) + weight
+
+    def top(d):
+        return sorted(d.items(), key=lambda kv: kv[1], reverse=True)[:limit]
+
+    return top(self_time), top(total_time)
+
+
+def flame_tree(samples, min_fraction=0.005):
+    """Дерево для «сосульки»: узлы уже min_fraction от всего профиля отбрасываются."""
+    root = {"name": "запрос", "value": 0, "children": {}}
+    for stack, weight in samples:
+        root["value"] += weight
+        node = root
+        for name in stack:
+            child = node["children"].get(name)
+            if child is None:
+                child = node["children"][name] = {"name": name, "value": 0, "children": {}}
+            child["value"] += weight
+            node = child
+    limit = root["value"] * min_fraction
+
+    def finish(node):
+        children = [c for c in node["children"].values() if c["value"] >= limit]
+        children.sort(key=lambda c: c["value"], reverse=True)
+        for child in children:
+            child["pct"] = 100.0 * child["value"] / node["value"]
+            finish(child)
+        node["children"] = children
+
+    root["pct"] = 100.0
+    if root["value"]:
+        finish(root)
+    else:
+        root["children"] = []
+    return root
@@ -0,0 +1,61 @@
+"""Приложение на временной базе: пути задаются до импорта app."""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TMP = tempfile.mkdtemp(prefix="fair-tests-")
+
+os.environ["DB_PATH"] = os.path.join(TMP, "fair.db")
+os.environ["ARCHIVE_PATH"] = os.path.join(TMP, "archive.db")
+os.environ["CACHE_PATH"] = os.path.join(TMP, "shared.db")
+for name in ("JINJA_CACHE_DIR", "METRICS_DIR", "PROFILE_DIR", "BACKUP_DIR"):
+    os.environ[name] = os.path.join(TMP, name.lower())
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope="session")
+def fair():
+    import app as fair
+
+    # воркеры очереди в тестах не нужны: задачи вызываются напрямую
+    fair.app.config["JOBS_IN_PROCESS"] = False
+    return fair
+
+
+@pytest.fixture
+def ctx(fair):
+    with fair.app.app_context():
+        yield
+        fair.db.session.rollback()
+
+
+@pytest.fixture
+def user(fair, ctx):
+    user = fair.User(
+        username="tester", email=f"tester{os.urandom(4).hex()}@example.com", password="x"
+    )
+    fair.db.session.add(user)
+    fair.db.session.commit()
+    return user
+
+
+@pytest.fixture
+def admin_client(fair, user):
+    client = fair.app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = user.id
+        session["user_role"] = "admin"
+    return client
+
+
+@pytest.fixture
+def pavilion(fair, ctx):
+    code = f"t{os.urandom(4).hex()}"
+    street = fair.Street(name="Тестовая", code=code)
+    pavilion = fair.Pavilion(title="Павильон", street=street)
+    fair.db.session.add_all([street, pavilion])
+    fair.db.session.commit()
+    return pavilion
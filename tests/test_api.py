@@ -0,0 +1,63 @@
+def add_ads(fair, pavilion, count):
+    ads = [
+        fair.Ad(title=f"Объявление {i} " + "x" * 60, text="текст", pavilion_id=pavilion.id)
+        for i in range(count)
+    ]
+    fair.db.session.add_all(ads)
+    fair.db.session.commit()
+    return [ad.id for ad in ads]
+
+
+def test_list_pages_by_cursor(fair, pavilion):
+    ids = add_ads(fair, pavilion, 3)
+    client = fair.app.test_client()
+    url = f"/api/v1/ads?pavilion_id={pavilion.id}&limit=2&fields=id,title"
+
+    first = client.get(url).get_json()
+    assert [row["id"] for row in first["data"]] == ids[:2]
+    assert set(first["data"][0]) == {"id", "title"}
+
+    second = client.get(url + "&cursor=" + first["next_cursor"]).get_json()
+    assert [row["id"] for row in second["data"]] == ids[2:]
+    assert second["next_cursor"] is None
+
+
+def test_unknown_field_and_resource(fair, ctx):
+    client = fair.app.test_client()
+    assert client.get("/api/v1/ads?fields=id,password").status_code == 400
+    assert client.get("/api/v1/nothing").status_code == 404
+
+
+def test_soft_deleted_ad_is_gone(fair, pavilion):
+    ad_id = add_ads(fair, pavilion, 1)[0]
+    client = fair.app.test_client()
+    assert client.get(f"/api/v1/ads/{ad_id}").status_code == 200
+
+    fair.db.session.get(fair.Ad, ad_id).deleted_at = fair.datetime.utcnow()
+    fair.db.session.commit()
+    assert client.get(f"/api/v1/ads/{ad_id}").status_code == 404
+
+
+def test_weak_etag_revalidates(fair, pavilion):
+    # сжатие по дороге делает ETag слабым (W/); совпасть он всё равно должен
+    add_ads(fair, pavilion, 1)
+    client = fair.app.test_client()
+    etag = client.get("/api/v1/ads").headers["ETag"]
+    again = client.get("/api/v1/ads", headers={"If-None-Match": "W/" + etag.removeprefix("W/")})
+    assert again.status_code == 304
+
+
+def test_compressed_etag_revalidates(fair, pavilion):
+    add_ads(fair, pavilion, 40)
+    client = fair.app.test_client()
+    headers = {"Accept-Encoding": "gzip"}
+
+    resp = client.get("/api/v1/ads?limit=100", headers=headers)
+    assert resp.status_code == 200
+    assert resp.headers["Content-Encoding"] == "gzip"
+    etag = resp.headers["ETag"]
+    assert etag.startswith('W/"')
+
+    again = client.get("/api/v1/ads?limit=100", headers={**headers, "If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.data == b""
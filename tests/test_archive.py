@@ -0,0 +1,148 @@
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select, text
+
+OLD = datetime.utcnow() - timedelta(days=365)
+
+
+def add_ticket(fair, user, status="done"):
+    msg = fair.SupportMessage(
+        user_id=user.id, subject="тема", text="текст", status=status, created_at=OLD
+    )
+    fair.db.session.add(msg)
+    fair.db.session.commit()
+    return msg.id
+
+
+def archived_ids(fair):
+    arch = fair.ARCHIVE_TABLES["support_messages"]
+    return set(fair.db.session.execute(select(arch.c.id)).scalars())
+
+
+def test_new_rows_never_reuse_archived_ids(fair, user):
+    ids = [add_ticket(fair, user) for _ in range(3)]
+    fair.archive_batch("support_messages", datetime.utcnow())
+    assert set(ids) <= archived_ids(fair)
+
+    # рабочая таблица пуста, но id архивных строк новым не достаются
+    last = add_ticket(fair, user, status="new")
+    fair.db.session.execute(
+        delete(fair.SupportMessage).where(fair.SupportMessage.id == last)
+    )
+    fair.db.session.commit()
+    fresh = add_ticket(fair, user)
+    assert fresh > last
+    assert fresh not in archived_ids(fair)
+    assert fair.archive_batch("support_messages", datetime.utcnow()) == 1
+
+
+def test_sequence_is_raised_to_archive(fair, user):
+    fair.archive_batch("support_messages", datetime.utcnow())
+    add_ticket(fair, user)
+    fair.archive_batch("support_messages", datetime.utcnow())
+    top = max(archived_ids(fair))
+
+    # как после переноса старой базы: счётчик ниже архива
+    fair.db.session.execute(
+        text("UPDATE sqlite_sequence SET seq = 0 WHERE name = 'support_messages'")
+    )
+    fair.db.session.commit()
+    fair.seed_archive_sequences()
+    assert add_ticket(fair, user) > top
+
+
+def add_street_request(fair, user):
+    req = fair.StreetRequest(
+        user_id=user.id, street_name="Улица", street_code="ul", pavilion_title="Павильон",
+        status="approved", created_at=OLD,
+    )
+    fair.db.session.add(req)
+    fair.db.session.commit()
+    return req.id
+
+
+def test_status_snapshot_counts_archived_requests(fair, user):
+    for _ in range(2):
+        add_street_request(fair, user)
+    fair.archive_batch("street_requests", datetime.utcnow())
+    add_street_request(fair, user)
+
+    day = datetime.utcnow().date()
+    fair.snapshot_request_statuses(day)
+    fair.db.session.commit()
+    value = fair.db.session.execute(
+        select(fair.DailyStat.value).filter_by(
+            day=day, metric="requests_status", dim="street:approved"
+        )
+    ).scalar()
+    arch = fair.ARCHIVE_TABLES["street_requests"]
+    archived = fair.db.session.execute(
+        select(fair.db.func.count()).select_from(arch).where(arch.c.status == "approved")
+    ).scalar()
+    hot = fair.StreetRequest.query.filter_by(status="approved").count()
+    assert archived >= 2 and hot >= 1
+    assert value == archived + hot
+
+
+def test_export_of_archived_rows(fair, user, admin_client):
+    archived = add_street_request(fair, user)
+    fair.archive_batch("street_requests", datetime.utcnow())
+    hot = add_street_request(fair, user)
+
+    resp = admin_client.get("/admin/exports/street_requests.jsonl?archive=1")
+    assert resp.status_code == 200
+    assert "street_requests-archive-" in resp.headers["Content-Disposition"]
+    ids = {int(line.split(",", 1)[0].split(":")[1]) for line in resp.text.splitlines()}
+    assert archived in ids and hot not in ids
+
+    resp = admin_client.get("/admin/exports/users.csv?archive=1")
+    assert resp.status_code == 400
+
+
+def test_backup_keeps_archive_in_one_snapshot(fair, user, tmp_path):
+    import backup
+
+    add_ticket(fair, user)
+    fair.archive_batch("support_messages", datetime.utcnow())
+    fair.backup_database({})
+
+    manifests = backup.list_backups(fair.BACKUP_DIR)
+    assert [m["name"].split("-")[0] for m in manifests] == ["fair"]
+    manifest = manifests[0]
+    assert [p["file"] for p in manifest["attached"]] == ["archive.db"]
+    assert manifest["attached"][0]["tables"]["support_messages"] == len(archived_ids(fair))
+
+    checked = backup.verify_backup(
+        manifest["name"], fair.BACKUP_DIR, restore_to=str(tmp_path / "fair.db")
+    )
+    assert checked["verified"]["ok"], checked["verified"]["errors"]
+    assert (tmp_path / "fair.db").exists() and (tmp_path / "archive.db").exists()
+
+
+def test_backup_and_archive_do_not_overlap(fair, user):
+    Job, MaintenanceRun = fair.Job, fair.MaintenanceRun
+    add_ticket(fair, user)
+
+    job = fair.enqueue_job("backup_database", unique_key="backup_database")
+    result = fair.maintenance_archive(None, time.monotonic() + 60, lambda: None)
+    assert result["cursor"] is not None and "резервная копия" in result["summary"]
+    assert fair.SupportMessage.query.filter_by(user_id=user.id).count() == 1
+
+    # и наоборот: копия откладывается, пока идёт перенос, попытка не тратится
+    worker = fair.enqueue_job("db_maintenance", {"tasks": ["archive"]})
+    run = MaintenanceRun(task="archive", status="running")
+    fair.db.session.add(run)
+    Job.query.filter(Job.id.in_((job.id, worker.id))).update(
+        {"status": "running", "attempts": 1}, synchronize_session=False
+    )
+    fair.db.session.commit()
+    try:
+        assert fair.run_job(fair.db.session.get(Job, job.id, populate_existing=True)) is False
+        job = fair.db.session.get(Job, job.id, populate_existing=True)
+        assert job.status == "queued" and job.attempts == 0
+        assert job.run_at > datetime.utcnow()
+    finally:
+        Job.query.filter(Job.id.in_((job.id, worker.id))).delete(synchronize_session=False)
+        fair.db.session.delete(run)
+        fair.db.session.commit()
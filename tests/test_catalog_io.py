@@ -0,0 +1,35 @@
+import csv
+
+import catalog_io
+
+HEADER = ["street_code", "street_name", "pavilion_title", "ad_title", "ad_text"]
+
+
+def write_csv(path, rows):
+    with open(path, "w", encoding="utf-8", newline="") as fh:
+        writer = csv.DictWriter(fh, fieldnames=HEADER)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def test_numeric_street_code_is_valid():
+    rec = catalog_io.clean_record({"street_code": "17", "street_name": "Улица"}, {})
+    assert rec["street_code"] == "17"
+
+
+def test_dry_run_sees_rows_from_earlier_chunks(fair, tmp_path):
+    path = tmp_path / "catalog.csv"
+    write_csv(path, [
+        {"street_code": "dry_1", "street_name": "Сухая", "pavilion_title": "Первый"},
+        # улица без названия и тот же павильон — только из прошлой пачки
+        {"street_code": "dry_1", "pavilion_title": "Первый", "ad_title": "А", "ad_text": "т"},
+        {"street_code": "dry_1", "pavilion_title": "Первый", "ad_title": "Б", "ad_text": "т"},
+    ])
+    stats = catalog_io.import_catalog(str(path), chunk_size=1, dry_run=True)
+    assert stats["errors"] == 0
+    assert stats["streets_new"] == 1
+    assert stats["pavilions_new"] == 1
+    assert stats["ads_new"] == 2
+
+    with fair.app.app_context():
+        assert fair.Street.query.filter_by(code="dry_1").count() == 0
@@ -0,0 +1,59 @@
+from datetime import datetime
+
+
+def changes(client, token):
+    resp = client.get(f"/api/v1/changes?since={token}")
+    assert resp.status_code == 200
+    return resp.get_json()
+
+
+def test_delta_since_token(fair, pavilion):
+    client = fair.app.test_client()
+    kept = fair.Ad(title="Остаётся", text="т", pavilion_id=pavilion.id)
+    gone = fair.Ad(title="Уйдёт", text="т", pavilion_id=pavilion.id)
+    fair.db.session.add_all([kept, gone])
+    fair.db.session.commit()
+
+    token = client.get("/api/v1/changes").get_json()["next"]
+    kept.title = "Остаётся, но другое"
+    new = fair.Ad(title="Новое", text="т", pavilion_id=pavilion.id)
+    fair.db.session.add(new)
+    gone.deleted_at = datetime.utcnow()
+    fair.db.session.commit()
+
+    delta = changes(client, token)
+    titles = {row["id"]: row["title"] for row in delta["changes"]["ads"]}
+    assert titles == {kept.id: "Остаётся, но другое", new.id: "Новое"}
+    assert delta["deleted"] == {"ads": [gone.id]}
+    assert delta["has_more"] is False
+
+    # по новому токену изменений уже нет
+    empty = changes(client, delta["next"])
+    assert empty["changes"] == {} and empty["deleted"] == {}
+    assert empty["next"] == delta["next"]
+
+
+def test_limit_sets_has_more(fair, pavilion):
+    client = fair.app.test_client()
+    token = client.get("/api/v1/changes").get_json()["next"]
+    fair.db.session.add_all(
+        [fair.Ad(title=f"А{i}", text="т", pavilion_id=pavilion.id) for i in range(3)]
+    )
+    fair.db.session.commit()
+
+    first = client.get(f"/api/v1/changes?since={token}&limit=2").get_json()
+    assert len(first["changes"]["ads"]) == 2 and first["has_more"] is True
+    rest = changes(client, first["next"])
+    assert len(rest["changes"]["ads"]) == 1 and rest["has_more"] is False
+
+
+def test_stale_and_broken_tokens(fair, ctx):
+    client = fair.app.test_client()
+    fair.db.session.add(fair.ChangeLogCompaction(horizon=10**9))
+    fair.db.session.commit()
+    try:
+        assert client.get("/api/v1/changes?since=" + fair.encode_cursor(5)).status_code == 410
+    finally:
+        fair.ChangeLogCompaction.query.filter_by(horizon=10**9).delete()
+        fair.db.session.commit()
+    assert client.get("/api/v1/changes?since=***").status_code == 400
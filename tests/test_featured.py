@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+KEY = "periodic:rank_featured_ads"
+
+
+def ranking_jobs(fair):
+    return fair.Job.query.filter(
+        fair.Job.kind == "rank_featured_ads", fair.Job.status.in_(("queued", "running"))
+    ).all()
+
+
+def test_cache_miss_does_not_write(fair, ctx):
+    fair.Job.query.filter_by(kind="rank_featured_ads").delete()
+    fair.db.session.commit()
+    fair.cache.clear()
+    later = datetime.utcnow() + timedelta(minutes=10)
+    fair.enqueue_job("rank_featured_ads", run_at=later, unique_key=KEY)
+
+    statements = []
+
+    def remember(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement.split(None, 1)[0].upper())
+
+    engine = fair.db.engine
+    event.listen(engine, "before_cursor_execute", remember)
+    try:
+        fair.featured_ad_cards()
+        fair.featured_ad_cards()
+    finally:
+        event.remove(engine, "before_cursor_execute", remember)
+    assert statements and set(statements) == {"SELECT"}
+
+    # пустой ключ замечает воркер: периодическая задача — на сейчас
+    fair._ensure_periodic_jobs()
+    jobs = ranking_jobs(fair)
+    assert len(jobs) == 1
+    assert jobs[0].unique_key == KEY
+    assert jobs[0].run_at <= datetime.utcnow()
+
+
+def test_cache_miss_after_failed_run_waits(fair, ctx):
+    fair.Job.query.filter_by(kind="rank_featured_ads").delete()
+    fair.db.session.commit()
+    fair.cache.clear()
+
+    # задача отработала, но результата в кэше нет — не перезапускаем каждый опрос
+    job = fair.enqueue_job("rank_featured_ads", unique_key=KEY)
+    job.status, job.finished_at = "failed", datetime.utcnow()
+    fair.db.session.commit()
+    fair._ensure_periodic_jobs()
+    (queued,) = ranking_jobs(fair)
+    retry = queued.run_at - job.finished_at
+    assert timedelta(seconds=fair.JOB_MISSING_RETRY) <= retry < timedelta(
+        seconds=fair.FEATURED_RANK_INTERVAL
+    )
+
+
+def test_empty_ranking_is_a_hit(fair, ctx):
+    fair.Job.query.filter_by(kind="rank_featured_ads").delete()
+    live = fair.Ad.query.filter(fair.Ad.deleted_at.is_(None))
+    ids = [ad.id for ad in live]
+    live.update({"deleted_at": datetime.utcnow()}, synchronize_session=False)
+    fair.db.session.commit()
+    try:
+        assert fair.rank_featured_ads({}) == []
+        assert fair.cache.get(fair.FEATURED_KEY) == []
+        assert fair.featured_ad_cards() == []
+        assert ranking_jobs(fair) == []
+    finally:
+        fair.db.session.rollback()
+        fair.Ad.query.filter(fair.Ad.id.in_(ids)).update(
+            {"deleted_at": None}, synchronize_session=False
+        )
+        fair.db.session.commit()
@@ -0,0 +1,72 @@
+import sqlite3
+import warnings
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import exc, insert
+
+
+def test_claim_binds_datetime_without_sqlite3_adapter(fair, ctx):
+    job = fair.enqueue_job("cleanup_jobs", priority=100)
+    fair.enqueue_job("cleanup_jobs", priority=100, delay=3600)
+
+    # адаптер по умолчанию устарел в Python 3.12: ошибка, если им воспользуются
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", DeprecationWarning)
+        adapters = dict(sqlite3.adapters)
+        sqlite3.adapters.pop((datetime, sqlite3.PrepareProtocol), None)
+        try:
+            claimed = fair._claim_job("test")
+        finally:
+            sqlite3.adapters.clear()
+            sqlite3.adapters.update(adapters)
+
+    assert claimed.id == job.id
+    assert claimed.status == "running"
+    assert abs(claimed.started_at - datetime.utcnow()) < timedelta(seconds=5)
+    fair.run_job(claimed)
+
+
+def test_one_active_job_per_unique_key(fair, ctx):
+    first = fair.enqueue_job("cleanup_jobs", unique_key="test:dedupe")
+    assert fair.enqueue_job("cleanup_jobs", unique_key="test:dedupe").id == first.id
+
+    # вставка мимо проверки (как у второго процесса) упирается в индекс
+    with pytest.raises(exc.IntegrityError):
+        fair.db.session.execute(
+            insert(fair.Job).values(
+                kind="cleanup_jobs", payload="{}", run_at=datetime.utcnow(),
+                unique_key="test:dedupe", status="queued",
+            )
+        )
+    fair.db.session.rollback()
+
+    # завершённая задача с тем же ключом новой не мешает
+    fair.Job.query.filter_by(id=first.id).update({"status": "done"})
+    fair.db.session.commit()
+    again = fair.enqueue_job("cleanup_jobs", unique_key="test:dedupe")
+    assert again.id != first.id and again.status == "queued"
+    fair.Job.query.filter_by(id=again.id).update({"status": "cancelled"})
+    fair.db.session.commit()
+
+
+def test_stale_job_fails_after_last_attempt(fair, ctx):
+    long_ago = datetime.utcnow() - timedelta(seconds=fair.JOB_LOCK_TIMEOUT * 2)
+    jobs = {}
+    for attempts in (1, 3):
+        job = fair.enqueue_job("cleanup_jobs", unique_key=f"test:stale:{attempts}")
+        fair.Job.query.filter_by(id=job.id).update(
+            {"status": "running", "attempts": attempts, "max_attempts": 3,
+             "locked_by": "dead", "locked_at": long_ago}
+        )
+        jobs[attempts] = job.id
+    fair.db.session.commit()
+
+    fair._requeue_stale_jobs()
+    retried = fair.db.session.get(fair.Job, jobs[1], populate_existing=True)
+    exhausted = fair.db.session.get(fair.Job, jobs[3], populate_existing=True)
+    assert retried.status == "queued" and retried.locked_by is None
+    assert exhausted.status == "failed" and exhausted.finished_at is not None
+    assert exhausted.last_error
+    fair.Job.query.filter_by(id=retried.id).update({"status": "cancelled"})
+    fair.db.session.commit()
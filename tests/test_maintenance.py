@@ -0,0 +1,42 @@
+import json
+import time
+
+from sqlalchemy import text
+
+
+def add_orphan_ad(fair):
+    fair.db.session.commit()
+    fair.db.session.execute(text("PRAGMA foreign_keys = OFF"))
+    ad_id = fair.db.session.execute(
+        text(
+            "INSERT INTO ads (title, text, pavilion_id, views) "
+            "VALUES ('с', 'т', -1, 0) RETURNING id"
+        )
+    ).scalar()
+    fair.db.session.commit()
+    fair.db.session.execute(text("PRAGMA foreign_keys = ON"))
+    return ad_id
+
+
+def test_orphans_are_only_reported_by_default(fair, user, admin_client):
+    assert fair.app.config["MAINTENANCE_FIX_ORPHANS"] is False
+    ad_id = add_orphan_ad(fair)
+
+    run = fair.run_maintenance_task("orphans", time.monotonic() + 60)
+    assert run.status == "problems" and "только отчёт" in run.summary
+    assert json.loads(run.details)["found"]["ads.pavilion_id"] >= 1
+    assert fair.db.session.get(fair.Ad, ad_id) is not None
+
+    assert b'value="orphans_fix"' in admin_client.get("/admin/maintenance").data
+    resp = admin_client.post("/admin/maintenance", data={"task": "orphans_fix"})
+    assert resp.status_code == 302
+    job = fair.Job.query.filter_by(unique_key="db_maintenance:orphans_fix").one()
+    assert job.payload_data == {"fix_orphans": True, "tasks": ["orphans"]}
+
+    fair.db_maintenance(job.payload_data)
+    fair.db.session.expire_all()
+    assert fair.db.session.get(fair.Ad, ad_id) is None
+    run = fair.last_maintenance_runs()["orphans"]
+    assert json.loads(run.details)["fixed"]["ads.pavilion_id"] >= 1
+    fair.db.session.delete(job)
+    fair.db.session.commit()
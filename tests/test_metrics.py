@@ -0,0 +1,32 @@
+import sqlite3
+
+import pytest
+from sqlalchemy import exc, text
+
+
+def lock_errors(fair):
+    return sum(fair.metrics.collect().get("fair_db_lock_errors_total", {}).values())
+
+
+def test_failed_statement_keeps_original_error(fair, ctx):
+    with fair.db.engine.connect() as conn:
+        with pytest.raises(exc.OperationalError, match="no such table"):
+            conn.execute(text("SELECT * FROM no_such_table"))
+        assert conn.info.get("sql_started") == []
+
+
+def test_lock_error_is_counted(fair, ctx):
+    before = lock_errors(fair)
+    other = sqlite3.connect(fair.DB_PATH)
+    other.execute("BEGIN IMMEDIATE")
+    try:
+        with fair.db.engine.connect() as conn:
+            conn.exec_driver_sql("PRAGMA busy_timeout=0")
+            with pytest.raises(exc.OperationalError, match="locked"):
+                conn.execute(text("UPDATE users SET role = role WHERE id = -1"))
+            conn.rollback()
+            conn.exec_driver_sql("PRAGMA busy_timeout=5000")
+    finally:
+        other.rollback()
+        other.close()
+    assert lock_errors(fair) == before + 1
@@ -0,0 +1,46 @@
+from datetime import datetime, timedelta
+
+
+def add_request(fair, user, status="pending", age_days=0):
+    req = fair.StreetRequest(
+        user_id=user.id, street_name="Улица", street_code="ul", pavilion_title="Павильон",
+        status=status, created_at=datetime.utcnow() - timedelta(days=age_days),
+    )
+    fair.db.session.add(req)
+    fair.db.session.commit()
+    return req.id
+
+
+def test_bulk_reject_reports_every_id(fair, user, admin_client):
+    old = add_request(fair, user, age_days=10)
+    fresh = add_request(fair, user)
+    done = add_request(fair, user, status="approved", age_days=10)
+    missing = fresh + 1000
+    pending = fair.StreetRequest.query.filter_by(status="pending").count()
+    fair.cache.set(
+        fair.ADMIN_COUNTERS_KEY, {"street": 5, "ad": 0, "pavilion": 0, "support": 0}, ttl=60
+    )
+
+    since = (datetime.utcnow() - timedelta(days=1)).strftime("%Y-%m-%d")
+    resp = admin_client.post(
+        "/admin/moderation/bulk",
+        data={
+            "kind": "street", "action": "reject", "format": "json",
+            "ids": [old, fresh, done, missing], "created_before": since,
+        },
+    )
+    assert resp.status_code == 200
+    items = {item["id"]: item for item in resp.json["items"]}
+    assert items[old]["result"] == "rejected"
+    assert items[fresh]["result"] == "skipped" and "фильтр" in items[fresh]["message"]
+    assert items[done]["result"] == "skipped" and "обработана" in items[done]["message"]
+    assert items[missing] == {"id": missing, "result": "error", "message": "заявка не найдена"}
+    assert resp.json["summary"] == {"rejected": 1, "skipped": 2, "error": 1}
+
+    fair.db.session.expire_all()
+    statuses = {r.id: r.status for r in fair.StreetRequest.query.filter(
+        fair.StreetRequest.id.in_((old, fresh, done))
+    )}
+    assert statuses == {old: "rejected", fresh: "pending", done: "approved"}
+    assert fair.StreetRequest.query.filter_by(status="pending").count() == pending - 1
+    assert fair.cache.get(fair.ADMIN_COUNTERS_KEY)["street"] == 4
@@ -0,0 +1,31 @@
+from datetime import date, timedelta
+
+from sqlalchemy import event
+
+
+def test_flush_stays_under_sqlite_bind_limit(fair, pavilion):
+    ad = fair.Ad(title="Просмотры", text="т", pavilion_id=pavilion.id)
+    fair.db.session.add(ad)
+    fair.db.session.commit()
+
+    # чужие id — в UPDATE и проверку живых; дни одного объявления — в upsert
+    size = fair.VIEWS_FLUSH_CHUNK * 2 + 1
+    counts = {(ad.id + 10**6 + i, date.today()): 1 for i in range(size)}
+    counts.update({(ad.id, date.today() - timedelta(days=i)): 2 for i in range(size)})
+
+    binds = []
+
+    def count_binds(conn, cursor, statement, parameters, context, executemany):
+        binds.append(len(parameters))
+
+    engine = fair.db.engine
+    event.listen(engine, "before_cursor_execute", count_binds)
+    try:
+        fair.write_views(counts)
+    finally:
+        event.remove(engine, "before_cursor_execute", count_binds)
+
+    assert max(binds) <= fair.SQLITE_MAX_VARIABLES
+    fair.db.session.refresh(ad)
+    assert ad.views == 2 * size
+    assert fair.AdViewDay.query.filter_by(ad_id=ad.id).count() == size